@@ -1,6 +1,9 @@
 import logging
 import os
-from .producers import DirMon
+from .pool import close_pools
+from .daemon import get_schedule, DEFAULT_INTERVAL
+# registers the built-in producers and processors
+from . import producers
 from .providers import providers
 
 try:
@@ -15,25 +18,51 @@ class AutoAnt(object):
 
     _is_locked = False
 
-    def __init__(self, config):
+    def __init__(self, config, interval=DEFAULT_INTERVAL):
         if not os.path.exists(config):
             log.critical("No config file named {0} found.".format(config))
             exit(2)
         self.config_name = config
+        self.interval = interval
         self.make_lock()
-        self.config = self._obj_from_json(config)
-        self._config = []
-        for config_item in self.config:
+        self.load_config()
+
+    def load_config(self):
+        """
+            Reads the config file and creates its producers and processors.
+            Exits on config errors, the current config is only replaced when
+            the new one is complete.
+        """
+        config = self._obj_from_json(self.config_name)
+        producers = []
+        # producer name: daemon mode schedule, from the config item "interval" or "cron"
+        schedules = dict()
+        for config_item in config:
+            schedule = get_schedule(config_item, self.interval)
             for producer_args in config_item['producer_sequence']:
-                producer_class = providers.get_class(producer_args['type_key'])
+                producer_class = self._get_class(producer_args['type_key'])
                 producer = producer_class(**producer_args)
                 for process in config_item['process_sequence']:
-                    processor_class = providers.get_class(process['type_key'])
+                    processor_class = self._get_class(process['type_key'])
                     process['mon_name'] = producer_args['name']
                     processor = processor_class(**process)
                     producer.add_process(processor)
 
-                self._config.append(producer)
+                producers.append(producer)
+                schedules[producer.name] = schedule
+        self.config, self._config, self.schedules = config, producers, schedules
+
+    @staticmethod
+    def _get_class(type_key):
+        provider_class = providers.get_class(type_key)
+        if provider_class is None:
+            log.critical("Unknown type_key {0}, see the --providers option".format(type_key))
+            exit(1)
+        return provider_class
+
+    @property
+    def producers(self):
+        return self._config
 
     @property
     def _lock_name(self):
@@ -55,8 +84,8 @@ class AutoAnt(object):
             pass
 
     def run(self):
+        thread_list = []
         for item in self._config:
-            thread_list = []
             if item.is_thread:
                 thread_list.append(item)
                 item.start()
@@ -64,6 +93,7 @@ class AutoAnt(object):
                 item.run()
         for thread_item in thread_list:
             thread_item.join()
+        close_pools()
 
     def list(self):
         """
@@ -85,6 +115,6 @@ class AutoAnt(object):
                 obj = _json.loads(json_file.read())
 
         except Exception as e:
-            log.critical('Unable to load configuration file (%s)' % e.message)
+            log.critical('Unable to load configuration file (%s)' % e)
             exit(1)
         return obj
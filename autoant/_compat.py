@@ -13,6 +13,16 @@ import sys
 PY2 = sys.version_info[0] == 2
 VER = sys.version_info
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
 if not PY2:
     text_type = str
     string_types = (str,)
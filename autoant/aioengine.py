@@ -0,0 +1,564 @@
+"""
+    asyncio engine, runs a process sequence pipelined from one thread.
+    Remote processors with an async counterpart transfer on the event loop,
+    all others run on a thread pool. Needs Python 3.
+"""
+import asyncio
+import copy
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .checksum import CHECKSUM_BLOCK_SIZE
+from .processors import ProcessorFTP, ProcessorSCP, STOP_ITEM, assert_file_locked, find_duplicate, retry_failed
+from .retry import CircuitOpenError, PUMP_INTERVAL
+from .metrics import get_metric, NULL_METRIC
+from .pool import destination_name
+from .ratelimit import reserve
+from .profiling import profile_call, register_thread, start_stage, stop_stage
+from .utils import lazy_import
+
+log = logging.getLogger(__name__)
+
+# processor class: (async counterpart, name of its library module)
+async_processors = dict()
+
+
+def register_async_processor(processor_class, module_name):
+    """
+        Registers an async counterpart of processor_class, used
+        only if its library module is installed. The library is
+        imported by the first sequence with a processor_class.
+    """
+    def inner(cls):
+        async_processors[processor_class] = (cls, module_name)
+        return cls
+    return inner
+
+
+def get_async_processor(processor, executor):
+    cls, module_name = async_processors.get(processor.__class__, (AsyncProcessor, None))
+    if module_name and not lazy_import(module_name):
+        cls = AsyncProcessor
+    if processor.checksum_verify or processor.rate_buckets('bytes') or getattr(processor, 'resume', False):
+        # destination checksums, bytes rate limits and resumed uploads are only done by the processor
+        cls = AsyncProcessor
+    return cls(processor, executor)
+
+
+class AsyncProcessor(object):
+    """
+        Async counterpart of a processor, runs it on the executor.
+        Opens up to 'threads' connections, each one used by one
+        run at a time, connected on first use and kept until disconnect.
+    """
+    connect_seconds = NULL_METRIC
+
+    def __init__(self, processor, executor):
+        self.processor = processor
+        self.executor = executor
+        self._idle = asyncio.Queue()
+        self._open = list()
+
+    @property
+    def name(self):
+        return self.processor.name
+
+    async def open_connection(self):
+        processor = copy.deepcopy(self.processor)
+        await asyncio.get_event_loop().run_in_executor(self.executor, processor.pre_process)
+        return processor
+
+    async def close_connection(self, processor):
+        await asyncio.get_event_loop().run_in_executor(self.executor, processor.post_process)
+
+    async def run_connection(self, processor, item):
+        """
+            Returns (success, error)
+        """
+        success = await asyncio.get_event_loop().run_in_executor(self.executor, processor.run, item)
+        return success, None if success else processor.last_error
+
+    async def acquire(self):
+        if self._idle.empty() and len(self._open) < self.processor.threads:
+            t1 = time.time()
+            connection = await self.open_connection()
+            self.connect_seconds.observe(time.time() - t1)
+            self._open.append(connection)
+            return connection
+        return await self._idle.get()
+
+    async def run(self, item):
+        connection = await self.acquire()
+        try:
+            return await self.run_connection(connection, item)
+        finally:
+            self._idle.put_nowait(connection)
+
+    async def disconnect(self):
+        for connection in self._open:
+            try:
+                await self.close_connection(connection)
+            except Exception as e:
+                log.error("{0}: Disconnect error {1}".format(self.name, e))
+        self._open = list()
+
+
+class BaseAsyncRemoteCP(AsyncProcessor):
+    """
+        Async counterpart of BaseProcessorRemoteCP
+    """
+    def __init__(self, processor, executor):
+        super(BaseAsyncRemoteCP, self).__init__(processor, executor)
+        self.connect_seconds = get_metric('destination_connect_seconds',
+                                          destination=destination_name(processor.pool_key))
+        # directory: future of the task creating it
+        self._making_dirs = dict()
+
+    def remote_path(self, file_item):
+        return self.processor.remote_dir + file_item.get_relative_path() + file_item.name
+
+    async def put(self, connection, file_item, remote_path):
+        """
+            Uploads file_item, sets its checksum if the processor has one
+        """
+        raise NotImplementedError
+
+    async def put_hashed(self, file_item, write):
+        """
+            Uploads file_item through write(data), hashing it on the same
+            read like the processor's HashingReader, sets its checksum
+        """
+        loop = asyncio.get_event_loop()
+        with open(file_item.full_path, 'rb') as fd:
+            reader = self.processor.open_reader(fd)
+            while True:
+                data = await loop.run_in_executor(self.executor, reader.read, CHECKSUM_BLOCK_SIZE)
+                if not data:
+                    break
+                await write(data)
+        file_item.checksum = reader.checksum
+
+    async def make_dirs(self, connection, directory):
+        raise NotImplementedError
+
+    async def is_dir(self, connection, directory):
+        raise NotImplementedError
+
+    async def check_connection(self, connection):
+        """
+            Raises if connection is not usable anymore
+        """
+        raise NotImplementedError
+
+    async def check_idle(self):
+        """
+            Closes idle connections failing a check, ex: closed by the server
+        """
+        alive = list()
+        while not self._idle.empty():
+            connection = self._idle.get_nowait()
+            try:
+                await self.check_connection(connection)
+                alive.append(connection)
+            except Exception as e:
+                log.info("{0}: Idle connection to {1} lost {2}".format(self.name, self.processor.remote_host, e))
+                self._open.remove(connection)
+                try:
+                    await self.close_connection(connection)
+                except Exception:
+                    pass
+        for connection in alive:
+            self._idle.put_nowait(connection)
+
+    async def _make_dir(self, connection, directory):
+        """
+            Creates directory once, concurrent tasks wait for the first one.
+            Created by someone else in the meantime is a success.
+        """
+        dir_cache = self.processor.dir_cache
+        while directory not in dir_cache:
+            making = self._making_dirs.get(directory)
+            if making is None:
+                break
+            # known when done, created again if it failed
+            await asyncio.shield(making)
+        else:
+            return
+        making = self._making_dirs[directory] = asyncio.get_event_loop().create_future()
+        try:
+            try:
+                await self.make_dirs(connection, directory)
+            except Exception:
+                if not await self.is_dir(connection, directory):
+                    raise
+            dir_cache.add(directory)
+        finally:
+            del self._making_dirs[directory]
+            making.set_result(None)
+
+    async def create_path(self, connection, remote_path):
+        """
+            Creates every unknown parent directory of remote_path, like DirCache.create_path
+        """
+        directory = os.path.dirname(remote_path).rstrip('/')
+        if not directory or directory in self.processor.dir_cache:
+            return
+        parts = directory.split('/')
+        for n in range(2, len(parts) + 1):
+            await self._make_dir(connection, '/'.join(parts[:n]))
+
+    async def run_connection(self, connection, file_item):
+        processor = self.processor
+        try:
+            assert_file_locked(file_item, processor.open_files)
+            remote_path = self.remote_path(file_item)
+            await self.create_path(connection, remote_path)
+            await self.put(connection, file_item, remote_path)
+            log.info("{0}: Async Put file {1}".format(self.name, file_item))
+        except Exception as e:
+            processor.dir_cache.invalidate(processor.remote_dir + file_item.get_relative_path())
+            log.error("{0}: Async Put error to {1} file {2} :{3}".format(self.name,
+                                                                         processor.remote_host,
+                                                                         file_item, e))
+            # a broken connection is not reused
+            self._open.remove(connection)
+            await self.close_connection(connection)
+            return False, e
+        return True, None
+
+    async def run(self, item):
+        try:
+            connection = await self.acquire()
+        except Exception as e:
+            log.error("{0}: Connect error to {1} {2}".format(self.name, self.processor.remote_host, e))
+            return False, e
+        result = await self.run_connection(connection, item)
+        if connection in self._open:
+            self._idle.put_nowait(connection)
+        return result
+
+
+@register_async_processor(ProcessorFTP, 'aioftp')
+class AsyncProcessorFTP(BaseAsyncRemoteCP):
+    """
+        FTP with aioftp, one control connection per concurrent transfer.
+        FTPS configs run the sync processor.
+    """
+    def __init__(self, processor, executor):
+        super(AsyncProcessorFTP, self).__init__(processor, executor)
+        self._fallback = None
+        if processor.is_ssl_auth or processor.is_ssl_data:
+            self._fallback = AsyncProcessor(processor, executor)
+
+    async def open_connection(self):
+        p = self.processor
+        client = lazy_import('aioftp').Client(socket_timeout=p.timeout)
+        await client.connect(p.remote_host, p.remote_port)
+        await client.login(p.username, p.password)
+        log.info("{0}: Async FTP Connected to {1} with {2}".format(self.name, p.remote_host, p.username))
+        return client
+
+    async def close_connection(self, client):
+        try:
+            await client.quit()
+        except Exception:
+            client.close()
+
+    async def make_dirs(self, client, directory):
+        await client.make_directory(directory, parents=True)
+
+    async def is_dir(self, client, directory):
+        try:
+            return await client.is_dir(directory)
+        except Exception:
+            return False
+
+    async def check_connection(self, client):
+        await client.command('NOOP', '200')
+
+    async def put(self, client, file_item, remote_path):
+        if not self.processor.checksum:
+            await client.upload(file_item.full_path, remote_path, write_into=True)
+            return
+        async with client.upload_stream(remote_path) as stream:
+            await self.put_hashed(file_item, stream.write)
+
+    async def run(self, item):
+        if self._fallback:
+            return await self._fallback.run(item)
+        return await super(AsyncProcessorFTP, self).run(item)
+
+    async def disconnect(self):
+        if self._fallback:
+            return await self._fallback.disconnect()
+        return await super(AsyncProcessorFTP, self).disconnect()
+
+
+@register_async_processor(ProcessorSCP, 'asyncssh')
+class AsyncProcessorSCP(BaseAsyncRemoteCP):
+    """
+        SFTP with asyncssh, all concurrent transfers share
+        one SSH connection, each one on its own SFTP channel.
+    """
+    _conn = None
+
+    async def _get_conn(self):
+        p = self.processor
+        if self._conn is None:
+            asyncssh = lazy_import('asyncssh')
+            self._conn = await asyncio.wait_for(
+                asyncssh.connect(p.remote_host, port=p.remote_port, username=p.username,
+                                 password=p.password or None,
+                                 client_keys=[p.key_filename] if p.key_filename else (),
+                                 known_hosts=None), p.timeout)
+            log.info("{0}: Async SFTP Connected to {1} with {2}".format(self.name, p.remote_host, p.username))
+        return self._conn
+
+    async def open_connection(self):
+        conn = await self._get_conn()
+        try:
+            return await conn.start_sftp_client()
+        except Exception:
+            # the SSH connection is probably gone, next open reconnects
+            self._conn = None
+            conn.close()
+            raise
+
+    async def close_connection(self, sftp):
+        sftp.exit()
+        await sftp.wait_closed()
+
+    async def make_dirs(self, sftp, directory):
+        await sftp.makedirs(directory, exist_ok=True)
+
+    async def is_dir(self, sftp, directory):
+        return await sftp.isdir(directory)
+
+    async def check_connection(self, sftp):
+        try:
+            await sftp.realpath('.')
+        except Exception:
+            # the SSH connection is probably gone too, next open reconnects
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            raise
+
+    async def put(self, sftp, file_item, remote_path):
+        if not self.processor.checksum:
+            await sftp.put(file_item.full_path, remote_path)
+            return
+        async with sftp.open(remote_path, 'wb') as remote_file:
+            await self.put_hashed(file_item, remote_file.write)
+
+    async def disconnect(self):
+        await super(AsyncProcessorSCP, self).disconnect()
+        if self._conn is not None:
+            self._conn.close()
+            await self._conn.wait_closed()
+            self._conn = None
+
+
+class AsyncSequenceRunner(object):
+    """
+        Runs a ProcessSequence pipelined on an event loop,
+        each processor has 'threads' concurrent tasks, and
+        transfers to the same remote host are capped by host_limit.
+        With keep_warm the event loop and remote connections are
+        kept between runs until close, remote connections idle
+        longer than pool_check_idle are checked when a run starts.
+    """
+    def __init__(self, process_sequence, queue_size=0, keep_warm=False):
+        self.process_sequence = process_sequence
+        self.queue_size = queue_size
+        self.keep_warm = keep_warm
+        self._host_limits = dict()
+        self._loop = None
+        self._executor = None
+        self._async_processors = None
+        self._last_run = None
+
+    def _host_limit(self, processor):
+        host = getattr(processor, 'remote_host', None)
+        limit = getattr(processor, 'host_limit', 0)
+        if not host or not limit:
+            return None
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(limit)
+        return self._host_limits[host]
+
+    @property
+    def _stage(self):
+        return self.process_sequence.sequence[0].producer_name + '.async'
+
+    def _start(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        workers = sum(process.threads for process in self.process_sequence.sequence) + 1
+        try:
+            # sampled as the engine stage, blocking calls run there
+            self._executor = ThreadPoolExecutor(max_workers=workers, initializer=register_thread,
+                                                initargs=(self._stage, self._stage + '.executor'))
+        except TypeError:
+            # Python < 3.7
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def run(self, generator):
+        self._start()
+        try:
+            profile_call(self._stage, self._stage, self._loop.run_until_complete, self._run(generator))
+        finally:
+            if not self.keep_warm:
+                self.close()
+
+    def close(self):
+        """
+            Closes kept connections, the event loop and the executor
+        """
+        if self._loop is None:
+            return
+        try:
+            for async_processor in self._async_processors or []:
+                self._loop.run_until_complete(async_processor.disconnect())
+        finally:
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+            self._loop = self._executor = self._async_processors = None
+
+    async def _worker(self, processor, async_processor, state, queue, next_queue, next_depends, host_limit):
+        while True:
+            item = await queue.get()
+            try:
+                if item is STOP_ITEM:
+                    break
+                state.metrics.took(queue.qsize())
+                success = True
+                if item not in state.processed:
+                    processor.pre_run(item)
+                    duplicate = None
+                    if processor.dedup:
+                        duplicate = await asyncio.get_event_loop().run_in_executor(
+                            async_processor.executor, find_duplicate, processor, state, item)
+                    if duplicate is not None:
+                        log.info("{0}: Skip {1} same content has {2}".format(processor.name, item, duplicate))
+                        state.metrics.count('skipped')
+                    else:
+                        success, error = await self._run_item(processor, async_processor, state, item, host_limit)
+                        if not success and retry_failed(processor, state, item, error):
+                            processor.post_run(item)
+                            continue
+                        state.retries.done(item)
+                        state.metrics.count('processed' if success else 'failed', item)
+                    if not success:
+                        state.add_fail(item)
+                    else:
+                        state.add_processed(item)
+                    processor.post_run(item)
+                else:
+                    state.metrics.count('skipped')
+                if next_queue is not None and (success or not next_depends):
+                    await next_queue.put(item)
+            except Exception as e:
+                log.error("{0}: Async engine error on {1} {2}".format(processor.name, item, e))
+            finally:
+                queue.task_done()
+
+    async def _run_item(self, processor, async_processor, state, item, host_limit):
+        """
+            Async run_item, returns (success, error)
+        """
+        breaker = processor.breaker
+        if breaker:
+            try:
+                breaker.check()
+            except CircuitOpenError as e:
+                return False, e
+        wait = reserve(processor.rate_buckets('files'), 1)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        t1 = time.time()
+        if host_limit:
+            async with host_limit:
+                success, error = await async_processor.run(item)
+        else:
+            success, error = await async_processor.run(item)
+        state.metrics.run_seconds.observe(time.time() - t1)
+        if breaker:
+            breaker.record(success, error)
+        return success, error
+
+    async def _drain(self, state, queue):
+        await queue.join()
+        while state.retries.pending:
+            await asyncio.sleep(state.retries.next_delay() or 0)
+            for item in state.retries.pop_due():
+                await queue.put(item)
+            await queue.join()
+
+    async def _pump_retries(self, targets):
+        """
+            Async RetryPump, puts due retries back on their queues
+            while items are produced, until cancelled
+        """
+        while True:
+            for retries, queue in targets:
+                retries.requeue_due(queue, asyncio.QueueFull)
+            delays = [retries.next_delay() for retries, queue in targets]
+            delays = [delay for delay in delays if delay is not None]
+            # due items that didn't fit on a full queue are tried again shortly
+            await asyncio.sleep(max(min(delays + [PUMP_INTERVAL]), 0.01))
+
+    def _produce(self, loop, generator, queue):
+        for item in generator():
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    async def _check_idle(self):
+        idle = time.time() - self._last_run
+        for async_processor in self._async_processors:
+            if isinstance(async_processor, BaseAsyncRemoteCP) and idle > async_processor.processor.pool_check_idle:
+                await async_processor.check_idle()
+
+    async def _run(self, generator):
+        loop = asyncio.get_event_loop()
+        executor = self._executor
+        sequence = self.process_sequence.sequence
+        states = [self.process_sequence.get_state(process) for process in sequence]
+        self.process_sequence.running_states = states
+        queues = [asyncio.Queue(self.queue_size) for process in sequence]
+        if self._async_processors is None:
+            self._async_processors = [get_async_processor(process, executor) for process in sequence]
+        elif self._last_run is not None:
+            await self._check_idle()
+        async_processors = self._async_processors
+        stages = list()
+        for i, process in enumerate(sequence):
+            next_queue, next_depends = None, False
+            if i + 1 < len(sequence):
+                next_queue, next_depends = queues[i + 1], sequence[i + 1].depends
+            states[i].metrics.start(process.threads)
+            start_stage(process.name)
+            stages.append([loop.create_task(self._worker(process, async_processors[i], states[i], queues[i],
+                                                         next_queue, next_depends, self._host_limit(process)))
+                           for task_id in range(process.threads)])
+        targets = [(state.retries, queue) for process, state, queue in zip(sequence, states, queues)
+                   if process.retries]
+        pump = loop.create_task(self._pump_retries(targets)) if targets else None
+        # the producer may block on disk, it runs on the executor
+        await loop.run_in_executor(executor, self._produce, loop, generator, queues[0])
+        if pump:
+            pump.cancel()
+        for process, state, queue, tasks, async_processor in zip(sequence, states, queues,
+                                                                 stages, async_processors):
+            await self._drain(state, queue)
+            for task in tasks:
+                await queue.put(STOP_ITEM)
+            await asyncio.wait(tasks, timeout=process.join_timeout)
+            if not self.keep_warm or not isinstance(async_processor, BaseAsyncRemoteCP):
+                await async_processor.disconnect()
+            state.metrics.stop()
+            state.metrics.log_summary()
+            stop_stage(process.name, state)
+            state.save()
+        self._last_run = time.time()
@@ -0,0 +1,92 @@
+"""
+    Content checksums, computed while files are read for transfer.
+    Checksums are strings "<algorithm>:<hexdigest>", ex: "sha256:9f86d0..."
+"""
+import hashlib
+
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+
+def is_algorithm(algorithm):
+    try:
+        hashlib.new(algorithm)
+    except ValueError:
+        return False
+    return True
+
+
+def format_checksum(algorithm, hexdigest):
+    return "{0}:{1}".format(algorithm, hexdigest)
+
+
+def checksum_algorithm(checksum):
+    return checksum.split(':', 1)[0] if checksum else None
+
+
+class HashingReader(object):
+    """
+        File object wrapper, hashes all data read through it
+    """
+    def __init__(self, fd, algorithm):
+        self.fd = fd
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        self.hash.update(data)
+        return data
+
+    def read_through(self, offset):
+        """
+            Hashes from the start of the file up to offset, where the
+            next read continues, for transfers resumed at offset
+        """
+        self.fd.seek(0)
+        while offset > 0:
+            data = self.read(min(CHECKSUM_BLOCK_SIZE, offset))
+            if not data:
+                break
+            offset -= len(data)
+
+    @property
+    def checksum(self):
+        return format_checksum(self.algorithm, self.hash.hexdigest())
+
+
+class HashingWriter(object):
+    """
+        Write only file object hashing all data written, to
+        checksum remote files read back through a callback
+    """
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.hash = hashlib.new(algorithm)
+
+    def write(self, data):
+        self.hash.update(data)
+
+    @property
+    def checksum(self):
+        return format_checksum(self.algorithm, self.hash.hexdigest())
+
+
+def hash_stream(read, algorithm):
+    """
+        Returns the checksum of all data returned by read(size)
+    """
+    file_hash = hashlib.new(algorithm)
+    while True:
+        data = read(CHECKSUM_BLOCK_SIZE)
+        if not data:
+            break
+        file_hash.update(data)
+    return format_checksum(algorithm, file_hash.hexdigest())
+
+
+def hash_file(path, algorithm):
+    with open(path, 'rb') as fd:
+        return hash_stream(fd.read, algorithm)
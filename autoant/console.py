@@ -5,6 +5,9 @@ import logging
 import datetime
 from autoant import AutoAnt
 from .providers import providers
+from . import metrics
+from . import profiling
+from .daemon import Daemon, DEFAULT_INTERVAL
 from .version import VERSION_STRING
 
 log_level = {'INFO':logging.INFO,
@@ -24,7 +27,20 @@ parser.add_argument('-p', '--providers', action='store_true', help='Shows availa
 parser.add_argument('-s', '--state', action='store_true', help='List the state of producers')
 parser.add_argument('-d', '--describe', action='store_true', help='Shows a summary of the config')
 parser.add_argument('-v', '--version', action='store_true', help='Shows AutoAnt version')
-parser.add_argument('-m', '--measure', action='store_true', help='Will measure run time')
+parser.add_argument('-m', '--measure', action='store_true', help='Will measure run time and log processor metrics')
+parser.add_argument('--metrics-json', type=str, default=None, help='Writes a JSON metrics report to this file')
+parser.add_argument('--metrics-prom', type=str, default=None,
+                    help='Writes metrics to this Prometheus textfile, ex: for node_exporter')
+parser.add_argument('--daemon', action='store_true',
+                    help='Keeps running, each config item on its "interval" seconds or "cron" schedule')
+parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL,
+                    help='Seconds between runs of config items without a schedule on --daemon')
+parser.add_argument('--profile', type=str, default=None,
+                    help='Profiles each processor and producer, writes pstats and collapsed stacks to this dir')
+parser.add_argument('--profile-memory', action='store_true',
+                    help='With --profile, also writes tracemalloc snapshots of each processor (Python 3)')
+parser.add_argument('--profile-interval', type=float, default=profiling.DEFAULT_SAMPLE_INTERVAL,
+                    help='Seconds between stack samples with --profile')
 
 args = parser.parse_args()
 
@@ -48,12 +64,40 @@ def main():
     elif vars(args).get('version'):
         print("AutoAnt {0}".format(VERSION_STRING))
     else:
-        aa = AutoAnt(args.config)
+        if args.measure or args.metrics_json or args.metrics_prom:
+            metrics.enable()
+        if args.profile:
+            profiling.enable(args.profile, args.profile_memory, args.profile_interval)
+        aa = AutoAnt(args.config, args.interval)
+        if args.daemon:
+            # metrics are written after each cycle, node_exporter reads them while running
+            Daemon(aa, write_metrics).run()
+            write_profiles()
+            return
         t1 = datetime.datetime.now()
         aa.run()
         t2 = datetime.datetime.now()
         if vars(args).get('measure'):
             log.info("Time to Process {0}".format(t2 - t1))
+        write_metrics()
+        write_profiles()
+
+
+def write_metrics():
+    try:
+        if args.metrics_json:
+            metrics.registry.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.registry.write_prometheus(args.metrics_prom)
+    except (IOError, OSError) as e:
+        log.error("Unable to write metrics {0}".format(e))
+
+
+def write_profiles():
+    try:
+        profiling.write()
+    except (IOError, OSError) as e:
+        log.error("Unable to write profiles {0}".format(e))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,245 @@
+"""
+    Daemon mode, runs each producer on its own interval or cron
+    schedule. Processing states, connection pools and caches stay
+    in memory between cycles. SIGHUP reloads the config, SIGTERM
+    stops producing and waits for queued items before exiting.
+"""
+import calendar
+import datetime
+import logging
+import signal
+import time
+from threading import Thread, Event, Lock
+from .pool import close_pools
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 60
+# Seconds between checks of the schedules
+MAX_SLEEP = 1
+CRON_MACROS = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@midnight': '0 0 * * *',
+               '@weekly': '0 0 * * 0', '@monthly': '0 0 1 * *', '@yearly': '0 0 1 1 *',
+               '@annually': '0 0 1 1 *'}
+# (name, min, max) of cron fields, 7 is also sunday
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+
+
+class IntervalSchedule(object):
+    def __init__(self, interval):
+        self.interval = interval
+
+    def first_time(self, now):
+        return now
+
+    def next_time(self, after):
+        return after + self.interval
+
+    def __repr__(self):
+        return "every {0}s".format(self.interval)
+
+
+class CronSchedule(object):
+    """
+        Cron expression with minute, hour, day of month, month and
+        day of week fields, each one a *, a value, a range or a list
+        with optional /step, ex: "*/5 8-18 * * 1-5". Local time.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CRON_MACROS.get(expression.strip(), expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError("{0} needs {1} fields".format(expression, len(CRON_FIELDS)))
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            _parse_cron_field(field, low, high) for field, (name, low, high) in zip(fields, CRON_FIELDS)]
+        self.weekdays = set(weekday % 7 for weekday in weekdays)
+        # with both days and weekdays restricted cron runs on either of them, a field
+        # starting with * is unrestricted, even with a step
+        self.either_day = not fields[2].startswith('*') and not fields[4].startswith('*')
+        if self.next_time(time.time()) is None:
+            raise ValueError("{0} never runs".format(expression))
+
+    def _day_matches(self, day):
+        in_days = day.day in self.days
+        # cron weekdays start on sunday
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self.either_day:
+            return in_days or in_weekdays
+        return in_days and in_weekdays
+
+    def first_time(self, now):
+        return self.next_time(now)
+
+    def next_time(self, after):
+        """
+            Timestamp of the first matching minute after after, None if never
+        """
+        t = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # february 29th on a given weekday can take years
+        limit = t + datetime.timedelta(days=366 * 28)
+        while t < limit:
+            if t.month not in self.months:
+                days = calendar.monthrange(t.year, t.month)[1] - t.day + 1
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=days)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return time.mktime(t.timetuple())
+        return None
+
+    def __repr__(self):
+        return "cron {0}".format(self.expression)
+
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(value) for value in part.split('-', 1)]
+        else:
+            start = end = int(part)
+            if step > 1:
+                end = high
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError("{0} out of {1}-{2}".format(field, low, high))
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def get_schedule(config_item, default_interval=DEFAULT_INTERVAL):
+    """
+        Returns the schedule of a config item from its "cron" or "interval" keys
+    """
+    try:
+        if config_item.get('cron'):
+            return CronSchedule(config_item['cron'])
+        interval = float(config_item.get('interval', default_interval))
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        return IntervalSchedule(interval)
+    except ValueError as e:
+        log.critical("Invalid schedule {0}".format(e))
+        exit(1)
+
+
+class Daemon(object):
+    """
+        Runs the producers of an AutoAnt on their schedules until SIGTERM or SIGINT.
+        A producer cycle still running when it's due again is skipped.
+        after_cycle is called after each cycle, ex: to write metrics.
+    """
+    def __init__(self, autoant, after_cycle=None):
+        self.autoant = autoant
+        self.after_cycle = after_cycle
+        # producer name: (producer, schedule, next due time)
+        self._producers = dict()
+        # producer name: cycle thread
+        self._cycles = dict()
+        self._wake = Event()
+        self._stopping = False
+        self._reloading = False
+        self._after_cycle_lock = Lock()
+
+    def _schedule_producers(self):
+        now = time.time()
+        self._producers = dict()
+        for producer in self.autoant.producers:
+            # processed items and async connections are kept between cycles
+            producer.process_sequence.keep_warm = True
+            schedule = self.autoant.schedules[producer.name]
+            self._producers[producer.name] = (producer, schedule, schedule.first_time(now))
+            log.info("{0}: Scheduled {1}".format(producer.name, schedule))
+
+    def _on_signal(self, signum, frame):
+        if signum == getattr(signal, 'SIGHUP', None):
+            log.info("Reloading the config")
+            self._reloading = True
+        else:
+            log.info("Stopping, waiting for queued items")
+            self._stopping = True
+        self._wake.set()
+
+    def run(self):
+        for signal_name in ('SIGTERM', 'SIGINT', 'SIGHUP'):
+            if hasattr(signal, signal_name):
+                signal.signal(getattr(signal, signal_name), self._on_signal)
+        self._schedule_producers()
+        while not self._stopping:
+            if self._reloading:
+                self.reload()
+            now = time.time()
+            for name, (producer, schedule, due) in list(self._producers.items()):
+                if due <= now:
+                    self._start_cycle(producer)
+                    self._producers[name] = (producer, schedule, schedule.next_time(now))
+            next_due = min([due for producer, schedule, due in self._producers.values()] or [now + MAX_SLEEP])
+            self._wake.wait(min(max(next_due - time.time(), 0), MAX_SLEEP))
+            self._wake.clear()
+        self.stop()
+
+    def _start_cycle(self, producer):
+        cycle = self._cycles.get(producer.name)
+        if cycle is not None and cycle.is_alive():
+            log.warning("{0}: Previous cycle still running, skipping this one".format(producer.name))
+            return
+        cycle = Thread(target=self._cycle, args=(producer,), name=producer.name + '.cycle')
+        cycle.daemon = True
+        self._cycles[producer.name] = cycle
+        cycle.start()
+
+    def _cycle(self, producer):
+        t1 = time.time()
+        try:
+            producer.run()
+        except Exception as e:
+            log.error("{0}: Cycle error {1}".format(producer.name, e))
+        log.info("{0}: Cycle done in {1:.3f}s".format(producer.name, time.time() - t1))
+        if self.after_cycle:
+            with self._after_cycle_lock:
+                self.after_cycle()
+
+    def _wait_cycles(self):
+        for cycle in list(self._cycles.values()):
+            # a timed join, so signals are still handled
+            while cycle.is_alive():
+                cycle.join(MAX_SLEEP)
+        self._cycles = dict()
+
+    def reload(self):
+        """
+            Loads the config again, then stops producing and waits for
+            running cycles of the current one, like stop, before scheduling
+            the new one. An invalid config is logged and the current one is kept.
+        """
+        self._reloading = False
+        producers = self.autoant.producers
+        try:
+            self.autoant.load_config()
+        except SystemExit:
+            log.error("Invalid config, keeping the current one")
+            return
+        # watching producers never end their cycle on their own
+        for producer in producers:
+            producer.stop()
+        self._wait_cycles()
+        for producer in producers:
+            producer.process_sequence.close()
+        self._schedule_producers()
+
+    def stop(self):
+        for producer in self.autoant.producers:
+            producer.stop()
+        self._wait_cycles()
+        for producer in self.autoant.producers:
+            producer.process_sequence.close()
+        close_pools()
+        log.info("Stopped")
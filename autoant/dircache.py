@@ -0,0 +1,104 @@
+import logging
+from threading import Event, Lock
+
+log = logging.getLogger(__name__)
+
+_caches = dict()
+_caches_lock = Lock()
+
+
+class DirCache(object):
+    """
+        Directories known to exist on one destination, shared by all
+        threads writing to it. Each directory is created once per run,
+        concurrent creations of the same directory wait for the first one.
+    """
+    def __init__(self, key):
+        self.key = key
+        self._known = set()
+        self._pending = dict()
+        self._lock = Lock()
+        self._seed_lock = Lock()
+        self._seeded = False
+
+    def __contains__(self, path):
+        return path in self._known
+
+    def _make(self, path, make_dir):
+        while True:
+            with self._lock:
+                if path in self._known:
+                    return
+                event = self._pending.get(path)
+                if event is None:
+                    event = self._pending[path] = Event()
+                    break
+            # another thread is creating it, it's known when done or failed
+            event.wait()
+        try:
+            make_dir(path)
+            with self._lock:
+                self._known.add(path)
+        finally:
+            with self._lock:
+                del self._pending[path]
+            event.set()
+
+    def create_path(self, path, make_dir):
+        """
+            Calls make_dir for every unknown parent directory of path,
+            a path ending with '/' is a directory itself.
+        """
+        parts = path.split('/')
+        if '/'.join(parts[:-1]) in self._known:
+            return
+        for n in range(2, len(parts)):
+            self._make('/'.join(parts[:n]), make_dir)
+
+    def seed(self, path, list_dirs, depth=1):
+        """
+            Adds path and its sub directories, up to depth levels,
+            from list_dirs(path) listings. Only done once.
+        """
+        with self._seed_lock:
+            if self._seeded:
+                return
+            self._seeded = True
+            dirs = [path.rstrip('/')]
+            try:
+                for level in range(depth):
+                    sub_dirs = list()
+                    for directory in dirs:
+                        found = [directory + '/' + name for name in list_dirs(directory + '/')]
+                        with self._lock:
+                            self._known.add(directory)
+                            self._known.update(found)
+                        sub_dirs.extend(found)
+                    dirs = sub_dirs
+            except Exception as e:
+                log.warning("{0}: Seed directory cache error {1}".format(self.key, e))
+
+    def add(self, path):
+        """
+            Adds path and all its parents, after they were created elsewhere
+        """
+        parts = path.rstrip('/').split('/')
+        with self._lock:
+            for n in range(2, len(parts) + 1):
+                self._known.add('/'.join(parts[:n]))
+
+    def invalidate(self, path):
+        """
+            Forgets path and all its parents, they're created again on next use
+        """
+        parts = path.rstrip('/').split('/')
+        with self._lock:
+            for n in range(2, len(parts) + 1):
+                self._known.discard('/'.join(parts[:n]))
+
+
+def get_dir_cache(key):
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = DirCache(key)
+        return _caches[key]
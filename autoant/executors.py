@@ -0,0 +1,94 @@
+import logging
+from threading import Thread
+from .pool import close_pools
+from .retry import RetryableError, is_retryable
+from .utils import lazy_import
+
+log = logging.getLogger(__name__)
+
+# The processor of a pool worker process
+_worker_processor = None
+# Its pre_process error, items fail instead of the pool starting workers again
+_worker_error = None
+
+
+def _init_worker(processor_class, kwargs):
+    global _worker_processor, _worker_error
+    _worker_processor = processor_class(**kwargs)
+    try:
+        _worker_processor.pre_process()
+    except Exception as e:
+        log.error("{0}: Pre process error {1}".format(_worker_processor.name, e))
+        _worker_error = Exception(str(e))
+        return
+    # runs when the worker process exits, after the pool is closed
+    finalize = lazy_import('multiprocessing.util', 'Finalize')
+    finalize(None, _worker_processor.post_process, exitpriority=10)
+    finalize(None, close_pools, exitpriority=5)
+
+
+def _run_item(item):
+    if _worker_error is not None:
+        return False, item, _worker_error
+    # the item goes back with what the processor set on it, ex: its checksum
+    success = _worker_processor.run(item)
+    error = _worker_processor.last_error
+    if error is not None:
+        # library errors may not pickle, only if they are retryable matters here
+        error = RetryableError(str(error)) if is_retryable(error) else Exception(str(error))
+    return success, item, error
+
+
+def create_pool(processor):
+    """
+        Returns a pool with processor.threads worker processes,
+        each one with its own processor built from the same config.
+    """
+    return lazy_import('multiprocessing').Pool(processor.threads, _init_worker, (processor.__class__, processor.kwargs))
+
+
+def close_pool(pool, timeout):
+    """
+        Lets workers run post_process and exit, terminates
+        them if they take longer than timeout seconds.
+    """
+    pool.close()
+    joiner = Thread(target=pool.join)
+    joiner.setDaemon(True)
+    joiner.start()
+    joiner.join(timeout)
+    if joiner.is_alive():
+        log.warning("Process pool did not stop in {0}s, terminating".format(timeout))
+        pool.terminate()
+
+
+class PoolProcessor(object):
+    """
+        Stands for a processor on a ProcessThread, items are run
+        on a pool worker process, all other calls go to the processor.
+        pre_process and post_process are done by each worker process.
+    """
+    def __init__(self, processor, pool):
+        self.processor = processor
+        self.pool = pool
+        self.last_error = None
+
+    def __getattr__(self, name):
+        return getattr(self.processor, name)
+
+    def pre_process(self):
+        return True
+
+    def post_process(self):
+        return True
+
+    def run(self, item):
+        try:
+            success, worked_item, self.last_error = self.pool.apply(_run_item, (item,))
+            if hasattr(item, '__setstate__'):
+                item.__setstate__(worked_item.__getstate__())
+            return success
+        except Exception as e:
+            log.error("{0}: Process pool error on {1} {2}".format(self.processor.name, item, e))
+            self.last_error = e
+            return False
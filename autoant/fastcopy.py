@@ -0,0 +1,204 @@
+"""
+    Local file copy trying the cheapest kernel path first,
+    reflink (FICLONE), copy_file_range, sendfile, then a buffered copy.
+"""
+import errno
+import logging
+import os
+import shutil
+from sys import platform
+from threading import Lock
+from .utils import lazy_import
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile', 'buffered')
+FSYNC_POLICIES = ('never', 'file', 'dir')
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+BUFFER_SIZE = 1024 * 1024
+MAX_CHUNK = 1024 * 1024 * 1024
+# Errors meaning a method is not supported for these files, not a failed copy
+UNSUPPORTED_ERRNOS = set(getattr(errno, name) for name in ('EXDEV', 'EINVAL', 'ENOSYS', 'EOPNOTSUPP',
+                                                           'ENOTSUP', 'ENOTTY', 'EBADF', 'EPERM')
+                         if hasattr(errno, name))
+
+# (method, source device, destination device) known not to work
+_unsupported = set()
+_unsupported_lock = Lock()
+_libc = None
+
+
+class UnsupportedCopy(Exception):
+    pass
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc_name = lazy_import('ctypes.util').find_library('c') or 'libc.so.6'
+        _libc = lazy_import('ctypes').CDLL(libc_name, use_errno=True)
+    return _libc
+
+
+def _raise_errno():
+    err = lazy_import('ctypes').get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def _os_copy_file_range(src_fd, dst_fd, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(src_fd, dst_fd, count)
+    # Python < 3.8, glibc >= 2.27
+    libc = _get_libc()
+    if not hasattr(libc, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range not available')
+    ctypes = lazy_import('ctypes')
+    libc.copy_file_range.restype = ctypes.c_ssize_t
+    copied = libc.copy_file_range(src_fd, None, dst_fd, None, ctypes.c_size_t(count), 0)
+    if copied < 0:
+        _raise_errno()
+    return copied
+
+
+def _os_sendfile(dst_fd, src_fd, offset, count):
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(dst_fd, src_fd, offset, count)
+    libc = _get_libc()
+    ctypes = lazy_import('ctypes')
+    libc.sendfile.restype = ctypes.c_ssize_t
+    c_offset = ctypes.c_longlong(offset)
+    sent = libc.sendfile(dst_fd, src_fd, ctypes.byref(c_offset), ctypes.c_size_t(count))
+    if sent < 0:
+        _raise_errno()
+    return sent
+
+
+def _reflink(src_fd, dst_fd, size, throttle=None):
+    # shares the source blocks, no data is written to throttle
+    if fcntl is None or not platform.startswith('linux'):
+        raise UnsupportedCopy()
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _chunk_size(throttle):
+    # throttled copies go in small chunks, waiting between them
+    return BUFFER_SIZE if throttle else MAX_CHUNK
+
+
+def _copy_file_range(src_fd, dst_fd, size, throttle=None):
+    if not platform.startswith('linux'):
+        raise UnsupportedCopy()
+    copied = 0
+    while True:
+        n = _os_copy_file_range(src_fd, dst_fd, min(_chunk_size(throttle), max(size - copied, BUFFER_SIZE)))
+        if n == 0:
+            break
+        copied += n
+        if throttle:
+            throttle(n)
+    if copied == 0 and size > 0:
+        # some filesystems (procfs, sysfs) report no data
+        raise UnsupportedCopy()
+
+
+def _sendfile(src_fd, dst_fd, size, throttle=None):
+    if not platform.startswith('linux'):
+        raise UnsupportedCopy()
+    offset = 0
+    while True:
+        n = _os_sendfile(dst_fd, src_fd, offset, min(_chunk_size(throttle), max(size - offset, BUFFER_SIZE)))
+        if n == 0:
+            break
+        offset += n
+        if throttle:
+            throttle(n)
+    if offset == 0 and size > 0:
+        raise UnsupportedCopy()
+
+
+def _buffered(src_fd, dst_fd, size, throttle=None):
+    while True:
+        data = os.read(src_fd, BUFFER_SIZE)
+        if not data:
+            break
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        if throttle:
+            throttle(len(data))
+
+
+_copiers = (_reflink, _copy_file_range, _sendfile, _buffered)
+
+
+def _is_unsupported(e, copied):
+    """
+        True if the method failed before copying anything,
+        for a reason the next method may not have.
+    """
+    if isinstance(e, UnsupportedCopy):
+        return True
+    return isinstance(e, (OSError, IOError)) and e.errno in UNSUPPORTED_ERRNOS and not copied
+
+
+def fsync_dir(path):
+    """
+        Syncs the directory holding path, making its creation durable
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_file(src, dst, preserve_metadata=False, fsync='never', throttle=None):
+    """
+        Copies src to dst, overwriting it, with the first method in
+        COPY_METHODS that works, returns the method used.
+        preserve_metadata copies mode and times, fsync is one
+        of FSYNC_POLICIES, 'dir' also syncs dst directory.
+        throttle(bytes) is called after each chunk copied.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.Error("{0} and {1} are the same file".format(src, dst))
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        src_stat = os.fstat(src_fd)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            dst_dev = os.fstat(dst_fd).st_dev
+            for method, copier in zip(COPY_METHODS, _copiers):
+                key = (method, src_stat.st_dev, dst_dev)
+                if key in _unsupported:
+                    continue
+                try:
+                    copier(src_fd, dst_fd, src_stat.st_size, throttle)
+                    break
+                except Exception as e:
+                    copied = os.lseek(dst_fd, 0, os.SEEK_CUR) > 0 or os.fstat(dst_fd).st_size > 0
+                    if method == COPY_METHODS[-1] or not _is_unsupported(e, copied):
+                        raise
+                    log.debug("Copy with {0} not supported from {1} to {2} {3}".format(method, src, dst, e))
+                    with _unsupported_lock:
+                        _unsupported.add(key)
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dst_fd, 0)
+            if fsync != 'never':
+                os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    if preserve_metadata:
+        shutil.copystat(src, dst)
+    if fsync == 'dir':
+        fsync_dir(dst)
+    return method
@@ -1,7 +1,10 @@
 import os
+import stat
+import time
 import datetime
 import ntpath
-from _compat import as_unicode
+from collections import OrderedDict
+from ._compat import as_unicode, itervalues
 
 class FileItem(object):
     """
@@ -15,26 +18,45 @@ class FileItem(object):
     mtime = None
     atime = None
     processed_time = None
+    # "<algorithm>:<hexdigest>" of the content, set by processors with checksum
+    checksum = None
+    # attributes pickled, on this order, to save state and ship items to processes
+    _state_attrs = ('basedir', 'full_path', 'name', 'size', 'ctime', 'mtime', 'atime', 'processed_time',
+                    'checksum')
 
-    def __init__(self, file_name, basedir=''):
+    def __init__(self, file_name, basedir='', stat_result=None):
         self.basedir = basedir
         # TODO use os.path.join
-        file_name = file_name.decode('utf-8')
+        file_name = as_unicode(file_name)
         self.full_path = file_name
-        (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(self.full_path)
+        if stat_result is None:
+            stat_result = os.stat(self.full_path)
         self.name = ntpath.basename(file_name)
-        self.size = size
-        self.mtime = mtime
-        self.ctime = ctime
-        self.atime = atime
+        # integer timestamps, same has the tuple values of os.stat
+        self.size = stat_result[stat.ST_SIZE]
+        self.mtime = stat_result[stat.ST_MTIME]
+        self.ctime = stat_result[stat.ST_CTIME]
+        self.atime = stat_result[stat.ST_ATIME]
+
+    @property
+    def key(self):
+        """
+            Hashable identity of the item, two items with
+            the same key are the same for processing state.
+        """
+        return (self.full_path, self.size, self.mtime)
 
     def __eq__(self, other):
         if type(other) is type(self):
-            return (self.full_path == other.full_path) and \
-                    (self.size == other.size) and \
-                    (self.mtime == other.mtime)
+            return self.key == other.key
         return False
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key)
+
     @classmethod
     def check_time(cls, value, ftime):
         t1 = datetime.datetime.now()
@@ -67,6 +89,17 @@ class FileItem(object):
         (mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = os.stat(file_name)
         return cls.check_time(value, ctime)
 
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self._state_attrs)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled by older versions
+            self.__dict__.update(state)
+        else:
+            for attr, value in zip(self._state_attrs, state):
+                setattr(self, attr, value)
+
     def __repr__(self):
         return self.full_path
 
@@ -77,3 +110,67 @@ class FileItem(object):
     def get_relative_path(self):
         return self.full_path.replace(self.basedir, '').replace(self.name, '')
 
+
+
+class TimeFilter(object):
+    """
+        Filters stat results by modified, accessed and created time.
+        Values are minutes, positive for older than, negative for newer than.
+        Cutoffs are computed once, for all the files of a scan.
+    """
+    def __init__(self, mtime=0, atime=0, ctime=0, now=None):
+        if now is None:
+            now = time.time()
+        self._checks = list()
+        for attr, value in (('st_mtime', mtime), ('st_atime', atime), ('st_ctime', ctime)):
+            if value != 0:
+                self._checks.append((attr, value >= 0, now - abs(value) * 60))
+
+    def check(self, stat_result):
+        for attr, older, cutoff in self._checks:
+            ftime = getattr(stat_result, attr)
+            if older and not ftime < cutoff:
+                return False
+            if not older and not ftime > cutoff:
+                return False
+        return True
+
+
+def get_item_key(item):
+    """
+        Returns the key used to index an item,
+        items without a key property are their own key.
+    """
+    return getattr(item, 'key', item)
+
+
+class ItemIndex(object):
+    """
+        Collection of items indexed by their key,
+        membership tests are O(1). Keeps insertion order.
+    """
+    def __init__(self, items=None):
+        self._items = OrderedDict()
+        for item in items or []:
+            self.append(item)
+
+    def append(self, item):
+        self._items[get_item_key(item)] = item
+
+    def remove(self, item):
+        self._items.pop(get_item_key(item), None)
+
+    def get(self, item, default=None):
+        return self._items.get(get_item_key(item), default)
+
+    def __contains__(self, item):
+        return get_item_key(item) in self._items
+
+    def __iter__(self):
+        return itervalues(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "ItemIndex({0} items)".format(len(self))
@@ -0,0 +1,75 @@
+import logging
+import os
+import time
+from ._compat import pickle
+from .utils import listdir_stat
+
+log = logging.getLogger(__name__)
+
+manifest_file_extension = 'manifest'
+# Listings of directories modified this close to the scan are not kept,
+# a change on the same mtime tick would go unnoticed
+MANIFEST_RACY_SECONDS = 2
+
+
+class DirManifest(object):
+    """
+        Keeps each directory mtime and listing between scans.
+        Directories with an unchanged mtime are replayed from the
+        manifest instead of being listed, costing one stat per directory.
+        Files changed in place do not change their directory mtime,
+        they are replayed with their previous stat.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._dirs = dict()
+        self._seen = dict()
+        self.replayed = 0
+        self.listed = 0
+
+    def _get_filename(self):
+        return self.name + '.' + manifest_file_extension
+
+    def load(self):
+        try:
+            if os.path.isfile(self._get_filename()):
+                with open(self._get_filename(), 'rb') as f:
+                    self._dirs = pickle.load(f)
+        except Exception as e:
+            log.error("{0}: Load manifest file error {1}".format(self.name, e))
+
+    def save(self):
+        log.debug("{0}: Manifest replayed {1} directories, listed {2}".format(self.name, self.replayed, self.listed))
+        try:
+            tmp_filename = self._get_filename() + '.tmp'
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump(self._seen, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, self._get_filename())
+        except Exception as e:
+            log.error("{0}: Save manifest file error {1}".format(self.name, e))
+        # ready for the next scan
+        self._dirs, self._seen = self._seen, dict()
+        self.replayed = self.listed = 0
+
+    def listdir_stat(self, directory):
+        """
+            Same has utils.listdir_stat, replaying unchanged directories
+        """
+        try:
+            dir_mtime = os.stat(directory).st_mtime
+        except OSError:
+            return [], []
+        cached = self._dirs.get(directory)
+        if cached and cached[0] == dir_mtime:
+            self.replayed += 1
+            files = [(file_name, os.stat_result(stat_tuple)) for file_name, stat_tuple in cached[1]]
+            dirs = cached[2]
+            stat_tuples = cached[1]
+        else:
+            self.listed += 1
+            files, dirs = listdir_stat(directory)
+            # keep only the integer stat fields, they are all FileItem and filters need
+            stat_tuples = [(file_name, tuple(stat_result)) for file_name, stat_result in files]
+        if dir_mtime < time.time() - MANIFEST_RACY_SECONDS:
+            self._seen[directory] = (dir_mtime, stat_tuples, dirs)
+        return files, dirs
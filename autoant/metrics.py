@@ -0,0 +1,320 @@
+"""
+    Run metrics: counters, gauges and histograms labeled by producer,
+    processor or destination. Exported as a JSON report or as a
+    Prometheus textfile for node_exporter.
+    Collection is off until enable() is called, metrics are then no-ops.
+"""
+import bisect
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'autoant_'
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+DEPTH_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+# name: (type, help, buckets)
+METRICS = {
+    'producer_scanned_total': ('counter', 'Items produced by scans', None),
+    'producer_scan_seconds_total': ('counter', 'Seconds spent producing items', None),
+    'processor_items_total': ('counter', 'Items taken from the queue, by result', None),
+    'processor_bytes_total': ('counter', 'Size of processed items', None),
+    'processor_run_seconds': ('histogram', 'Seconds per item run', SECONDS_BUCKETS),
+    'processor_queue_depth': ('histogram', 'Queued items when a thread takes one', DEPTH_BUCKETS),
+    'processor_threads': ('gauge', 'Threads or concurrent tasks running items', None),
+    'processor_stage_seconds_total': ('counter', 'Seconds the processor threads were running', None),
+    'processor_utilization': ('gauge', 'Share of thread time spent running items', None),
+    'destination_connect_seconds': ('histogram', 'Seconds to open a connection', SECONDS_BUCKETS),
+}
+# waited: put back without using a retry while a circuit trial run is in flight
+ITEM_RESULTS = ('queued', 'processed', 'failed', 'skipped', 'retried', 'waited')
+# estimated from histogram buckets on JSON reports
+QUANTILES = (0.5, 0.95, 0.99)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class NullMetric(object):
+    """
+        Stands for any metric while collection is off
+    """
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(object):
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """
+        Counts observations per bucket upper bound, plus their sum and max
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+            Upper bound of the bucket holding the q quantile, max for the last bucket
+        """
+        rank = q * self.count
+        for bound, count in self.cumulative():
+            if count >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        """
+            (upper bound, observations lower or equal) pairs, last bound is +Inf
+        """
+        total = 0
+        pairs = list()
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+_metric_classes = {'counter': Counter, 'gauge': Gauge}
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.enabled = False
+        self._metrics = dict()
+        self._lock = Lock()
+
+    def get(self, name, **labels):
+        """
+            Returns the metric name with labels, NULL_METRIC if collection is off
+        """
+        if not self.enabled:
+            return NULL_METRIC
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric_type, help_text, buckets = METRICS[name]
+                metric = Histogram(buckets) if metric_type == 'histogram' else _metric_classes[metric_type]()
+                self._metrics[key] = metric
+            return metric
+
+    def _sorted(self):
+        with self._lock:
+            return sorted(self._metrics.items(), key=lambda entry: (entry[0][0], entry[0][1]))
+
+    def report(self):
+        """
+            Metrics nested by their first label, ex:
+            {"processor": {"SRC.CP": {"items_total": {"processed": 4}}}}
+        """
+        report = dict()
+        for (name, labels), metric in self._sorted():
+            if not labels:
+                continue
+            (kind, entity), rest = labels[0], labels[1:]
+            field = name[len(kind) + 1:] if name.startswith(kind + '_') else name
+            if isinstance(metric, Histogram):
+                value = {'count': metric.count, 'sum': round(metric.sum, 6), 'max': round(metric.max, 6),
+                         'mean': round(metric.sum / metric.count, 6) if metric.count else 0}
+                for q in QUANTILES:
+                    value['p{0}'.format(int(q * 100))] = round(metric.quantile(q), 6)
+            else:
+                value = metric.value
+            target = report.setdefault(kind, dict()).setdefault(entity, dict())
+            for label, label_value in rest:
+                target = target.setdefault(field, dict())
+                field = label_value
+            target[field] = value
+        return report
+
+    def prometheus(self):
+        """
+            Returns all metrics in the Prometheus text format
+        """
+        lines = list()
+        last_name = None
+        for (name, labels), metric in self._sorted():
+            full_name = PREFIX + name
+            if name != last_name:
+                metric_type, help_text, buckets = METRICS[name]
+                lines.append("# HELP {0} {1}".format(full_name, help_text))
+                lines.append("# TYPE {0} {1}".format(full_name, metric_type))
+                last_name = name
+            if isinstance(metric, Histogram):
+                for bound, count in metric.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append("{0}_bucket{1} {2}".format(full_name, _labels(labels + (('le', le),)), count))
+                lines.append("{0}_sum{1} {2!r}".format(full_name, _labels(labels), float(metric.sum)))
+                lines.append("{0}_count{1} {2}".format(full_name, _labels(labels), metric.count))
+            else:
+                lines.append("{0}{1} {2!r}".format(full_name, _labels(labels), float(metric.value)))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.report(), indent=2, sort_keys=True, separators=(',', ': ')))
+
+    def write_prometheus(self, path):
+        # node_exporter must never read a partial file
+        _write_atomic(path, self.prometheus())
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fd:
+        fd.write(data)
+    os.rename(tmp_path, path)
+
+
+registry = MetricsRegistry()
+
+
+def enable():
+    registry.enabled = True
+
+
+def get_metric(name, **labels):
+    return registry.get(name, **labels)
+
+
+class StageMetrics(object):
+    """
+        Metrics of one processor, fetched once and updated by all its threads
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = dict((result, get_metric('processor_items_total', processor=name, result=result))
+                          for result in ITEM_RESULTS)
+        self.bytes = get_metric('processor_bytes_total', processor=name)
+        self.run_seconds = get_metric('processor_run_seconds', processor=name)
+        self.queue_depth = get_metric('processor_queue_depth', processor=name)
+        self.threads = get_metric('processor_threads', processor=name)
+        self.stage_seconds = get_metric('processor_stage_seconds_total', processor=name)
+        self.utilization = get_metric('processor_utilization', processor=name)
+        self._started = None
+
+    def start(self, threads):
+        self.threads.set(threads)
+        self._started = _clock()
+
+    def stop(self):
+        if self._started is None:
+            return
+        self.stage_seconds.inc(_clock() - self._started)
+        self._started = None
+        thread_seconds = self.threads.value * self.stage_seconds.value
+        if thread_seconds and isinstance(self.run_seconds, Histogram):
+            self.utilization.set(min(self.run_seconds.sum / thread_seconds, 1.0))
+
+    def took(self, depth):
+        """
+            A thread took an item, depth items were left on the queue
+        """
+        self.items['queued'].inc()
+        self.queue_depth.observe(depth)
+
+    def count(self, result, item=None):
+        self.items[result].inc()
+        if result == 'processed':
+            self.bytes.inc(getattr(item, 'size', 0) or 0)
+
+    def log_summary(self):
+        if not isinstance(self.run_seconds, Histogram):
+            return
+        seconds = self.stage_seconds.value
+        retried = "{0} retried".format(self.items['retried'].value)
+        if self.items['waited'].value:
+            retried += " ({0} waited on a circuit trial)".format(self.items['waited'].value)
+        log.info("{0}: {1} processed, {2} failed, {3} skipped, {4}, {5:.1f} MB at {6:.1f} MB/s, "
+                 "{7:.3f}s mean run, {8:.0%} busy".format(self.name, self.items['processed'].value,
+                                                           self.items['failed'].value,
+                                                           self.items['skipped'].value,
+                                                           retried,
+                                                           self.bytes.value / 1048576.0,
+                                                           self.bytes.value / 1048576.0 / seconds if seconds else 0,
+                                                           self.run_seconds.sum / self.run_seconds.count
+                                                           if self.run_seconds.count else 0,
+                                                           self.utilization.value))
+
+
+def count_scan(producer_name, generator):
+    """
+        Wraps a producer generator function counting items and time spent producing them
+    """
+    def counted():
+        scanned = get_metric('producer_scanned_total', producer=producer_name)
+        scan_seconds = get_metric('producer_scan_seconds_total', producer=producer_name)
+        items = generator()
+        try:
+            while True:
+                t1 = _clock()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    scan_seconds.inc(_clock() - t1)
+                    return
+                scan_seconds.inc(_clock() - t1)
+                scanned.inc()
+                yield item
+        finally:
+            # producers clean up when closed, ex: save their manifest
+            items.close()
+    if not registry.enabled:
+        return generator
+    return counted
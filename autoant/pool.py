@@ -0,0 +1,198 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import Condition, Lock
+from .metrics import get_metric
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHECK_IDLE = 10
+
+_pools = dict()
+# (key, size, check_idle) of processors that wanted other pool settings, warned once
+_pool_conflicts = set()
+_pools_lock = Lock()
+_pools_pid = os.getpid()
+
+
+def destination_name(key):
+    """
+        protocol://user@host:port of a pool key, without its connection settings
+    """
+    return "{0}://{3}@{1}:{2}".format(*key)
+
+
+class SendingReader(object):
+    """
+        File object wrapper, calls on_send before the first read,
+        from then on the server may have got part of the file
+    """
+    def __init__(self, fd, on_send):
+        self.fd = fd
+        self.on_send = on_send
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+    def read(self, size=-1):
+        if self.on_send is not None:
+            self.on_send()
+            self.on_send = None
+        return self.fd.read(size)
+
+
+class ConnectionPool(object):
+    """
+        Connections to one server, shared by every thread of every
+        processor with the same key. Connections are opened on first
+        use, checked before reuse when idle for more than check_idle
+        seconds, and dropped when they fail a check.
+        size caps open connections, 0 is no limit.
+    """
+    def __init__(self, key, open_connection, close_connection, check_connection,
+                 size=0, check_idle=DEFAULT_CHECK_IDLE):
+        self.key = key
+        self.size = size
+        self.check_idle = check_idle
+        self._open_connection = open_connection
+        self._close_connection = close_connection
+        self._check_connection = check_connection
+        # (connection, last release time), last released is reused first
+        self._idle = list()
+        self._count = 0
+        self._cond = Condition()
+        self._connect_seconds = get_metric('destination_connect_seconds', destination=destination_name(key))
+
+    def __repr__(self):
+        return destination_name(self.key)
+
+    def _discard(self, connection):
+        try:
+            self._close_connection(connection)
+        except Exception as e:
+            log.debug("{0}: Close connection error {1}".format(self, e))
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+    def _is_alive(self, connection):
+        try:
+            return self._check_connection(connection)
+        except Exception as e:
+            log.debug("{0}: Connection check error {1}".format(self, e))
+            return False
+
+    def acquire(self, check=False):
+        """
+            Returns an idle connection, checked if idle for more than
+            check_idle seconds or check is set, or a new one
+        """
+        while True:
+            with self._cond:
+                while not self._idle and self.size and self._count >= self.size:
+                    self._cond.wait()
+                if self._idle:
+                    connection, released = self._idle.pop()
+                else:
+                    connection, released = None, None
+                    self._count += 1
+            if connection is None:
+                try:
+                    t1 = time.time()
+                    connection = self._open_connection()
+                    self._connect_seconds.observe(time.time() - t1)
+                    return connection
+                except Exception:
+                    with self._cond:
+                        self._count -= 1
+                        self._cond.notify()
+                    raise
+            if (not check and time.time() - released < self.check_idle) or self._is_alive(connection):
+                return connection
+            log.info("{0}: Dropping broken connection".format(self))
+            self._discard(connection)
+
+    def release(self, connection, broken=False):
+        if broken:
+            return self._discard(connection)
+        with self._cond:
+            self._idle.append((connection, time.time()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, check=False):
+        """
+            Yields a connection, on errors it's checked
+            and only returned to the pool if still alive
+        """
+        connection = self.acquire(check)
+        try:
+            yield connection
+        except Exception:
+            self.release(connection, not self._is_alive(connection))
+            raise
+        self.release(connection)
+
+    def run(self, work, sent):
+        """
+            Returns work(connection). A connection can go stale while idle
+            and only fail on first use: if work fails, the connection is
+            broken and sent() is False, nothing reached the server yet, so
+            it's dropped and work runs once more on a checked or new one.
+        """
+        connection = self.acquire()
+        try:
+            result = work(connection)
+        except Exception as e:
+            broken = not self._is_alive(connection)
+            self.release(connection, broken)
+            if not broken or sent():
+                raise
+            log.info("{0}: Connection lost before sending {1}, trying again".format(self, e))
+        else:
+            self.release(connection)
+            return result
+        with self.connection(check=True) as connection:
+            return work(connection)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, list()
+        for connection, released in idle:
+            self._discard(connection)
+
+
+def get_pool(key, open_connection, close_connection, check_connection, size=0, check_idle=DEFAULT_CHECK_IDLE):
+    """
+        Returns the pool for key (protocol, host, port, user, connection settings...),
+        created with the given arguments on first call.
+    """
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # forked, connections belong to the parent process
+            _pools.clear()
+            _pool_conflicts.clear()
+            _pools_pid = os.getpid()
+        if key not in _pools:
+            _pools[key] = ConnectionPool(key, open_connection, close_connection, check_connection,
+                                         size, check_idle)
+        pool = _pools[key]
+        if (size, check_idle) != (pool.size, pool.check_idle) and (key, size, check_idle) not in _pool_conflicts:
+            _pool_conflicts.add((key, size, check_idle))
+            log.warning("{0}: Pool already open with pool_size {1} and pool_check_idle {2}, "
+                        "not {3} and {4}".format(pool, pool.size, pool.check_idle, size, check_idle))
+        return pool
+
+
+def close_pools():
+    """
+        Closes all idle connections of all pools
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+        _pool_conflicts.clear()
+    for pool in pools:
+        pool.close()
@@ -1,99 +1,275 @@
 from __future__ import unicode_literals
 import io
-import re, os, pickle, shutil, sys
+import re, os, errno, stat, sys, time
 import logging
 import copy
-from threading import Thread
-from Queue import Queue
-from ftplib import FTP, FTP_TLS
-from sys import platform
-from .utilslinux import is_file_open
-from .utils import boolstr, sub_list
-from .providers import BaseProvider, register_processor, register_property, PROP_HIDDEN_PREFIX
-
+from functools import partial
+from threading import Thread, RLock
 try:
-    import paramiko
-except:
-    paramiko = None
-
-try:
-    from smb.SMBConnection import SMBConnection
-except:
-    SMBConnection = None
-
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from ftplib import FTP, FTP_TLS, error_perm, error_reply
+from sys import platform
+from .items import ItemIndex
+from .executors import PoolProcessor, create_pool, close_pool
+from .pool import SendingReader, get_pool, DEFAULT_CHECK_IDLE
+from .dircache import get_dir_cache
+from .fastcopy import copy_file, fsync_dir, FSYNC_POLICIES
+from .checksum import HashingReader, HashingWriter, hash_file, hash_stream, is_algorithm, checksum_algorithm
+from .ratelimit import ThrottledReader, get_bucket, get_host_limit, throttle, DEFAULT_RATE_BURST
+from .retry import RetryScheduler, RetryPump, RetryableError, CircuitOpenError, get_breaker, is_retryable, \
+    DEFAULT_RETRY_DELAY, DEFAULT_RETRY_MAX_DELAY, DEFAULT_BREAKER_COOLDOWN
+from .metrics import StageMetrics
+from .profiling import profile_call, start_stage, stop_stage
+from ._compat import shell_quote
+from .states import get_state_backend, state_backends
+from .utilslinux import get_open_file_index
+from .utils import boolstr, sizestr, lazy_import
+from .providers import BaseProvider, register_processor, register_property
 
 log = logging.getLogger(__name__)
 
 DEFAULT_CONNECT_TIMEOUT = 10
 DEFAULT_CHANNEL_TIMEOUT = 10
 DEFAULT_FTP_PORT = 21
-save_file_extension = 'sav'
+DEFAULT_SSH_PORT = 22
+DEFAULT_SMB_PORT = 139
+DEFAULT_SFTP_BLOCK_SIZE = 32768
+DEFAULT_SFTP_PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+# Suffix of files being uploaded, renamed when complete
+PART_SUFFIX = '.part'
+DEFAULT_JOIN_TIMEOUT = 30
+DEFAULT_OPEN_FILES_TTL = 5
+EXECUTORS = ('thread', 'process')
+# Queued to tell a ProcessThread to stop
+STOP_ITEM = object()
+# Server side checksum commands
+FTP_CHECKSUM_COMMANDS = {'md5': 'XMD5', 'sha1': 'XSHA1', 'sha256': 'XSHA256', 'sha512': 'XSHA512'}
+SSH_CHECKSUM_COMMANDS = {'md5': 'md5sum', 'sha1': 'sha1sum', 'sha224': 'sha224sum', 'sha256': 'sha256sum',
+                         'sha384': 'sha384sum', 'sha512': 'sha512sum'}
+# pool keys of servers without server side checksums, their files are read back
+no_server_checksum = set()
+
+
+def find_duplicate(processor, p_state, item):
+    """
+        On dedup processors, returns the processed item with the same content as item
+    """
+    if not processor.dedup:
+        return None
+    try:
+        return p_state.digests.get(processor.item_digest(item))
+    except Exception as e:
+        log.error("{0}: Checksum error {1} {2}".format(processor.name, item, e))
+        return None
+
 
+def run_item(processor, item, metrics):
+    """
+        Runs item unless the processor destination circuit is open,
+        returns (success, error)
+    """
+    breaker = processor.breaker
+    if breaker:
+        try:
+            breaker.check()
+        except CircuitOpenError as e:
+            return False, e
+    processor.wait_rate('files')
+    t1 = time.time()
+    success = processor.run(item)
+    metrics.run_seconds.observe(time.time() - t1)
+    error = None if success else processor.last_error
+    if breaker:
+        breaker.record(success, error)
+    return success, error
+
+
+def retry_failed(processor, p_state, item, error):
+    """
+        Schedules a failed item again if error is retryable,
+        returns True if scheduled, the item is not done yet
+    """
+    if isinstance(error, CircuitOpenError):
+        # not run, waits for the circuit without using a retry while a trial is in flight
+        if p_state.retries.schedule(item, error.wait, not error.trial):
+            p_state.metrics.count('waited' if error.trial else 'retried')
+            return True
+        log.error("{0}: Not run {1} {2}".format(processor.name, item, error))
+        return False
+    if is_retryable(error) and p_state.retries.schedule(item):
+        p_state.metrics.count('retried')
+        return True
+    return False
 
-def assert_file_locked(file_item):
-    if platform == 'linux2':
-        if is_file_open(file_item.full_path):
-            raise Exception("File is open")
+
+def assert_file_locked(file_item, open_files=None):
+    if platform.startswith('linux'):
+        if open_files is None:
+            open_files = get_open_file_index()
+        if open_files.is_open(file_item.full_path):
+            raise RetryableError("File is open")
 
 
 class ProcessThread(Thread):
     """
-        Process thread
+        Process thread, blocks on the state queue
+        until it gets the STOP_ITEM sentinel.
     """
-    def __init__(self, thread_id, processor, p_state):
-        super(ProcessThread, self).__init__()
+    def __init__(self, thread_id, processor, p_state, next_state=None, next_depends=False):
+        super(ProcessThread, self).__init__(name="{0}.{1}".format(processor.name, thread_id))
         self.thread_id = thread_id
         self.processor = processor
         self.p_state = p_state
-        self.processor.pre_process()
+        self.next_state = next_state
+        self.next_depends = next_depends
 
     def run(self):
+        profile_call(self.processor.name, self.name, self._run)
+
+    def _run(self):
+        try:
+            self.processor.pre_process()
+        except Exception as e:
+            log.error("{0}: Pre process error {1}".format(self.processor.name, e))
+            # the queue is still joined, its items fail
+            return self._consume(self.fail)
+        try:
+            self._consume(self.process)
+        finally:
+            self.processor.post_process()
+
+    def _consume(self, process):
         while True:
-            if not self.p_state.queue.empty():
-                item = self.p_state.queue.get()
-                if item not in self.p_state.processed:
-                    self.processor.pre_run(item)
-                    success = self.processor.run(item)
-                    if not success:
-                        self.p_state.process_fails.append(item)
-                    else:
-                        self.p_state.processed.append(item)
-                    self.processor.post_run(item)
+            item = self.p_state.queue.get()
+            try:
+                if item is STOP_ITEM:
+                    break
+                self.p_state.metrics.took(self.p_state.queue.qsize())
+                process(item)
+            finally:
                 self.p_state.queue.task_done()
 
-    def __del__(self):
-        self.processor.post_process()
+    def fail(self, item):
+        """
+            Fails item without running it, ex: the processor could not start
+        """
+        if item not in self.p_state.processed:
+            self.p_state.metrics.count('failed', item)
+            self.p_state.add_fail(item)
+        else:
+            self.p_state.metrics.count('skipped')
+        self.forward(item, False)
+
+    def process(self, item):
+        success = True
+        metrics = self.p_state.metrics
+        if item not in self.p_state.processed:
+            self.processor.pre_run(item)
+            duplicate = find_duplicate(self.processor, self.p_state, item)
+            if duplicate is not None:
+                log.info("{0}: Skip {1} same content has {2}".format(self.processor.name, item, duplicate))
+                metrics.count('skipped')
+            else:
+                success, error = run_item(self.processor, item, metrics)
+                if not success and retry_failed(self.processor, self.p_state, item, error):
+                    # forwarded once its retries are done
+                    self.processor.post_run(item)
+                    return
+                self.p_state.retries.done(item)
+                metrics.count('processed' if success else 'failed', item)
+            if not success:
+                self.p_state.add_fail(item)
+            else:
+                self.p_state.add_processed(item)
+            self.processor.post_run(item)
+        else:
+            metrics.count('skipped')
+        self.forward(item, success)
 
+    def forward(self, item, success):
+        """
+            On pipelined sequences passes the item to the next
+            stage queue, dependent stages only get successes.
+        """
+        if self.next_state is not None and (success or not self.next_depends):
+            self.next_state.queue.put(item)
 
 
 class ProcessState(object):
     """
         Keeps process data between threads.
-        Holds Queue with work, processed items and failed items
+        Holds Queue with work, processed items and failed items.
+        Processed and failed items are indexed by item key,
+        processed items are loaded from the state backend on first use.
     """
-    def __init__(self, name):
+    def __init__(self, name, backend=None, queue_size=0, retries=None):
         self.name = name
-        self.processed = list()
-        self.process_fails = list()
-        self.queue = Queue(0)
+        self.retries = retries or RetryScheduler(name)
+        self.metrics = StageMetrics(name)
+        self.backend = None
+        if backend:
+            self.backend = get_state_backend(backend)(name)
+        self._processed = None
+        self._digests = None
+        self.process_fails = ItemIndex()
+        self.queue = Queue(queue_size)
+        self._lock = RLock()
 
-    def _get_filename(self):
-        return self.name + '.' + save_file_extension
+    @property
+    def processed(self):
+        if self._processed is None:
+            self.load()
+        return self._processed
+
+    @property
+    def digests(self):
+        """
+            Processed items indexed by content checksum
+        """
+        with self._lock:
+            if self._digests is None:
+                self._digests = dict((item.checksum, item) for item in self.processed
+                                     if getattr(item, 'checksum', None))
+            return self._digests
+
+    def add_processed(self, item):
+        with self._lock:
+            self.processed.append(item)
+            if self._digests is not None and getattr(item, 'checksum', None):
+                self._digests[item.checksum] = item
+            if self.backend:
+                try:
+                    self.backend.record(item)
+                except Exception as e:
+                    log.error("{0}: Record state error {1}".format(self.name, e))
+
+    def add_fail(self, item):
+        with self._lock:
+            self.process_fails.append(item)
 
     def save(self):
-        try:
-            with open(self._get_filename(), 'wb') as f:
-                pickle.dump(self.processed, f)
-        except Exception as e:
-            log.error("{0}: Save state file error {1}".format(self.name, e))
+        if not self.backend:
+            return
+        with self._lock:
+            try:
+                self.backend.save(self.processed)
+            except Exception as e:
+                log.error("{0}: Save state file error {1}".format(self.name, e))
 
     def load(self):
-        try:
-            if os.path.isfile(self._get_filename()):
-                with open(self._get_filename(), 'rb') as f:
-                    self.processed = pickle.load(f)
-        except Exception as e:
-            log.error("{0}: Load state file error {1}".format(self.name, e))
+        with self._lock:
+            if self._processed is not None:
+                return
+            processed = ItemIndex()
+            if self.backend:
+                try:
+                    processed = ItemIndex(self.backend.load())
+                except Exception as e:
+                    log.error("{0}: Load state file error {1}".format(self.name, e))
+            # only published when complete, threads check it without the lock
+            self._processed = processed
 
 
 class ProcessSequence(object):
@@ -102,25 +278,115 @@ class ProcessSequence(object):
         from a consumer.
     """
     sequence = None
-    threads = []
 
     def __init__(self):
         self.sequence = []
+        self._pools = dict()
+        # daemon mode keeps states, with their processed items, and async connections between runs
+        self.keep_warm = False
+        self._states = dict()
+        self._async_runner = None
+        # states of the processors items are being produced for
+        self.running_states = list()
 
     def add_process(self, processor):
         self.sequence.append(processor)
 
-    def run(self, generator):
-        for process, i in zip(self.sequence, range(0, len(self.sequence))):
-            process_state = ProcessState(process.name)
-            if process.state:
-                process_state.load()
-            for thread_id in range(0, process.threads):
+    def start_threads(self, process, process_state, next_state=None, next_depends=False):
+        threads = []
+        pool = None
+        if process.executor == 'process':
+            pool = self._pools[process.name] = create_pool(process)
+        process_state.metrics.start(process.threads)
+        start_stage(process.name)
+        for thread_id in range(0, process.threads):
+            if pool:
+                process_c = PoolProcessor(process, pool)
+            else:
                 process_c = copy.deepcopy(process)
-                thread = ProcessThread(thread_id, process_c, process_state)
-                thread.setDaemon(True)
-                thread.start()
-                self.threads.append(thread)
+            thread = ProcessThread(thread_id, process_c, process_state, next_state, next_depends)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def stop_threads(self, process, process_state, threads):
+        """
+            Sends one stop sentinel per thread, and waits
+            at most join_timeout seconds for all of them.
+        """
+        for thread in threads:
+            process_state.queue.put(STOP_ITEM)
+        deadline = time.time() + process.join_timeout
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+            if thread.is_alive():
+                log.warning("{0}: Thread {1} did not stop in {2}s".format(process.name,
+                                                                          thread.name,
+                                                                          process.join_timeout))
+        pool = self._pools.pop(process.name, None)
+        if pool:
+            close_pool(pool, max(deadline - time.time(), 0))
+        process_state.metrics.stop()
+        process_state.metrics.log_summary()
+        stop_stage(process.name, process_state)
+
+    def get_state(self, process, queue_size=0):
+        process_state = self._states.get(process.name)
+        if process_state is not None:
+            # failures only decide dependent processors of the same run
+            process_state.process_fails = ItemIndex()
+            return process_state
+        retries = RetryScheduler(process.name, process.retries, process.retry_delay, process.retry_max_delay)
+        process_state = ProcessState(process.name, process.state_backend if process.state else None, queue_size,
+                                     retries)
+        if self.keep_warm and process.state:
+            self._states[process.name] = process_state
+        return process_state
+
+    def is_pending(self, item):
+        """
+            True if a processor items are being produced for has not processed item yet
+        """
+        return not self.running_states or any(item not in state.processed for state in self.running_states)
+
+    def start_retry_pump(self, processes, states):
+        """
+            Returns a started RetryPump of the states of processes
+            with retries, None if none has them
+        """
+        targets = [(state.retries, state.queue) for process, state in zip(processes, states) if process.retries]
+        if not targets:
+            return None
+        pump = RetryPump(processes[0].name, targets)
+        pump.start()
+        return pump
+
+    def drain(self, process_state):
+        """
+            Waits for the queue, then puts retries back
+            on it when due until none are pending.
+        """
+        process_state.queue.join()
+        while process_state.retries.pending:
+            for item in process_state.retries.wait_due():
+                process_state.queue.put(item)
+            process_state.queue.join()
+
+    def run(self, generator, pipeline=False, queue_size=0, engine='thread'):
+        if engine == 'async':
+            from .aioengine import AsyncSequenceRunner
+            runner = self._async_runner or AsyncSequenceRunner(self, queue_size, self.keep_warm)
+            if self.keep_warm:
+                self._async_runner = runner
+            return runner.run(generator)
+        if pipeline:
+            return self.run_pipeline(generator, queue_size)
+        for process, i in zip(self.sequence, range(0, len(self.sequence))):
+            process_state = self.get_state(process)
+            self.running_states = [process_state]
+            threads = self.start_threads(process, process_state)
+            pump = self.start_retry_pump([process], [process_state])
             for item in generator():
                 if process.depends:
                     # This process depends on the previous, will only process successful items
@@ -128,26 +394,84 @@ class ProcessSequence(object):
                         process_state.queue.put(item)
                 else:
                     process_state.queue.put(item)
-            process_state.queue.join()
-            if process.state:
-                process_state.save()
+            if pump:
+                pump.stop()
+            self.drain(process_state)
+            self.stop_threads(process, process_state, threads)
+            process_state.save()
             # keep previous state for process dependency
             previous_state = process_state
 
+    def run_pipeline(self, generator, queue_size=0):
+        """
+            Scans once and runs all processors concurrently,
+            items flow through bounded queues from one stage
+            to the next as soon as they are processed.
+        """
+        states = [self.get_state(process, queue_size) for process in self.sequence]
+        self.running_states = states
+        stages = list()
+        for i, process in enumerate(self.sequence):
+            next_state, next_depends = None, False
+            if i + 1 < len(self.sequence):
+                next_state, next_depends = states[i + 1], self.sequence[i + 1].depends
+            stages.append(self.start_threads(process, states[i], next_state, next_depends))
+        pump = self.start_retry_pump(self.sequence, states)
+        for item in generator():
+            states[0].queue.put(item)
+        if pump:
+            pump.stop()
+        # stop stages in order, a stage is drained only after the previous one stopped feeding it
+        for process, process_state, threads in zip(self.sequence, states, stages):
+            self.drain(process_state)
+            self.stop_threads(process, process_state, threads)
+            process_state.save()
+
+    def close(self):
+        """
+            Closes what keep_warm kept open
+        """
+        if self._async_runner is not None:
+            self._async_runner.close()
+            self._async_runner = None
+
     def list(self):
         for item in self.sequence:
             item.list()
 
 
 @register_property('state', 'Keeps processing state, will not repeat items', boolstr, False, "True")
+@register_property('state_backend', 'How state is kept {0}'.format(sorted(state_backends.keys())), str, False, "pickle")
 @register_property('depends', 'If True will only process previous processing successes', boolstr, False, "False")
 @register_property('threads', 'Number of threads the process will use', int, False, "1")
+@register_property('join_timeout', 'Seconds to wait for threads to stop', float, False, DEFAULT_JOIN_TIMEOUT)
+@register_property('executor', 'Where items are run {0}'.format(EXECUTORS), str, False, "thread")
+@register_property('open_files_ttl', 'Seconds between open files checks', float, False, DEFAULT_OPEN_FILES_TTL)
+@register_property('open_files_uid', 'Only check files open by this uid, -1 is any', int, False, "-1")
+@register_property('open_files_procs', 'Only check files open by these comma separated process names', str, False, "")
+@register_property('checksum', 'Hash algorithm of content checksums kept in state, ex: sha256', str, False, "")
+@register_property('checksum_verify', 'Checks the destination checksum', boolstr, False, "False")
+@register_property('dedup', 'Skips files with the same checksum has a processed one', boolstr, False, "False")
+@register_property('rate_limit', 'Max bytes per second written by the processor, ex: 10M, 0 is unlimited',
+                   sizestr, False, "0")
+@register_property('files_rate_limit', 'Max files per second run by the processor, 0 is unlimited',
+                   float, False, "0")
+@register_property('rate_burst', 'Seconds of rate limit that can be used at once after idle', float, False,
+                   DEFAULT_RATE_BURST)
+@register_property('retries', 'Times a failed item is retried on transient errors', int, False, "0")
+@register_property('retry_delay', 'Seconds before the first retry, doubles on each one', float, False,
+                   DEFAULT_RETRY_DELAY)
+@register_property('retry_max_delay', 'Max seconds between retries', float, False, DEFAULT_RETRY_MAX_DELAY)
 class BaseProcessor(BaseProvider):
     """
         This is the base class of all processors
     """
     _prod_name = None
     _name = None
+    # error of the last failed run
+    last_error = None
+    # the file of the current run was read to be sent, see open_reader
+    _sent = False
 
     def __init__(self, **kwargs):
         BaseProvider.__init__(self, **kwargs)
@@ -157,6 +481,17 @@ class BaseProcessor(BaseProvider):
         except:
             log.critical("Missing unique name process identifier")
             exit(1)
+        if self.executor not in EXECUTORS:
+            log.critical("{0}: Unknown executor {1}, use one of {2}".format(self.name, self.executor, EXECUTORS))
+            exit(1)
+        if self.checksum and not is_algorithm(self.checksum):
+            log.critical("{0}: Unknown checksum algorithm {1}".format(self.name, self.checksum))
+            exit(1)
+        if (self.checksum_verify or self.dedup) and not self.checksum:
+            log.critical("{0}: checksum_verify and dedup need a checksum algorithm".format(self.name))
+            exit(1)
+        # config kept to build the processor again on other processes
+        self.kwargs = dict(kwargs)
         log.debug("Config Processor {0} with {1}".format(self.__class__.__name__, kwargs))
 
 
@@ -172,13 +507,94 @@ class BaseProcessor(BaseProvider):
     def process_name(self):
         return self._name
 
+    @property
+    def open_files(self):
+        """
+            Open files index shared by processors with the same open_files properties
+        """
+        uid = self.open_files_uid if self.open_files_uid >= 0 else None
+        names = [name.strip() for name in self.open_files_procs.split(',') if name.strip()]
+        return get_open_file_index(self.open_files_ttl, uid, names)
+
+    @property
+    def dir_cache_key(self):
+        return ('local',)
+
+    @property
+    def dir_cache(self):
+        """
+            Directories known to exist on the destination, shared by processors with the same dir_cache_key
+        """
+        return get_dir_cache(self.dir_cache_key)
+
+    def item_digest(self, item):
+        """
+            Returns the item checksum, reads the file if not known for this algorithm
+        """
+        if checksum_algorithm(item.checksum) != self.checksum:
+            item.checksum = hash_file(item.full_path, self.checksum)
+        return item.checksum
+
+    def open_reader(self, fd, offset=0, hashed=True):
+        """
+            Returns fd at offset, hashing all data read if checksum is set
+            and hashed, and waiting on the bytes rate limits. The first read
+            marks the file sent, see with_connection.
+        """
+        if hashed and self.checksum:
+            fd = HashingReader(fd, self.checksum)
+            fd.read_through(offset)
+        else:
+            fd.seek(offset)
+        buckets = self.rate_buckets('bytes')
+        if buckets:
+            fd = ThrottledReader(fd, buckets)
+        return SendingReader(fd, self._mark_sent)
+
+    def _mark_sent(self):
+        self._sent = True
+
+    def _was_sent(self):
+        return self._sent
+
+    def rate_buckets(self, unit):
+        """
+            Token buckets limiting this processor, unit is 'bytes' or 'files'
+        """
+        rate = self.rate_limit if unit == 'bytes' else self.files_rate_limit
+        if not rate:
+            return []
+        return [get_bucket(('processor', self.name, unit), rate, rate * self.rate_burst)]
+
+    def wait_rate(self, unit, amount=1):
+        throttle(self.rate_buckets(unit), amount)
+
+    @property
+    def breaker(self):
+        """
+            Circuit breaker of the destination, None if it has none
+        """
+        return None
+
+    @property
+    def copy_throttle(self):
+        """
+            Throttle of local copies, None if bytes are not limited
+        """
+        if not self.rate_buckets('bytes'):
+            return None
+        return partial(self.wait_rate, 'bytes')
+
+    def verify_checksum(self, item, checksum):
+        if item.checksum != checksum:
+            raise IOError("Checksum mismatch, destination {0} local {1}".format(checksum, item.checksum))
+
     def list(self):
         print("Process ID {0}".format(self.name))
         print("--------------------------")
         if self.state:
-            self.load()
-        for item in self.processed:
-            print("{0}".format(item))
+            for item in ProcessState(self.name, self.state_backend).processed:
+                print("{0}".format(item))
 
     def pre_process(self):
         log.debug("{0}: Begin Pre Process".format(self.name))
@@ -198,30 +614,107 @@ class BaseProcessor(BaseProvider):
 
     def run(self, item):
         log.debug("{0}: Begin Processing {1}".format(self.name, item))
+        self.last_error = None
         return True
 
     def __repr__(self):
         return self.name
 
 
+@register_property('host_limit', 'Max concurrent transfers to the remote host, 0 is unlimited', int, False, "0")
+@register_property('host_rate_limit', 'Max bytes per second written to the remote host, ex: 10M, 0 is unlimited',
+                   sizestr, False, "0")
+@register_property('host_files_rate_limit', 'Max files per second sent to the remote host, 0 is unlimited',
+                   float, False, "0")
+@register_property('pool_size', 'Max connections open to the remote host, 0 is unlimited', int, False, "0")
+@register_property('pool_check_idle', 'Seconds idle before a pooled connection is checked', float, False,
+                   DEFAULT_CHECK_IDLE)
+@register_property('dir_cache_seed', 'Levels of remote_dir listed to seed the known directories', int, False, "0")
+@register_property('breaker_threshold', 'Consecutive transient failures stopping runs to the remote host, 0 is never',
+                   int, False, "0")
+@register_property('breaker_cooldown', 'Seconds runs to the remote host are stopped', float, False,
+                   DEFAULT_BREAKER_COOLDOWN)
 class BaseProcessorRemoteCP(BaseProcessor):
+    """
+        Base of processors that put files on a remote host.
+        Connections come from a pool shared by all processors
+        with the same pool_key and connection_properties, and are opened on first use.
+    """
+    protocol = None
+    # properties connections are opened with, processors that differ on them don't share connections
+    connection_properties = ('password', 'timeout', 'debug_level')
 
-    def pre_process(self):
-        super(BaseProcessorRemoteCP, self).pre_process()
-        return self.connect()
+    @property
+    def pool_key(self):
+        """
+            The destination, (protocol, host, port, user)
+        """
+        return (self.protocol, self.remote_host, self.remote_port, self.username)
 
-    def post_process(self):
-        super(BaseProcessorRemoteCP, self).post_process()
-        return self.disconnect()
+    @property
+    def connection_key(self):
+        return self.pool_key + tuple(getattr(self, name) for name in self.connection_properties)
+
+    @property
+    def pool(self):
+        return get_pool(self.connection_key, self.open_connection, self.close_connection, self.check_connection,
+                        self.pool_size, self.pool_check_idle)
+
+    def with_connection(self, work):
+        """
+            Returns work(connection) on a pooled connection, after taking a host_limit
+            slot if set. A stale pooled connection failing before the file is read to
+            be sent is replaced, see ConnectionPool.run.
+        """
+        self._sent = False
+        if not self.host_limit:
+            return self.pool.run(work, self._was_sent)
+        with get_host_limit(self.remote_host, self.host_limit):
+            return self.pool.run(work, self._was_sent)
+
+    @property
+    def breaker(self):
+        if not self.breaker_threshold:
+            return None
+        return get_breaker(self.pool_key, self.breaker_threshold, self.breaker_cooldown)
 
-    def connect(self):
-        pass
+    def rate_buckets(self, unit):
+        buckets = super(BaseProcessorRemoteCP, self).rate_buckets(unit)
+        rate = self.host_rate_limit if unit == 'bytes' else self.host_files_rate_limit
+        if rate:
+            buckets.append(get_bucket(('host', self.remote_host, unit), rate, rate * self.rate_burst))
+        return buckets
 
-    def disconnect(self):
-        pass
+    def open_connection(self):
+        raise NotImplementedError
 
-    def __del__(self):
-        pass
+    def close_connection(self, connection):
+        raise NotImplementedError
+
+    def check_connection(self, connection):
+        return True
+
+    @property
+    def dir_cache_key(self):
+        return self.pool_key + (self.remote_dir,)
+
+    def make_dir(self, connection, path):
+        raise NotImplementedError
+
+    def list_dirs(self, connection, path):
+        raise NotImplementedError
+
+    def resume_path(self, file_item, remote_path):
+        """
+            Temporary name of a resumable upload, changes with the local file size and mtime
+            so a partial upload of another version is never resumed
+        """
+        return "{0}.{1}-{2}{3}".format(remote_path, file_item.size, int(file_item.mtime), self.part_suffix)
+
+    def create_path(self, connection, remotepath):
+        if self.dir_cache_seed:
+            self.dir_cache.seed(self.remote_dir, partial(self.list_dirs, connection), self.dir_cache_seed)
+        self.dir_cache.create_path(remotepath, partial(self.make_dir, connection))
 
 @register_property('stdout', 'Where will output go, blank is STDOUT', str, False, "")
 @register_processor('echo', 'Writes produced items, default stdout')
@@ -237,6 +730,7 @@ class ProcessorEcho(BaseProcessor):
             self.fd.write("{0}\n".format(item.__repr__()))
             return True
         except Exception as e:
+            self.last_error = e
             log.error("{0}: Echo file error {1} :{2}".format(self.name, item, e))
             return False
         log.debug("End Processing {0}".format(item))
@@ -254,8 +748,9 @@ class ProcessorEcho(BaseProcessor):
 
     def post_process(self):
         super(ProcessorEcho, self).post_process()
-        if self.fd != sys.stdout:
-            return self.fd.close()
+        if self.fd is not None and self.fd != sys.stdout:
+            self.fd.close()
+            self.fd = None
 
 @register_property('rule_origin', 'Regex origin for sub rule', str, True, "")
 @register_property('rule_destination', 'Regex destination for sub rule', str, True, "")
@@ -273,6 +768,7 @@ class ProcessorRename(BaseProcessor):
             os.rename(file_item.full_path, new_full_path)
             log.info("{0}: Renamed file {1}".format(self.name, file_item))
         except Exception as e:
+            self.last_error = e
             log.error("{0}: Renamed file error file {1} :{2}".format(self.name,
                                                                        file_item, e))
             return False
@@ -281,31 +777,54 @@ class ProcessorRename(BaseProcessor):
 
 
 @register_property('dest_dir', 'Destination directory', str, True, "")
+@register_property('fsync', 'When moved files are synced to disk {0}'.format(FSYNC_POLICIES), str, False, "never")
 @register_processor('move', 'Move local files')
 class ProcessorMove(BaseProcessor):
     def __init__(self, **kwargs):
         super(ProcessorMove, self).__init__(**kwargs)
+        if self.fsync not in FSYNC_POLICIES:
+            log.critical("{0}: Unknown fsync {1}, use one of {2}".format(self.name, self.fsync, FSYNC_POLICIES))
+            exit(1)
+
+    def make_dir(self, path):
+        try:
+            os.mkdir(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
 
     def create_path(self, remotepath):
-        parts = remotepath.split('/')
-        for n in range(2, len(parts)):
-            path = '/'.join(parts[:n])
-            try:
-                os.mkdir(path)
-            except:
-                pass
+        self.dir_cache.create_path(remotepath, self.make_dir)
 
     def run(self, file_item):
-        print file_item
         super(ProcessorMove, self).run(file_item)
         try:
-            assert_file_locked(file_item)
+            assert_file_locked(file_item, self.open_files)
             rel_path = file_item.get_relative_path()
             dest_path = self.dest_dir + rel_path
             self.create_path(dest_path)
-            shutil.move(file_item.full_path, dest_path)
-            log.info("{0}: Moved file {1}".format(self.name, file_item))
+            dest_file = dest_path + file_item.name
+            if os.path.exists(dest_file):
+                raise Exception("Destination path '{0}' already exists".format(dest_file))
+            if self.checksum:
+                self.item_digest(file_item)
+            try:
+                os.rename(file_item.full_path, dest_file)
+                method = 'rename'
+                if self.fsync == 'dir':
+                    fsync_dir(dest_file)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # other filesystem, copy then remove the source
+                method = copy_file(file_item.full_path, dest_file, True, self.fsync, self.copy_throttle)
+                if self.checksum_verify:
+                    self.verify_checksum(file_item, hash_file(dest_file, self.checksum))
+                os.unlink(file_item.full_path)
+            log.info("{0}: Moved file {1} with {2}".format(self.name, file_item, method))
         except Exception as e:
+            self.last_error = e
+            self.dir_cache.invalidate(self.dest_dir + file_item.get_relative_path())
             log.error("{0}: Moved file error file {1} :{2}".format(self.name,
                                                                        file_item, e))
             return False
@@ -314,33 +833,47 @@ class ProcessorMove(BaseProcessor):
 
 
 @register_property('dest_dir', 'Destination directory', str, True, "")
+@register_property('preserve_metadata', 'Copies file mode and times', boolstr, False, "False")
+@register_property('fsync', 'When copied files are synced to disk {0}'.format(FSYNC_POLICIES), str, False, "never")
 @register_processor('cp', 'Copies local files')
 class ProcessorCopy(BaseProcessor):
     def __init__(self, **kwargs):
         super(ProcessorCopy, self).__init__(**kwargs)
+        if self.fsync not in FSYNC_POLICIES:
+            log.critical("{0}: Unknown fsync {1}, use one of {2}".format(self.name, self.fsync, FSYNC_POLICIES))
+            exit(1)
 
     def __repr__(self):
         return "{0}".format(self.dest_dir)
 
+    def make_dir(self, path):
+        try:
+            os.mkdir(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
     def create_path(self, remotepath):
-        parts = remotepath.split('/')
-        for n in range(2, len(parts)):
-            path = '/'.join(parts[:n])
-            try:
-                os.mkdir(path)
-            except:
-                pass
+        self.dir_cache.create_path(remotepath, self.make_dir)
 
     def run(self, file_item):
         super(ProcessorCopy, self).run(file_item)
         try:
-            assert_file_locked(file_item)
+            assert_file_locked(file_item, self.open_files)
             rel_path = file_item.get_relative_path()
             self.create_path(self.dest_dir + rel_path)
             destination_path = self.dest_dir + rel_path + file_item.name
-            shutil.copyfile(file_item.full_path, destination_path)
-            log.info("{0}: Copy file {1}".format(self.name, file_item))
+            method = copy_file(file_item.full_path, destination_path, self.preserve_metadata, self.fsync,
+                               self.copy_throttle)
+            if self.checksum:
+                # the kernel copied it, the source is read from the page cache
+                self.item_digest(file_item)
+                if self.checksum_verify:
+                    self.verify_checksum(file_item, hash_file(destination_path, self.checksum))
+            log.info("{0}: Copy file {1} with {2}".format(self.name, file_item, method))
         except Exception as e:
+            self.last_error = e
+            self.dir_cache.invalidate(self.dest_dir + file_item.get_relative_path())
             log.error("{0}: Copy file error {1} :{2}".format(self.name,
                                                                        file_item, e))
             return False
@@ -349,6 +882,7 @@ class ProcessorCopy(BaseProcessor):
 
 
 @register_property('remote_host', 'The remote hostname or IP', str, True, "")
+@register_property('remote_port', 'The remote SMB Port.', int, False, DEFAULT_SMB_PORT)
 @register_property('remote_name', 'The remote host SMB Name.', str, True, "")
 @register_property('local_name', 'The local host SMB Name', str, True, "")
 @register_property('remote_dir', 'The remote directory', str, True, "")
@@ -358,57 +892,75 @@ class ProcessorCopy(BaseProcessor):
 @register_property('timeout', 'The connection timeout in seconds', float, False, DEFAULT_CONNECT_TIMEOUT)
 @register_processor('smb', 'Copies files using SMB')
 class ProcessorSMB(BaseProcessorRemoteCP):
-    smb_conn = None
+    protocol = 'smb'
+    connection_properties = BaseProcessorRemoteCP.connection_properties + ('local_name', 'remote_name')
 
     def __init__(self, **kwargs):
         super(ProcessorSMB, self).__init__(**kwargs)
-        if not SMBConnection:
+        # imported by the first smb processor, not by every run
+        if not lazy_import('smb.SMBConnection'):
             log.error("No pySMB package please install")
 
     def __repr__(self):
         return "{0}@{1}:{2}".format(self.username, self.remote_host, self.remote_dir)
 
 
-    def connect(self):
+    def open_connection(self):
         try:
-            self.smb_conn = SMBConnection(self.username, self.password, self.local_name, self.remote_name)
-            print self.remote_host
-            self.smb_conn.connect(self.remote_host)
+            SMBConnection = lazy_import('smb.SMBConnection', 'SMBConnection')
+            smb_conn = SMBConnection(self.username, self.password, self.local_name, self.remote_name)
+            smb_conn.connect(self.remote_host, self.remote_port, timeout=self.timeout)
         except Exception as e:
             log.error("{0}: Connect error to {1} {2}".format(self.name, self.remote_host, e))
-            return False
+            raise
         log.info("{0}: SMB Connected to {1} with {2}".format(self.name, self.remote_host, self.username))
+        return smb_conn
+
+    def close_connection(self, smb_conn):
+        smb_conn.close()
+        log.info("{0}: SMB Disconnected from {1} with {2}".format(self.name, self.remote_host, self.username))
+
+    def check_connection(self, smb_conn):
+        smb_conn.echo(b'autoant', timeout=self.timeout)
         return True
 
-    def disconnect(self):
+    def make_dir(self, smb_conn, path):
         try:
-            self.smb_conn.close()
-        except Exception as e:
-            log.error("{0}: Disconnect error to {1} {2}".format(self.name, self.remote_host, e))
-            return False
-        log.info("{0}: SMB Disconnected from {1} with {2}".format(self.name, self.remote_host, self.username))
+            smb_conn.createDirectory(self.remote_dir, path)
+        except:
+            pass
 
-    def create_path(self, remotepath):
-        parts = remotepath.split('/')
-        for n in range(2, len(parts)):
-            path = '/'.join(parts[:n])
-            try:
-                self.smb_conn.createDirectory(self.remote_dir, path)
-            except:
-                pass
+    def remote_checksum(self, smb_conn, path):
+        writer = HashingWriter(self.checksum)
+        smb_conn.retrieveFile(self.remote_dir, path, writer)
+        return writer.checksum
+
+    def list_dirs(self, smb_conn, path):
+        return [shared_file.filename for shared_file in smb_conn.listPath(self.remote_dir, path)
+                if shared_file.isDirectory and shared_file.filename not in ('.', '..')]
 
     def run(self, file_item):
         super(ProcessorSMB, self).run(file_item)
         try:
-            assert_file_locked(file_item)
+            assert_file_locked(file_item, self.open_files)
             rel_path = file_item.get_relative_path()
             remote_path = self.remote_dir + rel_path + file_item.name
-            self.create_path(remote_path)
-            fd = open(file_item.full_path, 'r')
-            self.smb_conn.storeFile(self.remote_dir, remote_path, fd)
-            fd.close()
+
+            def put(smb_conn):
+                self.create_path(smb_conn, remote_path)
+                fd = open(file_item.full_path, 'rb')
+                reader = self.open_reader(fd)
+                smb_conn.storeFile(self.remote_dir, remote_path, reader)
+                fd.close()
+                if self.checksum:
+                    file_item.checksum = reader.checksum
+                if self.checksum_verify:
+                    self.verify_checksum(file_item, self.remote_checksum(smb_conn, remote_path))
+            self.with_connection(put)
             log.info("{0}: SMB Put file {1}".format(self.name, file_item))
         except Exception as e:
+            self.last_error = e
+            self.dir_cache.invalidate(self.remote_dir + file_item.get_relative_path())
             log.error("{0}: SMB Put error to {1} file {2} :{3}".format(self.name,
                                                                        self.remote_host,
                                                                        file_item, e))
@@ -427,9 +979,10 @@ class ProcessorSMB(BaseProcessorRemoteCP):
 @register_property('key_filename', 'Filename of key file for auth.', str, False, None)
 @register_property('debug_level', 'The debug level 0,1,2', int, False, "0")
 @register_property('timeout', 'The connection timeout in seconds', float, False, DEFAULT_CONNECT_TIMEOUT)
+@register_property('resume', 'Uploads to a temporary name, resuming partial uploads', boolstr, False, "False")
+@register_property('part_suffix', 'Suffix of resumable uploads temporary name', str, False, PART_SUFFIX)
 @register_processor('ftp', 'Copies files using FTP')
 class ProcessorFTP(BaseProcessorRemoteCP):
-    ftp = None
 
     def __init__(self, **kwargs):
         super(ProcessorFTP, self).__init__(**kwargs)
@@ -437,56 +990,137 @@ class ProcessorFTP(BaseProcessorRemoteCP):
     def __repr__(self):
         return "{0}@{1}:{2}".format(self.username, self.remote_host, self.remote_dir)
 
-    def connect(self):
+    @property
+    def protocol(self):
+        return 'ftps' if self.is_ssl_auth or self.is_ssl_data else 'ftp'
+
+    def open_connection(self):
         try:
             if self.is_ssl_auth or self.is_ssl_data:
                 log.debug("{0}: FTP with SSL/TLS".format(self.name))
-                self.ftp = FTP_TLS()
+                ftp = FTP_TLS()
             else:
                 log.debug("{0}: FTP no SSL".format(self.name))
-                self.ftp = FTP()
-            self.ftp.set_debuglevel(self.debug_level)
-            self.ftp.connect(self.remote_host, self.remote_port, timeout=self.timeout)
+                ftp = FTP()
+            ftp.set_debuglevel(self.debug_level)
+            ftp.connect(self.remote_host, self.remote_port, timeout=self.timeout)
             if self.is_ssl_auth:
-                self.ftp.auth()
-            self.ftp.login(user=self.username, passwd=self.password)
+                ftp.auth()
+            ftp.login(user=self.username, passwd=self.password)
             if self.is_ssl_data:
-                self.ftp.prot_p()
+                ftp.prot_p()
         except Exception as e:
             log.error("{0}: Connect error to {1} {2}".format(self.name, self.remote_host, e))
-            return False
+            raise
         log.info("{0}: FTP Connected to {1} with {2}".format(self.name, self.remote_host, self.username))
+        return ftp
+
+    def close_connection(self, ftp):
+        ftp.close()
+        log.info("{0}: FTP Disconnected from {1} with {2}".format(self.name, self.remote_host, self.username))
+
+    def check_connection(self, ftp):
+        ftp.voidcmd('NOOP')
         return True
 
-    def disconnect(self):
+    def make_dir(self, ftp, path):
         try:
-            self.ftp.close()
-        except Exception as e:
-            log.error("{0}: Disconnect error to {1} {2}".format(self.name, self.remote_host, e))
-            return False
-        log.info("{0}: FTP Disconnected from {1} with {2}".format(self.name, self.remote_host, self.username))
+            ftp.mkd(path)
+        except:
+            pass
 
-    def create_path(self, remotepath):
-        parts = remotepath.split('/')
-        for n in range(2, len(parts)):
-            path = '/'.join(parts[:n])
+    def remote_size(self, ftp, path):
+        """
+            Returns path size, None if it doesn't exist
+        """
+        try:
+            return ftp.size(path)
+        except error_perm:
+            return None
+
+    def put_resume(self, ftp, file_item, remote_path):
+        """
+            Uploads to a temporary name continuing from its remote size,
+            with REST or APPE, renamed when complete
+        """
+        part_path = self.resume_path(file_item, remote_path)
+        file_size = os.path.getsize(file_item.full_path)
+        # SIZE is only reliable on binary mode
+        ftp.voidcmd('TYPE I')
+        offset = self.remote_size(ftp, part_path) or 0
+        if offset > file_size:
+            offset = 0
+        if offset:
+            log.info("{0}: FTP Resume {1} from {2} bytes".format(self.name, file_item, offset))
+        with open(file_item.full_path, 'rb') as fd:
+            reader = self.open_reader(fd, offset)
+            if offset < file_size or offset == 0:
+                if offset:
+                    try:
+                        ftp.storbinary("STOR " + part_path, reader, rest=offset)
+                    except (error_perm, error_reply):
+                        # no REST for STOR, append instead, nothing was read
+                        ftp.storbinary("APPE " + part_path, reader)
+                else:
+                    ftp.storbinary("STOR " + part_path, reader)
+            if self.checksum:
+                file_item.checksum = reader.checksum
+        remote_size = self.remote_size(ftp, part_path)
+        if remote_size != file_size:
+            raise IOError("Size mismatch, remote {0} local {1}".format(remote_size, file_size))
+        try:
+            ftp.rename(part_path, remote_path)
+        except error_perm:
+            # some servers don't rename over existing files
+            ftp.delete(remote_path)
+            ftp.rename(part_path, remote_path)
+
+    def remote_checksum(self, ftp, path):
+        command = FTP_CHECKSUM_COMMANDS.get(self.checksum)
+        if command and self.pool_key not in no_server_checksum:
             try:
-                self.ftp.mkd(path)
-            except:
-                pass
+                return "{0}:{1}".format(self.checksum, ftp.sendcmd(command + ' ' + path).split()[-1].lower())
+            except error_perm:
+                no_server_checksum.add(self.pool_key)
+        writer = HashingWriter(self.checksum)
+        ftp.retrbinary('RETR ' + path, writer.write)
+        return writer.checksum
+
+    def list_dirs(self, ftp, path):
+        lines = list()
+        ftp.retrlines('MLSD ' + path, lines.append)
+        dirs = list()
+        for line in lines:
+            facts, name = line.split(' ', 1)
+            if 'type=dir;' in facts.lower():
+                dirs.append(name)
+        return dirs
 
     def run(self, file_item):
         super(ProcessorFTP, self).run(file_item)
         try:
-            assert_file_locked(file_item)
+            assert_file_locked(file_item, self.open_files)
             rel_path = file_item.get_relative_path()
             remote_path = self.remote_dir + rel_path + file_item.name
-            self.create_path(remote_path)
-            fd = open(file_item.full_path, 'r')
-            self.ftp.storbinary("STOR " + remote_path, fd)
-            fd.close()
+
+            def put(ftp):
+                self.create_path(ftp, remote_path)
+                if self.resume:
+                    self.put_resume(ftp, file_item, remote_path)
+                else:
+                    fd = open(file_item.full_path, 'rb')
+                    reader = self.open_reader(fd)
+                    ftp.storbinary("STOR " + remote_path, reader)
+                    fd.close()
+                    if self.checksum:
+                        file_item.checksum = reader.checksum
+                if self.checksum_verify:
+                    self.verify_checksum(file_item, self.remote_checksum(ftp, remote_path))
+            self.with_connection(put)
             log.info("{0}: FTP Put file {1}".format(self.name, file_item))
         except Exception as e:
+            self.last_error = e
+            self.dir_cache.invalidate(self.remote_dir + file_item.get_relative_path())
             log.error("{0}: FTP Put error to {1} file {2} :{3}".format(self.name,
                                                                        self.remote_host,
                                                                        file_item, e))
@@ -496,76 +1130,234 @@ class ProcessorFTP(BaseProcessorRemoteCP):
 
 
 @register_property('remote_host', 'The remote hostname or IP', str, True, "")
+@register_property('remote_port', 'The remote SSH Port.', int, False, DEFAULT_SSH_PORT)
 @register_property('remote_dir', 'The remote directory', str, True, "")
 @register_property('username', 'The username to authenticate', str, True, "")
 @register_property('password', 'The password to authenticate', str, False, "")
 @register_property('key_filename', 'Filename of key file for auth.', str, False, None)
 @register_property('channel_timeout', 'The channel timeout in seconds', float, False, DEFAULT_CHANNEL_TIMEOUT)
 @register_property('timeout', 'The connection timeout in seconds', float, False, DEFAULT_CONNECT_TIMEOUT)
+@register_property('block_size', 'Bytes per SFTP write request', int, False, DEFAULT_SFTP_BLOCK_SIZE)
+@register_property('pipelined', 'Sends writes without waiting for each reply', boolstr, False, "True")
+@register_property('window_size', 'SSH channel window in bytes, 0 is paramiko default', int, False, "0")
+@register_property('parallel_chunks', 'SFTP channels uploading parts of large files', int, False, "1")
+@register_property('parallel_min_size', 'Min file size in bytes uploaded in parallel chunks', int, False,
+                   DEFAULT_SFTP_PARALLEL_MIN_SIZE)
+@register_property('resume', 'Uploads to a temporary name, resuming partial uploads', boolstr, False, "False")
+@register_property('part_suffix', 'Suffix of resumable uploads temporary name', str, False, PART_SUFFIX)
 @register_processor('scp', 'Copies files using SFTP')
 class ProcessorSCP(BaseProcessorRemoteCP):
-    sftp = None
+    protocol = 'sftp'
+    connection_properties = ('password', 'key_filename', 'timeout', 'channel_timeout', 'window_size')
 
     def __init__(self, **kwargs):
         super(ProcessorSCP, self).__init__(**kwargs)
-        try:
-            self.ssh = paramiko.SSHClient()
-        except:
+        # imported by the first scp processor, not by every run
+        if not lazy_import('paramiko'):
             log.error("No paramiko package please install, run: pip install paramiko")
 
     def __repr__(self):
         return "{0}@{1}:{2}".format(self.username, self.remote_host, self.remote_dir)
 
-    def connect(self):
+    def open_connection(self):
+        """
+            Returns an (ssh, sftp) pair
+        """
+        paramiko = lazy_import('paramiko')
+        ssh = paramiko.SSHClient()
         try:
-            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh.connect(self.remote_host,
-                             username=self.username,
-                             password=self.password,
-                             key_filename=self.key_filename,
-                             timeout=self.timeout)
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(self.remote_host,
+                        port=self.remote_port,
+                        username=self.username,
+                        password=self.password,
+                        key_filename=self.key_filename,
+                        timeout=self.timeout)
         except Exception as e:
             log.error("{0}: Connect error to {1} {2}".format(self.name, self.remote_host, e))
-            return False
+            raise
         try:
-            self.sftp = self.ssh.open_sftp()
-            self.sftp.get_channel().settimeout(self.channel_timeout)
+            sftp = self.open_sftp(ssh)
         except Exception as e:
             log.error("{0}: Open SFTP error to {1} {2}".format(self.name, self.remote_host, e))
-            return False
+            ssh.close()
+            raise
         log.info("{0}: SFTP Connected to {1} with {2}".format(self.name, self.remote_host, self.username))
-        return True
-
-    def disconnect(self):
-        try:
-            self.sftp.close()
-            self.ssh.close()
-        except Exception as e:
-            log.error("{0}: Disconnect error to {1} {2}".format(self.name, self.remote_host, e))
-            return False
+        return ssh, sftp
+
+    def open_sftp(self, ssh):
+        """
+            Opens an SFTP channel on the ssh connection
+        """
+        paramiko = lazy_import('paramiko')
+        sftp = paramiko.SFTPClient.from_transport(ssh.get_transport(), window_size=self.window_size or None)
+        sftp.get_channel().settimeout(self.channel_timeout)
+        return sftp
+
+    def close_connection(self, connection):
+        ssh, sftp = connection
+        sftp.close()
+        ssh.close()
         log.info("{0}: SFTP Disconnected from {1} with {2}".format(self.name,
                                                                    self.remote_host,
                                                                    self.username))
 
-    def create_path(self, remotepath):
-        parts = remotepath.split('/')
-        for n in range(2, len(parts)):
-            path = '/'.join(parts[:n])
+    def check_connection(self, connection):
+        ssh, sftp = connection
+        if not ssh.get_transport() or not ssh.get_transport().is_active():
+            return False
+        sftp.normalize('.')
+        return True
+
+    def make_dir(self, sftp, path):
+        try:
+            sftp.stat(path)
+        except IOError:
+            sftp.mkdir(path)
+
+    def list_dirs(self, sftp, path):
+        return [attr.filename for attr in sftp.listdir_attr(path) if stat.S_ISDIR(attr.st_mode)]
+
+    def put_range(self, sftp, local_path, remote_path, offset, size, mode='wb', hashed=False):
+        """
+            Writes size bytes at offset of local_path to remote_path,
+            in block_size requests, pipelined if set.
+            If hashed returns the checksum of local_path up to offset + size.
+        """
+        with open(local_path, 'rb') as fd:
+            remote_file = sftp.open(remote_path, mode, self.block_size)
             try:
-                self.sftp.stat(path)
-            except:
-                self.sftp.mkdir(path)
+                remote_file.MAX_REQUEST_SIZE = self.block_size
+                remote_file.set_pipelined(self.pipelined)
+                fd = self.open_reader(fd, offset, hashed)
+                remote_file.seek(offset)
+                while size > 0:
+                    data = fd.read(min(self.block_size, size))
+                    if not data:
+                        break
+                    remote_file.write(data)
+                    size -= len(data)
+            finally:
+                # waits for pending pipelined writes
+                remote_file.close()
+        if hashed and self.checksum:
+            return fd.checksum
+
+    def put_parallel(self, ssh, sftp, file_item, remote_path, file_size):
+        """
+            Uploads parallel_chunks byte ranges, each on its own SFTP channel,
+            to a part_suffix file renamed when complete
+        """
+        local_path = file_item.full_path
+        part_path = remote_path + self.part_suffix
+        sftp.open(part_path, 'wb').close()
+        chunk_size = -(-file_size // self.parallel_chunks)
+        errors = list()
+
+        def upload(offset):
+            try:
+                chunk_sftp = self.open_sftp(ssh)
+                try:
+                    self.put_range(chunk_sftp, local_path, part_path, offset, chunk_size, 'r+b')
+                finally:
+                    chunk_sftp.close()
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=upload, args=(offset,)) for offset in range(0, file_size, chunk_size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        self.verify_size(sftp, part_path, file_size)
+        self.rename(sftp, part_path, remote_path)
+        if self.checksum:
+            # chunks were read out of order, the file is read again
+            self.item_digest(file_item)
+
+    def rename(self, sftp, part_path, remote_path):
+        try:
+            sftp.posix_rename(part_path, remote_path)
+        except IOError:
+            # no posix-rename extension, rename fails on existing files
+            try:
+                sftp.remove(remote_path)
+            except IOError:
+                pass
+            sftp.rename(part_path, remote_path)
+
+    def put_resume(self, sftp, file_item, remote_path, file_size):
+        """
+            Uploads to a temporary name continuing from its remote size, renamed when complete
+        """
+        part_path = self.resume_path(file_item, remote_path)
+        try:
+            offset = sftp.stat(part_path).st_size
+        except IOError:
+            offset = 0
+        if offset > file_size:
+            offset = 0
+        if offset:
+            log.info("{0}: SFTP Resume {1} from {2} bytes".format(self.name, file_item, offset))
+        checksum = self.put_range(sftp, file_item.full_path, part_path, offset, file_size - offset,
+                                  'r+b' if offset else 'wb', True)
+        if checksum:
+            file_item.checksum = checksum
+        self.verify_size(sftp, part_path, file_size)
+        self.rename(sftp, part_path, remote_path)
+
+    def verify_size(self, sftp, remote_path, file_size):
+        remote_size = sftp.stat(remote_path).st_size
+        if remote_size != file_size:
+            raise IOError("Size mismatch, remote {0} local {1}".format(remote_size, file_size))
+
+    def put(self, ssh, sftp, file_item, remote_path):
+        local_path = file_item.full_path
+        file_size = os.path.getsize(local_path)
+        if self.parallel_chunks > 1 and file_size and file_size >= self.parallel_min_size:
+            return self.put_parallel(ssh, sftp, file_item, remote_path, file_size)
+        if self.resume:
+            return self.put_resume(sftp, file_item, remote_path, file_size)
+        checksum = self.put_range(sftp, local_path, remote_path, 0, file_size, hashed=True)
+        if checksum:
+            file_item.checksum = checksum
+        self.verify_size(sftp, remote_path, file_size)
+
+    def remote_checksum(self, ssh, sftp, path):
+        command = SSH_CHECKSUM_COMMANDS.get(self.checksum)
+        if command and self.pool_key not in no_server_checksum:
+            try:
+                stdin, stdout, stderr = ssh.exec_command("{0} {1}".format(command, shell_quote(path)),
+                                                         timeout=self.channel_timeout)
+                output = stdout.read().decode('utf-8', 'replace')
+                if stdout.channel.recv_exit_status() == 0 and output:
+                    return "{0}:{1}".format(self.checksum, output.split()[0].lower())
+            except Exception as e:
+                log.debug("{0}: Remote {1} error {2}".format(self.name, command, e))
+            no_server_checksum.add(self.pool_key)
+        with sftp.open(path, 'rb') as remote_file:
+            remote_file.prefetch()
+            return hash_stream(remote_file.read, self.checksum)
 
     def run(self, file_item):
         super(ProcessorSCP, self).run(file_item)
         try:
-            assert_file_locked(file_item)
+            assert_file_locked(file_item, self.open_files)
             rel_path = file_item.get_relative_path()
             remote_path = self.remote_dir + rel_path + file_item.name
-            self.create_path(remote_path)
-            self.sftp.put(file_item.full_path, remote_path)
+
+            def put(connection):
+                ssh, sftp = connection
+                self.create_path(sftp, remote_path)
+                self.put(ssh, sftp, file_item, remote_path)
+                if self.checksum_verify:
+                    self.verify_checksum(file_item, self.remote_checksum(ssh, sftp, remote_path))
+            self.with_connection(put)
             log.info("{0}: SFTP Put file {1}".format(self.name, file_item))
         except Exception as e:
+            self.last_error = e
+            self.dir_cache.invalidate(self.remote_dir + file_item.get_relative_path())
             log.error("{0}: SFTP Put error to {1} file {2} :{3}".format(self.name,
                                                                         self.remote_host,
                                                                         file_item, e))
@@ -1,14 +1,24 @@
 
 import logging
-import os, re
-from threading import Thread
-from .utils import boolstr, walkfiles
-from .items import FileItem
+import os, re, stat, time
+from threading import Thread, Event
+from ._compat import PY2
+from .utils import boolstr, walkfiles_stat, walkfiles_parallel, listdir_stat
+from .manifest import DirManifest
+from .utilslinux import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR
+from .items import FileItem, TimeFilter
+from .metrics import count_scan
+from .profiling import profile_generator
 from .processors import ProcessSequence
 from .providers import BaseProvider, register_producer, register_property
 log = logging.getLogger(__name__)
 
+ENGINES = ('thread', 'async')
 
+
+@register_property('pipeline', 'Scan once and stream items through all processors', boolstr, False, "False")
+@register_property('queue_size', 'Max queued items per processor when pipelined', int, False, "1000")
+@register_property('engine', 'How processors are run {0}'.format(ENGINES), str, False, "thread")
 class BaseProducer(BaseProvider, Thread):
     """
         All Consumer objects classes inherit from this
@@ -16,10 +26,18 @@ class BaseProducer(BaseProvider, Thread):
     process_sequence = None
 
     def __init__(self, thread=False, **kwargs):
-        Thread.__init__(self)
+        # the thread is named after the producer, so name is the config name
+        Thread.__init__(self, name=kwargs.get('name'))
         BaseProvider.__init__(self, **kwargs)
         self.is_thread = boolstr(thread)
         self._process_sequence = ProcessSequence()
+        self._stop_event = Event()
+        if self.engine not in ENGINES:
+            log.critical("{0}: Unknown engine {1}, use one of {2}".format(self.name, self.engine, ENGINES))
+            exit(1)
+        if self.engine == 'async' and PY2:
+            log.critical("{0}: The async engine needs Python 3".format(self.name))
+            exit(1)
 
     @property
     def process_sequence(self):
@@ -35,8 +53,29 @@ class BaseProducer(BaseProvider, Thread):
         """
         return []
 
+    def stop(self):
+        """
+            Stops producing items, items already queued are still processed
+        """
+        self._stop_event.set()
+
+    def _until_stopped(self, generator):
+        def produced():
+            items = generator()
+            try:
+                for item in items:
+                    if self._stop_event.is_set():
+                        log.info("{0}: Stopped producing".format(self.name))
+                        return
+                    yield item
+            finally:
+                items.close()
+        return produced
+
     def run(self):
-        self.process_sequence.run(self.generator)
+        generator = count_scan(self.name, self._until_stopped(self.generator))
+        generator = profile_generator(self.name + '.scan', generator)
+        self.process_sequence.run(generator, self.pipeline, self.queue_size, self.engine)
 
     def list(self):
         self.process_sequence.list()
@@ -58,6 +97,13 @@ class Read(BaseProducer):
 @register_property('mtime', 'Filter files with modified TS', int, False, "0")
 @register_property('atime', 'Filter files with accessed TS', int, False, "0")
 @register_property('ctime', 'Filter files with creation TS', int, False, "0")
+@register_property('dir_include', 'RegEx sub directories must match to be walked', str, False)
+@register_property('dir_exclude', 'RegEx sub directories that are not walked', str, False)
+@register_property('max_depth', 'Max sub directory depth, -1 is unlimited', int, False, "-1")
+@register_property('max_files', 'Max files produced per scan, 0 is unlimited', int, False, "0")
+@register_property('manifest', 'Keep directory listings, only list changed directories', boolstr, False, "False")
+@register_property('walk_threads', 'Number of threads listing directories', int, False, "1")
+@register_property('walk_ordered', 'Produce files on the same order with walk_threads', boolstr, False, "False")
 @register_producer('dir_mon', 'Monitors directory changes between runs')
 class DirMon(BaseProducer):
     """
@@ -66,7 +112,15 @@ class DirMon(BaseProducer):
     """
     def __init__(self, **kwargs):
         super(DirMon, self).__init__(**kwargs)
-
+        try:
+            self._filter_re = re.compile(self.filter)
+            self._dir_include_re = self.dir_include and re.compile(self.dir_include)
+            self._dir_exclude_re = self.dir_exclude and re.compile(self.dir_exclude)
+        except re.error as e:
+            log.critical("{0}: Invalid regular expression {1}".format(self.name, e))
+            exit(1)
+        # loaded on the first scan, kept for the next ones in daemon mode
+        self._manifest = None
 
     def generator(self):
         if not os.path.exists(self.basedir):
@@ -75,14 +129,143 @@ class DirMon(BaseProducer):
         if not self.recursive:
             level = 0
         else:
-            level = -1
-        for file_name in walkfiles(self.basedir, self.filter, level):
-                # filter file name
-                    if FileItem.check_mtime(file_name, self.mtime) and \
-                        FileItem.check_atime(file_name, self.atime) and \
-                        FileItem.check_ctime(file_name, self.ctime):
-                        yield FileItem(file_name, self.basedir)
+            level = self.max_depth
+        time_filter = TimeFilter(self.mtime, self.atime, self.ctime)
+        manifest = None
+        list_dir = listdir_stat
+        if self.manifest:
+            if self._manifest is None:
+                self._manifest = DirManifest(self.name)
+                self._manifest.load()
+            manifest = self._manifest
+            list_dir = manifest.listdir_stat
+        if self.walk_threads > 1:
+            walk = walkfiles_parallel(self.basedir, self._filter_re, level,
+                                      self._dir_include_re, self._dir_exclude_re, list_dir,
+                                      self.walk_threads, self.walk_ordered)
+        else:
+            walk = walkfiles_stat(self.basedir, self._filter_re, level,
+                                  self._dir_include_re, self._dir_exclude_re, list_dir=list_dir)
+        produced = 0
+        try:
+            for file_name, stat_result in walk:
+                if time_filter.check(stat_result):
+                    item = FileItem(file_name, self.basedir, stat_result)
+                    # processed items are skipped, only new ones count, checked before they're queued
+                    pending = self.max_files and self.process_sequence.is_pending(item)
+                    yield item
+                    if pending:
+                        produced += 1
+                        if produced == self.max_files:
+                            log.info("{0}: Reached max files {1} on this scan".format(self.name, self.max_files))
+                            return
+        finally:
+            walk.close()
+            if manifest:
+                manifest.save()
 
     def __repr__(self):
         return "Base Dir:{0}, Recursive: {1}, Filter: {2}".format(self.basedir, self.recursive, self.filter)
 
+
+
+@register_property('watch_time', 'Seconds to watch for changes, 0 is forever', int, False, "0")
+@register_producer('inotify_mon', 'Watches directory changes with inotify (Linux only)')
+class InotifyMon(DirMon):
+    """
+        Producer that scans a directory structure once, like DirMon,
+        then watches it with inotify and produces files closed after
+        write or moved in. Always pipelined.
+    """
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    # dir_mon properties that mean nothing to a watch, rejected if configured
+    unsupported_properties = ('manifest', 'walk_threads', 'walk_ordered', 'max_files')
+
+    def __init__(self, **kwargs):
+        super(InotifyMon, self).__init__(**kwargs)
+        unsupported = [name for name in self.unsupported_properties if name in kwargs]
+        if unsupported:
+            log.critical("{0}: {1} not supported by inotify_mon".format(self.name, ', '.join(unsupported)))
+            exit(1)
+        # events are produced once, they must flow through all processors
+        self.pipeline = True
+
+    def add_process(self, processor):
+        if not self.watch_time and processor.state and processor.state_backend == 'pickle':
+            # pickle states are only written when the watch ends, never with watch_time 0
+            log.critical("{0}: {1} needs state_backend journal or sqlite to watch forever, "
+                         "or state False".format(self.name, processor.name))
+            exit(1)
+        super(InotifyMon, self).add_process(processor)
+
+    def _is_dir_walked(self, dir_name):
+        if self._dir_include_re and not self._dir_include_re.match(dir_name):
+            return False
+        return not (self._dir_exclude_re and self._dir_exclude_re.match(dir_name))
+
+    def _scan(self, inotify, watches, directory, depth, level):
+        """
+            Watches and scans directory and its sub directories
+        """
+        def on_dir(dir_name, dir_depth):
+            try:
+                watches[inotify.add_watch(dir_name, self.watch_mask)] = (dir_name, depth + dir_depth)
+            except OSError as e:
+                log.error("{0}: Unable to watch {1} {2}".format(self.name, dir_name, e))
+
+        time_filter = TimeFilter(self.mtime, self.atime, self.ctime)
+        sub_level = level if level == -1 else level - depth
+        for file_name, stat_result in walkfiles_stat(directory, self._filter_re, sub_level,
+                                                     self._dir_include_re, self._dir_exclude_re, on_dir):
+            if time_filter.check(stat_result):
+                yield FileItem(file_name, self.basedir, stat_result)
+
+    def generator(self):
+        if not os.path.exists(self.basedir):
+            log.error("Path does not exist {0}".format(self.basedir))
+            return
+        if not self.recursive:
+            level = 0
+        else:
+            level = self.max_depth
+        inotify = Inotify()
+        watches = dict()
+        try:
+            for item in self._scan(inotify, watches, self.basedir, 0, level):
+                yield item
+            log.info("{0}: Watching {1} directories".format(self.name, len(watches)))
+            deadline = time.time() + self.watch_time if self.watch_time else None
+            while not self._stop_event.is_set():
+                timeout = 1.0
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.time())
+                    if timeout <= 0:
+                        break
+                for wd, mask, cookie, name in inotify.read_events(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        log.warning("{0}: Event queue overflow, scanning {1}".format(self.name, self.basedir))
+                        for item in self._scan(inotify, watches, self.basedir, 0, level):
+                            yield item
+                        continue
+                    if mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    if wd not in watches:
+                        continue
+                    root, depth = watches[wd]
+                    file_name = os.path.join(root, name)
+                    if mask & IN_ISDIR:
+                        # new directories may already have files, scan them after watching
+                        if (mask & (IN_CREATE | IN_MOVED_TO)) and (level == -1 or depth < level) and \
+                                self._is_dir_walked(file_name):
+                            for item in self._scan(inotify, watches, file_name, depth + 1, level):
+                                yield item
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self._filter_re.match(file_name):
+                        try:
+                            stat_result = os.lstat(file_name)
+                        except OSError:
+                            continue
+                        if not stat.S_ISLNK(stat_result.st_mode):
+                            yield FileItem(file_name, self.basedir, stat_result)
+        finally:
+            inotify.close()
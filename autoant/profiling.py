@@ -0,0 +1,248 @@
+"""
+    Profiling of runs, enabled by the console --profile option.
+    Each processor thread and producer scan runs under its own cProfile,
+    merged into one pstats file per stage. A sampler thread records the
+    stacks of the same threads as collapsed stacks for flamegraph tools.
+    With memory, tracemalloc snapshots are compared at the start and
+    end of each stage (Python 3).
+"""
+import logging
+import os
+import sys
+from threading import Thread, Event, Lock, current_thread
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# growth is reported by line, more frames make tracing much slower
+TRACEMALLOC_FRAMES = 1
+MEMORY_TOP = 25
+
+_profiler = None
+
+
+class Sampler(Thread):
+    """
+        Samples the stacks of registered threads every interval seconds,
+        counting them per stage as collapsed stacks
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        super(Sampler, self).__init__(name='autoant.sampler')
+        self.setDaemon(True)
+        self.interval = interval
+        # thread ident: (stage, label)
+        self.threads = dict()
+        # stage: {collapsed stack: count}
+        self.stacks = dict()
+        self._stop_event = Event()
+
+    def register(self, stage, label):
+        """
+            Samples the current thread as label of stage, returns its previous registration
+        """
+        ident = current_thread().ident
+        previous = self.threads.get(ident)
+        self.threads[ident] = (stage, label)
+        return previous
+
+    def unregister(self, previous=None):
+        ident = current_thread().ident
+        if previous is None:
+            self.threads.pop(ident, None)
+        else:
+            self.threads[ident] = previous
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        threads = dict(self.threads)
+        for ident, frame in sys._current_frames().items():
+            if ident not in threads:
+                continue
+            stage, label = threads[ident]
+            names = list()
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            names.append(label)
+            stack = ';'.join(reversed(names))
+            counts = self.stacks.setdefault(stage, dict())
+            counts[stack] = counts.get(stack, 0) + 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    # ';' separates frames and the last space the count on collapsed stacks
+    name = "{0}:{1}:{2}".format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+    return name.replace(';', ':').replace(' ', '_')
+
+
+def _file_name(stage):
+    return stage.replace(os.sep, '_')
+
+
+class Profiler(object):
+    """
+        Keeps the profiles of all stages until written to output_dir
+    """
+    def __init__(self, output_dir, memory=False, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.memory = memory and tracemalloc is not None
+        # cProfile is per thread only up to Python 3.11, later it's one at a time per process
+        self.use_cprofile = sys.version_info < (3, 12)
+        # stage: [cProfile.Profile]
+        self.profiles = dict()
+        # stage: tracemalloc snapshot at its start
+        self.snapshots = dict()
+        self._lock = Lock()
+        self.sampler = Sampler(interval)
+        if memory and tracemalloc is None:
+            log.warning("Memory profiling needs Python 3 tracemalloc")
+        if not self.use_cprofile:
+            log.warning("No cProfile per thread on this Python, only sampling")
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.sampler.start()
+
+    def new_profile(self, stage):
+        """
+            Returns a new cProfile of stage, None if only sampling
+        """
+        if not self.use_cprofile:
+            return None
+        import cProfile
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.setdefault(stage, list()).append(profile)
+        return profile
+
+    def start_stage(self, stage):
+        if self.memory:
+            self.snapshots[stage] = tracemalloc.take_snapshot()
+
+    def stop_stage(self, stage, p_state=None):
+        start = self.snapshots.pop(stage, None)
+        if start is None:
+            return
+        snapshot = tracemalloc.take_snapshot()
+        path = os.path.join(self.output_dir, _file_name(stage) + '.memory.txt')
+        with open(path, 'w') as fd:
+            if p_state is not None:
+                fd.write("{0}: {1} processed, {2} failed, {3} queued\n".format(
+                    stage, len(p_state.processed), len(p_state.process_fails), p_state.queue.qsize()))
+            fd.write("Top {0} allocation growth during the stage\n".format(MEMORY_TOP))
+            # snapshots and the sampler allocate too
+            ignored = (tracemalloc.__file__, __file__)
+            stats = [stat for stat in snapshot.compare_to(start, 'lineno')
+                     if stat.traceback[0].filename not in ignored]
+            for stat in stats[:MEMORY_TOP]:
+                fd.write("{0}\n".format(stat))
+        snapshot.dump(os.path.join(self.output_dir, _file_name(stage) + '.tracemalloc'))
+
+    def write(self):
+        import pstats
+        self.sampler.stop()
+        for stage, profiles in self.profiles.items():
+            stats = None
+            for profile in profiles:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(profile)
+                    else:
+                        stats.add(profile)
+                except TypeError:
+                    # a profile that never ran
+                    continue
+            if stats is not None:
+                stats.dump_stats(os.path.join(self.output_dir, _file_name(stage) + '.pstats'))
+        for stage, counts in self.sampler.stacks.items():
+            with open(os.path.join(self.output_dir, _file_name(stage) + '.collapsed'), 'w') as fd:
+                for stack, count in sorted(counts.items()):
+                    fd.write("{0} {1}\n".format(stack, count))
+        log.info("Profiles written to {0}".format(self.output_dir))
+
+
+def enable(output_dir, memory=False, interval=DEFAULT_SAMPLE_INTERVAL):
+    global _profiler
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    _profiler = Profiler(output_dir, memory, interval)
+
+
+def write():
+    if _profiler is not None:
+        _profiler.write()
+
+
+def profile_call(stage, label, func, *args):
+    """
+        Runs func(*args) on this thread, profiled as label of stage
+    """
+    if _profiler is None:
+        return func(*args)
+    profile = _profiler.new_profile(stage)
+    previous = _profiler.sampler.register(stage, label)
+    try:
+        if profile is None:
+            return func(*args)
+        return profile.runcall(func, *args)
+    finally:
+        _profiler.sampler.unregister(previous)
+
+
+def register_thread(stage, label):
+    """
+        Samples the current thread until it ends, ex: executor threads
+    """
+    if _profiler is not None:
+        _profiler.sampler.register(stage, label)
+
+
+def profile_generator(stage, generator):
+    """
+        Wraps a producer generator function, profiling only the time spent producing items
+    """
+    if _profiler is None:
+        return generator
+
+    def profiled():
+        profile = _profiler.new_profile(stage)
+        items = generator()
+        try:
+            while True:
+                previous = _profiler.sampler.register(stage, stage)
+                if profile is not None:
+                    profile.enable()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    if profile is not None:
+                        profile.disable()
+                    _profiler.sampler.unregister(previous)
+                yield item
+        finally:
+            items.close()
+    return profiled
+
+
+def start_stage(stage):
+    if _profiler is not None:
+        _profiler.start_stage(stage)
+
+
+def stop_stage(stage, p_state=None):
+    if _profiler is not None:
+        _profiler.stop_stage(stage, p_state)
@@ -1,9 +1,72 @@
+import importlib
 import logging
+import os
+import sys
 
 log = logging.getLogger(__name__)
 
 
 PROP_HIDDEN_PREFIX = '_prop_'
+# entry point group of third party producers and processors, the
+# entry point name is the type_key, ex: "my_proc = my_package.processors"
+ENTRY_POINT_GROUP = 'autoant.providers'
+
+
+class _EntryPoint(object):
+    """
+        Entry point read from an entry_points.txt, for
+        Pythons without importlib.metadata
+    """
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def load(self):
+        module_name, _, attrs = self.value.partition(':')
+        obj = importlib.import_module(module_name.strip())
+        for attr in attrs.strip().split('.') if attrs.strip() else []:
+            obj = getattr(obj, attr)
+        return obj
+
+
+def _scan_entry_points():
+    """
+        Reads the entry_points.txt of the distributions on sys.path,
+        faster to import than pkg_resources
+    """
+    try:
+        from ConfigParser import RawConfigParser
+    except ImportError:
+        from configparser import RawConfigParser
+    entry_points = list()
+    for path in sys.path:
+        if not os.path.isdir(path or '.'):
+            continue
+        for name in sorted(os.listdir(path or '.')):
+            file_name = os.path.join(path, name, 'entry_points.txt')
+            if not name.endswith(('.dist-info', '.egg-info')) or not os.path.isfile(file_name):
+                continue
+            config = RawConfigParser()
+            # entry point names are case sensitive
+            config.optionxform = str
+            config.read(file_name)
+            if config.has_section(ENTRY_POINT_GROUP):
+                entry_points.extend(_EntryPoint(key, value) for key, value in config.items(ENTRY_POINT_GROUP))
+    return entry_points
+
+
+def _entry_points():
+    """
+        Installed entry points of ENTRY_POINT_GROUP, their modules are not imported
+    """
+    try:
+        from importlib import metadata
+    except ImportError:
+        return _scan_entry_points()
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=ENTRY_POINT_GROUP))
+    return list(entry_points.get(ENTRY_POINT_GROUP, []))
 
 
 class BaseProvider(object):
@@ -15,12 +78,20 @@ class BaseProvider(object):
     def __init__(self, **kwargs):
         self._set_properties(**kwargs)
 
+    @classmethod
+    def _properties(cls):
+        """
+            (name, ProviderProperty) of the class and its bases,
+            looked up once per class
+        """
+        if '_provider_properties' not in cls.__dict__:
+            cls._provider_properties = [(attr[len(PROP_HIDDEN_PREFIX):], getattr(cls, attr))
+                                        for attr in dir(cls) if attr.startswith(PROP_HIDDEN_PREFIX)]
+        return cls._provider_properties
+
     def _set_properties(self, **kwargs):
-        for attr in dir(self):
-            if PROP_HIDDEN_PREFIX in attr:
-                attr_val = getattr(self, attr).get_value(**kwargs)
-                attr_name = attr.replace(PROP_HIDDEN_PREFIX, '')
-                setattr(self, attr_name, attr_val)
+        for attr_name, prop in self._properties():
+            setattr(self, attr_name, prop.get_value(**kwargs))
 
 
 class Provider(object):
@@ -31,6 +102,10 @@ class Provider(object):
 
     def __init__(self):
         self._providers = list()
+        # indexes of _providers by key and by class
+        self._by_key = dict()
+        self._by_class = dict()
+        self._entry_points = None
 
     def add(self, provider_type, key, provider_class, short_description):
         provider = dict()
@@ -40,28 +115,61 @@ class Provider(object):
         provider['short_description'] = short_description
         provider['properties'] = list()
         self._providers.append(provider)
+        self._by_key[key] = provider
+        self._by_class[provider_class] = provider
 
     def add_property(self, cls, prop):
-        for provider in self._providers:
-            if cls.__name__ == provider['class'].__name__:
-                provider['properties'].append(prop)
+        provider = self._by_class.get(cls)
+        if provider is not None:
+            provider['properties'].append(prop)
+
+    @property
+    def entry_points(self):
+        """
+            key: entry point of installed third party providers
+        """
+        if self._entry_points is None:
+            self._entry_points = dict()
+            try:
+                for entry_point in _entry_points():
+                    self._entry_points.setdefault(entry_point.name, entry_point)
+            except Exception as e:
+                log.error("Error reading {0} entry points {1}".format(ENTRY_POINT_GROUP, e))
+        return self._entry_points
 
+    def _load_entry_point(self, key):
+        """
+            Imports the module of key's entry point, its decorators register the class
+        """
+        entry_point = self.entry_points.get(key)
+        if entry_point is None:
+            return
+        try:
+            entry_point.load()
+        except Exception as e:
+            log.error("Error loading provider {0} from {1}: {2}".format(key, entry_point.value, e))
+            return
+        if key not in self._by_key:
+            log.error("Provider {0} not registered by {1}".format(key, entry_point.value))
 
     def get_class(self, key):
         """
-            Get class from key
+            Get class from key, third party providers are
+            imported on their first use
         """
-        for provider in self._providers:
-            if provider['key'] == key:
-                return provider['class']
+        if key not in self._by_key:
+            self._load_entry_point(key)
+        provider = self._by_key.get(key)
+        if provider is not None:
+            return provider['class']
 
     def get_short_description(self, cls):
         """
             Get short description from class
         """
-        for provider in self._providers:
-            if cls.__name__ == provider['class'].__name__:
-                return provider['short_description']
+        provider = self._by_class.get(cls)
+        if provider is not None:
+            return provider['short_description']
 
     def __repr__(self):
         retstr = ''
@@ -70,6 +178,9 @@ class Provider(object):
                                                      provider['key'], provider['short_description'])
             for prop in provider['properties']:
                 retstr = retstr + " - {0}".format(prop)
+        for key, entry_point in sorted(self.entry_points.items()):
+            if key not in self._by_key:
+                retstr = retstr + "Plugin: key:{0} - {1} (not loaded)\n".format(key, entry_point.value)
         return retstr
 
 providers = Provider()
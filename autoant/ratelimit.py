@@ -0,0 +1,121 @@
+"""
+    Token buckets limiting bytes and files per second, and
+    semaphores limiting concurrent transfers per remote host.
+    Shared by all threads of the process, like connection pools.
+"""
+import logging
+import os
+import time
+from threading import BoundedSemaphore, Lock
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RATE_BURST = 1
+
+_clock = getattr(time, 'monotonic', time.time)
+_buckets = dict()
+_host_limits = dict()
+_host_limit_values = dict()
+# (host, limit) of processors that wanted another host_limit, warned once
+_host_limit_conflicts = set()
+_registry_lock = Lock()
+_registry_pid = os.getpid()
+
+
+class TokenBucket(object):
+    """
+        Fills with rate tokens per second up to capacity.
+        Taking more tokens than available leaves a debt
+        the caller waits for, so any amount can be taken.
+    """
+    def __init__(self, key, rate, capacity=None):
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._last = _clock()
+        self._lock = Lock()
+
+    def reserve(self, tokens):
+        """
+            Takes tokens, returns the seconds to wait before using them
+        """
+        with self._lock:
+            now = _clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+
+class ThrottledReader(object):
+    """
+        File object wrapper, waits on buckets for each block read
+    """
+    def __init__(self, fd, buckets):
+        self.fd = fd
+        self.buckets = buckets
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+    def read(self, size=-1):
+        data = self.fd.read(size)
+        throttle(self.buckets, len(data))
+        return data
+
+
+def reserve(buckets, tokens):
+    """
+        Takes tokens from all buckets, returns the seconds to wait,
+        for callers that can't sleep, ex: the async engine.
+    """
+    if not tokens:
+        return 0
+    return max([bucket.reserve(tokens) for bucket in buckets] or [0])
+
+
+def throttle(buckets, tokens):
+    wait = reserve(buckets, tokens)
+    if wait > 0:
+        time.sleep(wait)
+
+
+def _check_fork():
+    global _registry_pid
+    if _registry_pid != os.getpid():
+        # forked, each process has its own limits
+        _buckets.clear()
+        _host_limits.clear()
+        _host_limit_values.clear()
+        _host_limit_conflicts.clear()
+        _registry_pid = os.getpid()
+
+
+def get_bucket(key, rate, capacity=None):
+    """
+        Returns the bucket for key, created with rate and capacity on first call
+    """
+    with _registry_lock:
+        _check_fork()
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(key, rate, capacity)
+            log.debug("Rate limit {0} to {1}/s".format(key, rate))
+        return _buckets[key]
+
+
+def get_host_limit(host, limit):
+    """
+        Returns the semaphore of host, created with limit on first call
+    """
+    with _registry_lock:
+        _check_fork()
+        if host not in _host_limits:
+            _host_limits[host] = BoundedSemaphore(limit)
+            _host_limit_values[host] = limit
+        elif limit != _host_limit_values[host] and (host, limit) not in _host_limit_conflicts:
+            _host_limit_conflicts.add((host, limit))
+            log.warning("{0}: host_limit already set to {1}, not {2}".format(host, _host_limit_values[host], limit))
+        return _host_limits[host]
@@ -0,0 +1,267 @@
+"""
+    Retries of failed items: error classification, exponential
+    backoff with jitter, and circuit breakers per destination.
+"""
+import errno
+import heapq
+import itertools
+import logging
+import random
+import time
+from threading import Thread, Event, Lock
+try:
+    from Queue import Full
+except ImportError:
+    from queue import Full
+from .items import get_item_key
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RETRY_DELAY = 1
+DEFAULT_RETRY_MAX_DELAY = 60
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+# Seconds items wait while a circuit trial run is in flight
+TRIAL_WAIT = 1
+# Max seconds between checks for due retries while items are produced
+PUMP_INTERVAL = 1
+# Errors of optional libraries are matched by class name, most derived first
+RETRYABLE_ERROR_NAMES = frozenset(('error_temp', 'error_reply', 'error_proto', 'SSHException',
+                                   'NotConnectedError', 'NotReadyError', 'SMBTimeout', 'EOFError'))
+FATAL_ERROR_NAMES = frozenset(('error_perm', 'AuthenticationException', 'BadAuthenticationType',
+                               'OperationFailure'))
+# OS errors retrying will not fix
+FATAL_ERRNOS = frozenset(getattr(errno, name) for name in ('ENOENT', 'EACCES', 'EPERM', 'EEXIST', 'EISDIR',
+                                                           'ENOTDIR', 'ENAMETOOLONG', 'EROFS', 'EINVAL',
+                                                           'ENOSPC', 'EDQUOT')
+                         if hasattr(errno, name))
+
+_clock = getattr(time, 'monotonic', time.time)
+_breakers = dict()
+_breakers_lock = Lock()
+
+
+class RetryableError(Exception):
+    """
+        Transient error, ex: the file is still open
+    """
+    pass
+
+
+class CircuitOpenError(RetryableError):
+    """
+        The item was not run, its destination circuit is open.
+        wait is the seconds until it can run, trial is True while
+        a trial run is in flight.
+    """
+    def __init__(self, key, wait, trial=False):
+        super(CircuitOpenError, self).__init__("Circuit open to {0}".format(key))
+        self.wait = wait
+        self.trial = trial
+
+
+def is_retryable(error):
+    """
+        True if a run failing with error may work later.
+        Timeouts, connection and temporary server errors are,
+        permissions, missing files and unknown errors are not.
+    """
+    if error is None:
+        return False
+    for cls in type(error).__mro__:
+        if cls.__name__ in FATAL_ERROR_NAMES:
+            return False
+        if cls.__name__ in RETRYABLE_ERROR_NAMES or cls is RetryableError:
+            return True
+    if isinstance(error, EnvironmentError):
+        # socket errors and timeouts, size and checksum mismatches
+        return error.errno not in FATAL_ERRNOS
+    return False
+
+
+def backoff_delay(attempt, delay, max_delay):
+    """
+        Seconds before retry number attempt, doubles on each attempt up
+        to max_delay, half of it random so retries don't come in waves
+    """
+    backoff = min(max_delay, delay * 2 ** (attempt - 1))
+    return backoff / 2.0 + random.uniform(0, backoff / 2.0)
+
+
+class RetryScheduler(object):
+    """
+        Failed items of one process waiting for their retry.
+        Each item is retried up to retries times.
+    """
+    def __init__(self, name, retries=0, delay=DEFAULT_RETRY_DELAY, max_delay=DEFAULT_RETRY_MAX_DELAY):
+        self.name = name
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        # (due time, sequence, item)
+        self._heap = list()
+        self._attempts = dict()
+        self._sequence = itertools.count()
+        self._lock = Lock()
+
+    @property
+    def pending(self):
+        return len(self._heap)
+
+    def schedule(self, item, min_delay=0, count=True):
+        """
+            Schedules item again, returns False if it had all its retries.
+            Uncounted retries wait min_delay and don't use an attempt.
+        """
+        key = get_item_key(item)
+        with self._lock:
+            attempt = self._attempts.get(key, 0) + (1 if count else 0)
+            if attempt > self.retries:
+                self._attempts.pop(key, None)
+                return False
+            self._attempts[key] = attempt
+            delay = max(min_delay, backoff_delay(attempt, self.delay, self.max_delay) if count else 0)
+            heapq.heappush(self._heap, (_clock() + delay, next(self._sequence), item))
+        if count:
+            log.info("{0}: Retry {1} in {2:.1f}s, attempt {3} of {4}".format(self.name, item, delay,
+                                                                             attempt, self.retries))
+        else:
+            log.debug("{0}: Retry {1} in {2:.1f}s".format(self.name, item, delay))
+        return True
+
+    def done(self, item):
+        """
+            Forgets the attempts of an item that succeeded or failed for good
+        """
+        with self._lock:
+            self._attempts.pop(get_item_key(item), None)
+
+    def next_delay(self):
+        """
+            Seconds until the next retry is due, None if there are none
+        """
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - _clock(), 0)
+
+    def pop_due(self):
+        items = list()
+        with self._lock:
+            now = _clock()
+            while self._heap and self._heap[0][0] <= now:
+                items.append(heapq.heappop(self._heap)[2])
+        return items
+
+    def wait_due(self):
+        """
+            Sleeps until the next retry is due, returns all due items
+        """
+        delay = self.next_delay()
+        if delay:
+            time.sleep(delay)
+        return self.pop_due()
+
+    def requeue_due(self, queue, full=Full):
+        """
+            Puts due items on queue without blocking, the ones
+            that don't fit stay scheduled. Items are never only
+            on the way, draining sees them pending or queued.
+        """
+        with self._lock:
+            now = _clock()
+            while self._heap and self._heap[0][0] <= now:
+                try:
+                    queue.put_nowait(self._heap[0][2])
+                except full:
+                    break
+                heapq.heappop(self._heap)
+
+
+class RetryPump(Thread):
+    """
+        Puts due retries back on their queues while items are still
+        produced, so endless producers, ex: inotify_mon, retry too.
+        targets is a list of (RetryScheduler, queue).
+    """
+    def __init__(self, name, targets):
+        super(RetryPump, self).__init__(name=name + '.retries')
+        self.setDaemon(True)
+        self.targets = targets
+        self._stop_event = Event()
+
+    def _wait(self):
+        delays = [retries.next_delay() for retries, queue in self.targets]
+        delays = [delay for delay in delays if delay is not None]
+        # due items that didn't fit on a full queue are tried again shortly
+        return max(min(delays + [PUMP_INTERVAL]), 0.01)
+
+    def run(self):
+        while not self._stop_event.wait(self._wait()):
+            for retries, queue in self.targets:
+                retries.requeue_due(queue)
+
+    def stop(self):
+        """
+            Returns once no more items are put back, draining does the rest
+        """
+        self._stop_event.set()
+        self.join()
+
+
+class CircuitBreaker(object):
+    """
+        Stops runs to a destination after threshold consecutive retryable
+        failures. After cooldown seconds one trial run goes through,
+        it closes the circuit on success or opens it again on failure.
+    """
+    def __init__(self, key, threshold=DEFAULT_BREAKER_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.key = key
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = Lock()
+
+    def check(self):
+        """
+            Raises CircuitOpenError if a run can't go now
+        """
+        with self._lock:
+            if self._opened is None:
+                return
+            wait = self._opened + self.cooldown - _clock()
+            if wait > 0:
+                raise CircuitOpenError(self.key, wait)
+            if self._trial:
+                raise CircuitOpenError(self.key, min(TRIAL_WAIT, self.cooldown), True)
+            self._trial = True
+
+    def record(self, success, error=None):
+        with self._lock:
+            if success:
+                if self._opened is not None:
+                    log.info("Circuit to {0} closed".format(self.key))
+                self._failures, self._opened, self._trial = 0, None, False
+                return
+            if not is_retryable(error):
+                # the destination answered, ex: permission denied
+                if self._trial:
+                    self._failures, self._opened, self._trial = 0, None, False
+                return
+            self._failures += 1
+            if self._trial or (self._opened is None and self._failures >= self.threshold):
+                log.warning("Circuit to {0} open for {1}s after {2} failures".format(self.key, self.cooldown,
+                                                                                    self._failures))
+                self._opened, self._trial = _clock(), False
+
+
+def get_breaker(key, threshold=DEFAULT_BREAKER_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN):
+    """
+        Returns the breaker of a destination, created with threshold and cooldown on first call
+    """
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(key, threshold, cooldown)
+        return _breakers[key]
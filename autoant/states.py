@@ -0,0 +1,192 @@
+import logging
+import os
+from ._compat import pickle
+from .items import get_item_key
+from .utils import lazy_import
+
+log = logging.getLogger(__name__)
+
+# Journals are compacted when they hold this many records per live item
+JOURNAL_COMPACT_RATIO = 2
+# SQLite files are vacuumed when this fraction of pages is free
+SQLITE_VACUUM_RATIO = 0.25
+
+state_backends = dict()
+
+
+def register_state_backend(key):
+    def inner(cls):
+        state_backends[key] = cls
+        return cls
+    return inner
+
+
+def get_state_backend(key):
+    try:
+        return state_backends[key]
+    except KeyError:
+        log.critical("Unknown state backend {0}, use one of {1}".format(key, list(state_backends.keys())))
+        exit(1)
+
+
+class BaseStateBackend(object):
+    """
+        Persists the processed items of a process state.
+        record is called for every success, save at the end of a run.
+    """
+    extension = None
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def filename(self):
+        return self.name + '.' + self.extension
+
+    def load(self):
+        """
+            Returns an iterable with all persisted items
+        """
+        return []
+
+    def record(self, item):
+        pass
+
+    def save(self, items):
+        pass
+
+
+@register_state_backend('pickle')
+class PickleStateBackend(BaseStateBackend):
+    """
+        Pickles the whole list of processed items at the end of a run.
+    """
+    extension = 'sav'
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return []
+        with open(self.filename, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, items):
+        with open(self.filename, 'wb') as f:
+            pickle.dump(list(items), f)
+
+
+@register_state_backend('journal')
+class JournalStateBackend(BaseStateBackend):
+    """
+        Append only journal, every success is written and flushed
+        as it happens. Compacted on save when it holds too many
+        stale records. Migrates an existing pickle state file.
+    """
+    extension = 'jnl'
+    _fd = None
+    _records = 0
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            items = PickleStateBackend(self.name).load()
+            if items:
+                # later appends only hold new items, the journal must start with these
+                self._compact(items)
+            return items
+        items = list()
+        offset = 0
+        with open(self.filename, 'rb') as f:
+            while True:
+                try:
+                    items.append(pickle.load(f))
+                    offset = f.tell()
+                except EOFError:
+                    break
+                except Exception as e:
+                    log.warning("{0}: Truncated state journal at {1} {2}".format(self.name, offset, e))
+                    break
+        if offset != os.path.getsize(self.filename):
+            # drop a partial record left by a crash, so appends stay readable
+            with open(self.filename, 'r+b') as f:
+                f.truncate(offset)
+        self._records = len(items)
+        return items
+
+    def record(self, item):
+        if not self._fd:
+            self._fd = open(self.filename, 'ab')
+        pickle.dump(item, self._fd, pickle.HIGHEST_PROTOCOL)
+        self._fd.flush()
+        self._records += 1
+
+    def save(self, items):
+        if self._fd:
+            os.fsync(self._fd.fileno())
+            self._fd.close()
+            self._fd = None
+        items = list(items)
+        if os.path.isfile(self.filename) and self._records <= JOURNAL_COMPACT_RATIO * len(items):
+            return
+        log.debug("{0}: Compacting state journal {1} records to {2}".format(self.name, self._records, len(items)))
+        self._compact(items)
+
+    def _compact(self, items):
+        """
+            Replaces the journal with one record per item
+        """
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            for item in items:
+                pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, self.filename)
+        self._records = len(items)
+
+
+@register_state_backend('sqlite')
+class SQLiteStateBackend(BaseStateBackend):
+    """
+        SQLite file keyed by item key, every success is committed
+        as it happens. Vacuumed on save when it has too many free pages.
+        Migrates an existing pickle state file.
+    """
+    extension = 'db'
+    _conn = None
+
+    def _connect(self):
+        if not self._conn:
+            self._conn = lazy_import('sqlite3').connect(self.filename, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, item BLOB)')
+        return self._conn
+
+    def _insert(self, item):
+        self._connect().execute('INSERT OR REPLACE INTO items (key, item) VALUES (?, ?)',
+                                (repr(get_item_key(item)),
+                                 lazy_import('sqlite3').Binary(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))))
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            items = PickleStateBackend(self.name).load()
+            for item in items:
+                self._insert(item)
+            self._connect().commit()
+            return items
+        rows = self._connect().execute('SELECT item FROM items ORDER BY rowid')
+        return [pickle.loads(bytes(row[0])) for row in rows]
+
+    def record(self, item):
+        self._insert(item)
+        self._connect().commit()
+
+    def save(self, items):
+        conn = self._connect()
+        conn.commit()
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        free_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if page_count and float(free_count) / page_count > SQLITE_VACUUM_RATIO:
+            log.debug("{0}: Vacuum state file {1}".format(self.name, self.filename))
+            conn.execute('VACUUM')
+        conn.close()
+        self._conn = None
@@ -1,5 +1,24 @@
 import os
 import re
+import stat
+from threading import Thread, Event
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+_lazy_modules = dict()
 
 
 def sub_list(x, y):
@@ -10,6 +29,36 @@ def boolstr(str):
     return str == 'True'
 
 
+def sizestr(str):
+    """
+        Parses a byte count with an optional K, M or G suffix, ex: "10M"
+    """
+    str = str.strip().upper().rstrip('B')
+    multiplier = 1
+    if str and str[-1] in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[str[-1]]
+        str = str[:-1]
+    return int(float(str) * multiplier)
+
+
+def lazy_import(name, attr=None):
+    """
+        Imports module name on first call, returns it or its attr,
+        None if it's not installed. For slow to import optional
+        libraries only some processors need, ex: paramiko.
+    """
+    if name not in _lazy_modules:
+        try:
+            module = __import__(name, fromlist=['__name__'])
+        except Exception:
+            module = None
+        _lazy_modules[name] = module
+    module = _lazy_modules[name]
+    if module is None or attr is None:
+        return module
+    return getattr(module, attr, None)
+
+
 def walklevel(some_dir, level=-1):
     if some_dir != '/':
         some_dir = some_dir.rstrip(os.path.sep)
@@ -30,3 +79,142 @@ def walkfiles(directory, file_filter=".*", level=-1):
                     not os.path.islink(file_name):
                 yield file_name
 
+
+
+def listdir_stat(directory):
+    """
+        Lists one directory, returns a tuple (files, dirs).
+        files is a list of (file_name, stat_result) and dirs a list of
+        directory names, symlinks are skipped. Issues at most one stat per file.
+    """
+    files, dirs = list(), list()
+    try:
+        if scandir:
+            for entry in scandir(directory):
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                else:
+                    files.append((entry.path, entry.stat(follow_symlinks=False)))
+        else:
+            for name in os.listdir(directory):
+                file_name = os.path.join(directory, name)
+                stat_result = os.lstat(file_name)
+                if stat.S_ISLNK(stat_result.st_mode):
+                    continue
+                if stat.S_ISDIR(stat_result.st_mode):
+                    dirs.append(file_name)
+                else:
+                    files.append((file_name, stat_result))
+    except OSError:
+        # same has os.walk, unreadable directories are ignored
+        pass
+    return files, dirs
+
+
+def walkfiles_stat(directory, file_filter=".*", level=-1, dir_include=None, dir_exclude=None, on_dir=None,
+                   list_dir=listdir_stat):
+    """
+        Same has walkfiles, but yields (file_name, stat_result)
+        reusing the directory listing stat. Sub directories
+        not matching dir_include or matching dir_exclude are not entered.
+        Filters can be strings or compiled regular expressions.
+        on_dir is called with (dir_name, depth) before listing each directory,
+        list_dir lists them, see listdir_stat.
+    """
+    if directory != '/':
+        directory = directory.rstrip(os.path.sep)
+    file_filter = re.compile(file_filter)
+    dir_include = dir_include and re.compile(dir_include)
+    dir_exclude = dir_exclude and re.compile(dir_exclude)
+    stack = [(directory, 0)]
+    while stack:
+        root, depth = stack.pop()
+        if on_dir:
+            on_dir(root, depth)
+        files, dirs = list_dir(root)
+        for file_name, stat_result in files:
+            if file_filter.match(file_name):
+                yield file_name, stat_result
+        if level != -1 and depth >= level:
+            continue
+        for dir_name in reversed(dirs):
+            if dir_include and not dir_include.match(dir_name):
+                continue
+            if dir_exclude and dir_exclude.match(dir_name):
+                continue
+            stack.append((dir_name, depth + 1))
+
+
+def walkfiles_parallel(directory, file_filter=".*", level=-1, dir_include=None, dir_exclude=None,
+                       list_dir=listdir_stat, threads=4, ordered=False):
+    """
+        Same has walkfiles_stat, but directories are listed by a pool of threads.
+        If not ordered files are yielded as soon has their directory is listed,
+        if ordered they are yielded on the same order has walkfiles_stat,
+        while the following directories are listed ahead.
+    """
+    if directory != '/':
+        directory = directory.rstrip(os.path.sep)
+    file_filter = re.compile(file_filter)
+    dir_include = dir_include and re.compile(dir_include)
+    dir_exclude = dir_exclude and re.compile(dir_exclude)
+    tasks, results = Queue(), Queue()
+    stop = Event()
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None or stop.is_set():
+                break
+            root, depth = task
+            try:
+                listing = list_dir(root)
+            except Exception:
+                listing = ([], [])
+            results.put((root, depth, listing))
+
+    def sub_dirs(depth, dirs):
+        if level != -1 and depth >= level:
+            return []
+        return [(dir_name, depth + 1) for dir_name in dirs
+                if not (dir_include and not dir_include.match(dir_name)) and
+                not (dir_exclude and dir_exclude.match(dir_name))]
+
+    workers = [Thread(target=worker, name='walk.{0}'.format(i)) for i in range(threads)]
+    for thread in workers:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        tasks.put((directory, 0))
+        if not ordered:
+            pending = 1
+            while pending:
+                root, depth, (files, dirs) = results.get()
+                pending -= 1
+                for task in sub_dirs(depth, dirs):
+                    tasks.put(task)
+                    pending += 1
+                for file_name, stat_result in files:
+                    if file_filter.match(file_name):
+                        yield file_name, stat_result
+        else:
+            listings = dict()
+            stack = [(directory, 0)]
+            while stack:
+                root, depth = stack.pop()
+                while root not in listings:
+                    listed_root, listed_depth, listing = results.get()
+                    listings[listed_root] = listing
+                    for task in sub_dirs(listed_depth, listing[1]):
+                        tasks.put(task)
+                files, dirs = listings.pop(root)
+                for file_name, stat_result in files:
+                    if file_filter.match(file_name):
+                        yield file_name, stat_result
+                stack.extend(reversed(sub_dirs(depth, dirs)))
+    finally:
+        stop.set()
+        for thread in workers:
+            tasks.put(None)
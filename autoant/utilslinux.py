@@ -6,9 +6,17 @@ import os
 import errno
 import sys
 import stat
+import time
+import select
+import struct
+from threading import Lock
+from .utils import lazy_import
 
 PY3 = sys.version_info[0] == 3
 
+# pid of the AutoAnt process, pool workers are forked from it
+_main_pid = os.getpid()
+
 if PY3:
     def u(s):
         return s
@@ -28,6 +36,13 @@ def pids():
     return [int(x) for x in os.listdir(b('/proc')) if x.isdigit()]
 
 
+def parent_pid(pid):
+    """Returns the parent PID of pid."""
+    with open('/proc/%s/stat' % pid) as f:
+        # comm, the second field, is in parentheses and may have spaces
+        return int(f.read().rsplit(')', 1)[1].split()[1])
+
+
 def isfile_strict(path):
     """Same as os.path.isfile() but does not swallow EACCES / EPERM
     exceptions, see:
@@ -44,19 +59,22 @@ def isfile_strict(path):
         return stat.S_ISREG(st.st_mode)
 
 
-def open_files(pid):
+def open_files(pid, regular_only=True):
+        """Returns the files open by pid. With regular_only False
+        every absolute path is returned, saving one stat per fd.
+        """
         retlist = []
         files = os.listdir("/proc/%s/fd" % pid)
         hit_enoent = False
         for fd in files:
             file = "/proc/%s/fd/%s" % (pid, fd)
-            if os.path.islink(file):
+            if not regular_only or os.path.islink(file):
                 try:
                     file = os.readlink(file)
                 except OSError:
                     # ENOENT == file which is gone in the meantime
                     err = sys.exc_info()[1]
-                    if err.errno in (errno.ENOENT, errno.ESRCH):
+                    if err.errno in (errno.ENOENT, errno.ESRCH, errno.EINVAL):
                         hit_enoent = True
                         continue
                     raise
@@ -65,7 +83,7 @@ def open_files(pid):
                     # to tell whether it's a regular file or not,
                     # so we skip it. A regular file is always supposed
                     # to be absolutized though.
-                    if file.startswith('/') and isfile_strict(file):
+                    if file.startswith('/') and (not regular_only or isfile_strict(file)):
                         retlist.append(str(file))
         if hit_enoent:
             # raise NSP if the process disappeared on us
@@ -82,3 +100,168 @@ def is_file_open(full_path):
         except Exception as e:
             continue
     return False
+
+
+class OpenFileIndex(object):
+    """Set of the files open by running processes, a snapshot rebuilt
+    at most once every ttl seconds so lookups are O(1). It's a TTL cache,
+    not an incremental index: /proc tells nothing about fd table changes
+    and fd numbers are reused, so every refresh reads the fds of all
+    wanted processes again. A file found open in the snapshot is checked
+    again on the processes holding it, closed files are not reported until
+    the next refresh. Only processes owned by uid and named on names are
+    read, when those are given. This process and its pool workers are never
+    read, files open by an earlier stage of the same run aren't "open".
+    Filtered out processes are remembered and not read again while they live.
+    """
+    def __init__(self, ttl=0, uid=None, names=None):
+        self.ttl = ttl
+        self.uid = uid
+        self.names = set(names) if names else None
+        self._lock = Lock()
+        self._pid_files = dict()
+        self._ignored = set()
+        # path: pids having it open
+        self._paths = dict()
+        self._refreshed = None
+
+    @staticmethod
+    def _is_worker(pid):
+        """Pool workers are forked from the AutoAnt process without exec,
+        they have its command line.
+        """
+        if parent_pid(pid) != _main_pid:
+            return False
+        with open('/proc/%s/cmdline' % pid, 'rb') as f:
+            cmdline = f.read()
+        with open('/proc/%s/cmdline' % _main_pid, 'rb') as f:
+            return cmdline == f.read()
+
+    def _is_wanted(self, pid):
+        try:
+            if pid in (os.getpid(), _main_pid) or self._is_worker(pid):
+                return False
+            if self.uid is not None and os.stat('/proc/%s' % pid).st_uid != self.uid:
+                return False
+            if self.names is not None:
+                with open('/proc/%s/comm' % pid) as f:
+                    if f.read().strip() not in self.names:
+                        return False
+        except (IOError, OSError):
+            return False
+        return True
+
+    def refresh(self):
+        running = set(pids())
+        for pid in list(self._pid_files):
+            if pid not in running:
+                del self._pid_files[pid]
+        self._ignored &= running
+        for pid in running:
+            if pid in self._ignored:
+                continue
+            if pid not in self._pid_files and not self._is_wanted(pid):
+                self._ignored.add(pid)
+                continue
+            try:
+                self._pid_files[pid] = open_files(pid, regular_only=False)
+            except Exception:
+                self._pid_files.pop(pid, None)
+        self._paths = dict()
+        for pid, files in self._pid_files.items():
+            for path in files:
+                self._paths.setdefault(path, set()).add(pid)
+        self._refreshed = time.time()
+
+    def _recheck(self, full_path):
+        """Reads the fds of the processes the snapshot has full_path open by,
+        forgets the ones that closed it.
+        """
+        holders = self._paths[full_path]
+        for pid in list(holders):
+            try:
+                if full_path in open_files(pid, regular_only=False):
+                    return True
+            except Exception:
+                pass
+            holders.discard(pid)
+        del self._paths[full_path]
+        return False
+
+    def is_open(self, full_path):
+        with self._lock:
+            if self._refreshed is None or time.time() - self._refreshed >= self.ttl:
+                self.refresh()
+            return full_path in self._paths and self._recheck(full_path)
+
+
+_open_file_indexes = dict()
+_open_file_indexes_lock = Lock()
+
+
+def get_open_file_index(ttl=0, uid=None, names=None):
+    """Returns the OpenFileIndex shared by all callers with the same arguments."""
+    key = (ttl, uid, tuple(sorted(names or [])))
+    with _open_file_indexes_lock:
+        if key not in _open_file_indexes:
+            _open_file_indexes[key] = OpenFileIndex(ttl, uid, names)
+        return _open_file_indexes[key]
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+_inotify_event = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal ctypes binding to the Linux inotify API."""
+    def __init__(self):
+        self._ctypes = lazy_import('ctypes')
+        libc_name = lazy_import('ctypes.util').find_library('c') or 'libc.so.6'
+        self._libc = self._ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        if not isinstance(path, bytes):
+            path = path.encode('utf-8')
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = self._ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self, timeout=None):
+        """Waits at most timeout seconds for events, returns a list
+        of (wd, mask, cookie, name) tuples.
+        """
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except (select.error, OSError):
+            # interrupted by a signal
+            return []
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = data[offset:offset + length].rstrip(b('\0'))
+            offset += length
+            if PY3:
+                name = os.fsdecode(name)
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,73 @@
+"""
+    cp processor copy benchmark, compares shutil.copyfile with
+    fastcopy.copy_file forced to start at each of its methods.
+
+    usage: python benchmarks/bench_copy.py [--size-mb 512] [--dest-dir /other/filesystem]
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from autoant import fastcopy
+from autoant.fastcopy import copy_file, COPY_METHODS
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def bench(name, copy, src, dst):
+    t1, c1 = time.time(), cpu_time()
+    method = copy(src, dst)
+    elapsed, cpu = time.time() - t1, cpu_time() - c1
+    size_mb = os.path.getsize(src) / (1024.0 * 1024)
+    print("{0:>16}: {1:.3f}s, {2:.3f}s cpu, {3:.0f} MB/s, used {4}".format(name, elapsed, cpu,
+                                                                        size_mb / max(elapsed, 1e-6), method))
+    os.remove(dst)
+
+
+def skip_methods(methods):
+    """
+        Copies with copy_file marking methods as not supported
+    """
+    def copy(src, dst):
+        devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+        fastcopy._unsupported.clear()
+        fastcopy._unsupported.update((method,) + devices for method in methods)
+        return copy_file(src, dst)
+    return copy
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cp processor copy benchmark')
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--dest-dir', default=None, help='Destination directory, default is next to the source')
+    args = parser.parse_args()
+    src_dir = tempfile.mkdtemp(prefix='autoant_bench_')
+    dest_dir = tempfile.mkdtemp(prefix='autoant_bench_', dir=args.dest_dir)
+    src = os.path.join(src_dir, 'src.dat')
+    dst = os.path.join(dest_dir, 'dst.dat')
+    try:
+        block = os.urandom(1024 * 1024)
+        with open(src, 'wb') as f:
+            for i in range(args.size_mb):
+                f.write(block)
+
+        bench('shutil.copyfile', lambda s, d: shutil.copyfile(s, d) and 'shutil', src, dst)
+        for i, method in enumerate(COPY_METHODS):
+            bench(method, skip_methods(COPY_METHODS[:i]), src, dst)
+        fastcopy._unsupported.clear()
+    finally:
+        shutil.rmtree(src_dir)
+        shutil.rmtree(dest_dir)
+
+
+if __name__ == '__main__':
+    main()
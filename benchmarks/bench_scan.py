@@ -0,0 +1,140 @@
+"""
+    DirMon scan benchmark, counts stat family syscalls per file.
+
+    Compares the scandir walker used by DirMon with the previous
+    walkfiles + FileItem.check_*time + FileItem path, the parallel
+    walker, and a second DirMon scan replayed from its directory manifest.
+
+    usage: python benchmarks/bench_scan.py [--files 10000] [--depth 3] [--mtime 5] [--walk-threads 4]
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from autoant import utils
+from autoant.items import FileItem
+from autoant.producers import DirMon
+from autoant.utils import walkfiles
+from trees import make_tree
+
+
+class SyscallCounter(object):
+    """
+        Counts os.stat, os.lstat, os.listdir, scandir and DirEntry.stat calls
+    """
+    def __init__(self):
+        self.counts = dict()
+        self._saved = list()
+
+    def _count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _wrap(self, module, attr):
+        func = getattr(module, attr)
+        self._saved.append((module, attr, func))
+
+        def wrapper(*args, **kwargs):
+            self._count(attr)
+            return func(*args, **kwargs)
+        setattr(module, attr, wrapper)
+
+    def __enter__(self):
+        self._wrap(os, 'stat')
+        self._wrap(os, 'lstat')
+        self._wrap(os, 'listdir')
+        if utils.scandir:
+            scandir = utils.scandir
+            counter = self
+
+            class Entry(object):
+                def __init__(self, entry):
+                    self._entry = entry
+
+                def __getattr__(self, name):
+                    return getattr(self._entry, name)
+
+                def stat(self, **kwargs):
+                    counter._count('DirEntry.stat')
+                    return self._entry.stat(**kwargs)
+
+            def wrapper(path):
+                counter._count('scandir')
+                return [Entry(entry) for entry in scandir(path)]
+            self._saved.append((utils, 'scandir', scandir))
+            utils.scandir = wrapper
+        return self
+
+    def __exit__(self, *args):
+        for module, attr, func in reversed(self._saved):
+            setattr(module, attr, func)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+def old_scan(basedir, mtime):
+    for file_name in walkfiles(basedir, '.*', -1):
+        if FileItem.check_mtime(file_name, mtime) and \
+                FileItem.check_atime(file_name, 0) and \
+                FileItem.check_ctime(file_name, 0):
+            yield FileItem(file_name, basedir)
+
+
+def new_scan(basedir, mtime):
+    return DirMon(name='BENCH', type_key='dir_mon', basedir=basedir, mtime=str(mtime)).generator()
+
+
+def parallel_scan(threads):
+    def scan(basedir, mtime):
+        return DirMon(name='BENCH', type_key='dir_mon', basedir=basedir, mtime=str(mtime),
+                      walk_threads=str(threads)).generator()
+    return scan
+
+
+def manifest_scan(basedir, mtime):
+    # the manifest is written next to basedir, not inside it
+    return DirMon(name=basedir + '_BENCH', type_key='dir_mon', basedir=basedir,
+                  mtime=str(mtime), manifest='True').generator()
+
+
+def bench(name, scan, basedir, mtime, files):
+    with SyscallCounter() as counter:
+        t1 = time.time()
+        produced = sum(1 for item in scan(basedir, mtime))
+        elapsed = time.time() - t1
+    print("{0:>4}: {1} items, {2:.3f}s, {3:.2f} stat calls/file {4}".format(name, produced, elapsed,
+                                                                           float(counter.total) / files,
+                                                                           sorted(counter.counts.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DirMon scan benchmark')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--mtime', type=int, default=-5, help='DirMon mtime filter in minutes')
+    parser.add_argument('--walk-threads', type=int, default=4, help='DirMon walk_threads for the parallel scan')
+    args = parser.parse_args()
+    basedir = tempfile.mkdtemp(prefix='autoant_bench_')
+    try:
+        make_tree(basedir, args.files, args.depth)
+        bench('old', old_scan, basedir, args.mtime, args.files)
+        bench('new', new_scan, basedir, args.mtime, args.files)
+        bench('par', parallel_scan(args.walk_threads), basedir, args.mtime, args.files)
+        # first scan writes the manifest, the second one replays it
+        sum(1 for item in manifest_scan(basedir, args.mtime))
+        bench('man', manifest_scan, basedir, args.mtime, args.files)
+    finally:
+        shutil.rmtree(basedir)
+        if os.path.exists(basedir + '_BENCH.manifest'):
+            os.remove(basedir + '_BENCH.manifest')
+
+
+if __name__ == '__main__':
+    main()
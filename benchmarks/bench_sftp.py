@@ -0,0 +1,96 @@
+"""
+    scp processor upload throughput benchmark, against a local
+    asyncssh SFTP stand-in behind a proxy adding latency.
+
+    Compares paramiko's sftp.put with the scp processor tuning
+    properties: pipelined, block_size, window_size and parallel_chunks.
+
+    usage: python benchmarks/bench_sftp.py [--size-mb 64] [--latency-ms 20]
+"""
+from __future__ import print_function
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from autoant.items import FileItem
+from autoant.pool import close_pools
+from autoant.processors import ProcessorSCP
+from standins import SFTPStandIn, LatencyProxy, USERNAME, PASSWORD
+
+SCENARIOS = (
+    ('paramiko put', None),
+    ('default', {}),
+    ('not pipelined', {'pipelined': 'False'}),
+    ('block 256K', {'block_size': str(256 * 1024)}),
+    ('window 16M', {'window_size': str(16 * 1024 * 1024)}),
+    ('parallel 4', {'parallel_chunks': '4', 'parallel_min_size': '1'}),
+    ('parallel 4 block 256K', {'parallel_chunks': '4', 'parallel_min_size': '1',
+                               'block_size': str(256 * 1024)}),
+)
+
+
+def make_processor(port, remote_dir, properties):
+    kwargs = dict(name='BENCH', mon_name='SFTP', remote_host='127.0.0.1', remote_port=str(port),
+                  remote_dir=remote_dir, username=USERNAME, password=PASSWORD, state='False')
+    kwargs.update(properties)
+    return ProcessorSCP(**kwargs)
+
+
+def paramiko_put(processor, file_item):
+    ssh, sftp = processor.open_connection()
+    try:
+        sftp.put(file_item.full_path, processor.remote_dir + file_item.name)
+    finally:
+        processor.close_connection((ssh, sftp))
+    return True
+
+
+def bench(name, properties, port, file_item, size_mb):
+    processor = make_processor(port, '/', properties or {})
+    t1 = time.time()
+    if properties is None:
+        success = paramiko_put(processor, file_item)
+    else:
+        success = processor.run(file_item)
+    elapsed = time.time() - t1
+    # every scenario opens its own connection
+    close_pools()
+    print("{0:>22}: {1:.2f}s, {2:.1f} MB/s{3}".format(name, elapsed, size_mb / elapsed,
+                                                       '' if success else ' FAILED'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='scp processor upload benchmark')
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=20, help='Added each way')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    local_dir = tempfile.mkdtemp(prefix='autoant_bench_')
+    remote_root = tempfile.mkdtemp(prefix='autoant_bench_remote_')
+    try:
+        file_name = os.path.join(local_dir, 'upload.dat')
+        block = os.urandom(1024 * 1024)
+        with open(file_name, 'wb') as f:
+            for i in range(args.size_mb):
+                f.write(block)
+        file_item = FileItem(file_name, local_dir + '/')
+        server = SFTPStandIn(remote_root).start()
+        proxy = LatencyProxy(server.port, args.latency_ms / 1000.0).start()
+        print("{0} MB file, {1} ms latency each way".format(args.size_mb, args.latency_ms))
+        for name, properties in SCENARIOS:
+            bench(name, properties, proxy.port, file_item, args.size_mb)
+        proxy.stop()
+        server.stop()
+    finally:
+        shutil.rmtree(local_dir)
+        shutil.rmtree(remote_root)
+
+
+if __name__ == '__main__':
+    main()
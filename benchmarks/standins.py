@@ -0,0 +1,202 @@
+"""
+    Local FTP and SFTP servers, stand-ins for remote hosts on
+    benchmarks and manual tests of the ftp and scp processors.
+
+    FTP needs pyftpdlib, SFTP needs asyncssh (Python 3).
+    Both serve a local directory, with user 'autoant' password 'autoant'.
+
+    usage: python benchmarks/standins.py /tmp/remote_root
+"""
+from __future__ import print_function
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+USERNAME = 'autoant'
+PASSWORD = 'autoant'
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class FTPStandIn(object):
+    """
+        pyftpdlib FTP server on a thread
+    """
+    def __init__(self, root, port=None):
+        self.root = root
+        self.port = port or free_port()
+        self._server = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def _serve(self):
+        # polls once per call, so stop can end the loop before the sockets are closed
+        while not self._stopping.is_set():
+            self._server.serve_forever(timeout=0.1, blocking=False, handle_exit=False)
+
+    def start(self):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USERNAME, PASSWORD, self.root, perm='elradfmwMT')
+        handler = type('StandInHandler', (FTPHandler,), {'authorizer': authorizer})
+        self._server = ThreadedFTPServer(('127.0.0.1', self.port), handler)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self._server.close_all()
+
+
+class SFTPStandIn(object):
+    """
+        asyncssh SFTP server on a thread with its own event loop,
+        paths are chrooted to root.
+    """
+    def __init__(self, root, port=None):
+        self.root = root
+        self.port = port or free_port()
+        self._loop = None
+        self._server = None
+
+    def start(self):
+        import asyncio
+        import asyncssh
+        key = asyncssh.generate_private_key('ssh-rsa')
+        root = self.root
+        started = threading.Event()
+
+        class Server(asyncssh.SSHServer):
+            def password_auth_supported(self):
+                return True
+
+            def validate_password(self, username, password):
+                return username == USERNAME and password == PASSWORD
+
+        def sftp_factory(chan):
+            return asyncssh.SFTPServer(chan, chroot=root.encode('utf-8'))
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            # no async syntax, this module is imported by Python 2 benchmarks too
+            self._server = self._loop.run_until_complete(
+                asyncssh.listen('127.0.0.1', self.port, server_host_keys=[key],
+                                server_factory=Server, sftp_factory=sftp_factory))
+            started.set()
+            self._loop.run_forever()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        started.wait(10)
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._server.close)
+
+
+class LatencyProxy(object):
+    """
+        TCP proxy adding delay seconds each way, stands for a WAN link
+        in front of a stand-in server.
+    """
+    def __init__(self, target_port, delay, port=None):
+        self.target_port = target_port
+        self.delay = delay
+        self.port = port or free_port()
+        self._sock = None
+
+    def _pipe(self, source, destination):
+        try:
+            from queue import Queue
+        except ImportError:
+            from Queue import Queue
+        pending = Queue()
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(65536)
+                except socket.error:
+                    data = b''
+                pending.put((time.time() + self.delay, data))
+                if not data:
+                    break
+
+        def write():
+            while True:
+                due, data = pending.get()
+                wait = due - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                if not data:
+                    break
+                try:
+                    destination.sendall(data)
+                except socket.error:
+                    break
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+        for target in (read, write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, address = self._sock.accept()
+            except socket.error:
+                break
+            server = socket.create_connection(('127.0.0.1', self.target_port))
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._pipe(client, server)
+            self._pipe(server, client)
+
+    def start(self):
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', self.port))
+        self._sock.listen(16)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._sock.close()
+
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp(prefix='autoant_remote_')
+    ftp = FTPStandIn(root).start()
+    sftp = SFTPStandIn(root).start()
+    print("Serving {0} user {1} password {2}".format(root, USERNAME, PASSWORD))
+    print("FTP on 127.0.0.1:{0} SFTP on 127.0.0.1:{1}".format(ftp.port, sftp.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
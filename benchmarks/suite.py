@@ -0,0 +1,334 @@
+"""
+    Benchmark suite, times DirMon scans, state load and save, and the
+    cp, move, rename, echo, ftp and scp processors on a synthetic tree.
+
+    ftp and scp run against the local stand-ins of standins.py, they are
+    skipped when pyftpdlib or asyncssh (Python 3) are missing.
+    Each benchmark runs repeat times and keeps the fastest run.
+
+    Results are written as JSON with --output. With --baseline the files/s
+    and MB/s of each benchmark are compared to a previous result, the exit
+    code is 1 if any is slower by more than tolerance.
+
+    usage: python benchmarks/suite.py [--files 2000] [--depth 3] [--min-size 1K] [--max-size 1M]
+                                      [--threads 1] [--repeat 3] [--only scan,cp]
+                                      [--output result.json] [--baseline baseline.json]
+"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from autoant.pool import close_pools
+from autoant.processors import ProcessSequence, ProcessorCopy, ProcessorMove, ProcessorRename, \
+    ProcessorEcho, ProcessorFTP, ProcessorSCP
+from autoant.producers import DirMon
+from autoant.states import state_backends
+from autoant.utils import sizestr
+from autoant.version import VERSION_STRING
+from standins import FTPStandIn, SFTPStandIn, USERNAME, PASSWORD
+from trees import make_tree
+
+log = logging.getLogger('benchmarks')
+
+DEFAULT_TOLERANCE = 0.1
+# compared with the baseline, higher is better
+RATES = ('files_per_sec', 'mb_per_sec')
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class Suite(object):
+    """
+        Runs benchmarks on a work directory, source trees are shared
+        by benchmarks that don't change them.
+    """
+    def __init__(self, workdir, args):
+        self.workdir = workdir
+        self.args = args
+        self.standins = dict()
+        self._runs = 0
+        self._tree = None
+        self._tree_size = 0
+
+    def path(self, name):
+        self._runs += 1
+        return os.path.join(self.workdir, '{0}{1}'.format(name, self._runs))
+
+    def new_tree(self):
+        basedir = self.path('tree')
+        size = make_tree(basedir, self.args.files, self.args.depth, self.args.width,
+                         self.args.min_size, self.args.max_size, self.args.seed)
+        return basedir + '/', size
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree, self._tree_size = self.new_tree()
+        return self._tree
+
+    def scan(self, basedir):
+        return list(DirMon(name='BENCH', type_key='dir_mon', basedir=basedir).generator())
+
+    def processor(self, processor_class, name, **kwargs):
+        return processor_class(name=name, mon_name='BENCH', threads=str(self.args.threads), state='False',
+                               **kwargs)
+
+    def run_processor(self, processor, items):
+        sequence = ProcessSequence()
+        sequence.add_process(processor)
+        t1 = time.time()
+        sequence.run(lambda: iter(items))
+        elapsed = time.time() - t1
+        # each run opens its own connections
+        close_pools()
+        return elapsed
+
+    def bench_scan(self):
+        basedir = self.tree
+        t1 = time.time()
+        items = self.scan(basedir)
+        return time.time() - t1, len(items), 0
+
+    def bench_state(self, backend):
+        """
+            Saves then loads the scanned items, returns both timings
+        """
+        items = self.scan(self.tree)
+        name = self.path('state')
+        t1 = time.time()
+        state = state_backends[backend](name)
+        for item in items:
+            state.record(item)
+        state.save(items)
+        save_seconds = time.time() - t1
+        t1 = time.time()
+        loaded = list(state_backends[backend](name).load())
+        return save_seconds, time.time() - t1, len(loaded)
+
+    def bench_cp(self):
+        items = self.scan(self.tree)
+        dest_dir = self.path('cp') + '/'
+        processor = self.processor(ProcessorCopy, 'CP', dest_dir=dest_dir)
+        return self.run_processor(processor, items), count_files(dest_dir), self._tree_size
+
+    def bench_move(self):
+        basedir = self.new_tree()[0]
+        items = self.scan(basedir)
+        dest_dir = self.path('move') + '/'
+        processor = self.processor(ProcessorMove, 'MOVE', dest_dir=dest_dir)
+        # a rename on the same filesystem, no bytes are moved
+        return self.run_processor(processor, items), count_files(dest_dir), 0
+
+    def bench_rename(self):
+        basedir = self.new_tree()[0]
+        items = self.scan(basedir)
+        processor = self.processor(ProcessorRename, 'RENAME', rule_origin=r'\.dat$', rule_destination='.ren')
+        elapsed = self.run_processor(processor, items)
+        return elapsed, count_files(basedir, '.ren'), 0
+
+    def bench_echo(self):
+        items = self.scan(self.tree)
+        stdout = self.path('echo')
+        processor = self.processor(ProcessorEcho, 'ECHO', stdout=stdout)
+        elapsed = self.run_processor(processor, items)
+        with io.open(stdout) as f:
+            return elapsed, sum(1 for line in f), 0
+
+    def standin(self, protocol):
+        """
+            Starts the protocol stand-in on first use, returns (root, port)
+        """
+        if protocol not in self.standins:
+            root = self.path(protocol + '_root')
+            os.mkdir(root)
+            standin = FTPStandIn if protocol == 'ftp' else SFTPStandIn
+            try:
+                self.standins[protocol] = (root, standin(root).start())
+            except ImportError as e:
+                self.standins[protocol] = (root, None)
+                log.warning("No {0} stand-in {1}".format(protocol, e))
+        root, server = self.standins[protocol]
+        if server is None:
+            raise SkipBenchmark()
+        return root, server.port
+
+    def bench_remote(self, protocol, processor_class):
+        root, port = self.standin(protocol)
+        items = self.scan(self.tree)
+        remote_dir = '/' + os.path.basename(self.path(protocol)) + '/'
+        processor = self.processor(processor_class, protocol.upper(), remote_host='127.0.0.1',
+                                   remote_port=str(port), remote_dir=remote_dir, username=USERNAME,
+                                   password=PASSWORD)
+        elapsed = self.run_processor(processor, items)
+        return elapsed, count_files(root + remote_dir), self._tree_size
+
+    def stop(self):
+        for root, server in self.standins.values():
+            if server is not None:
+                server.stop()
+
+
+def count_files(path, suffix=''):
+    return sum(1 for root, dirs, files in os.walk(path) for name in files if name.endswith(suffix))
+
+
+def result(seconds, files, size):
+    return {'seconds': round(seconds, 6),
+            'files': files,
+            'files_per_sec': round(files / seconds, 3) if seconds else None,
+            'mb_per_sec': round(size / 1048576.0 / seconds, 3) if seconds and size else None}
+
+
+def best(runs):
+    """
+        Keeps the fastest run, with all run times
+    """
+    fastest = min(runs, key=lambda run: run['seconds'])
+    fastest['runs'] = [run['seconds'] for run in runs]
+    return fastest
+
+
+def benchmarks(suite):
+    """
+        (name, function returning a list of (name, result)) in run order
+    """
+    def single(name, bench):
+        def run():
+            return [(name, result(*bench()))]
+        return name, run
+
+    def state(backend):
+        def run():
+            save_seconds, load_seconds, files = suite.bench_state(backend)
+            return [('state_{0}_save'.format(backend), result(save_seconds, files, 0)),
+                    ('state_{0}_load'.format(backend), result(load_seconds, files, 0))]
+        return 'state_' + backend, run
+
+    return ([single('scan', suite.bench_scan)] +
+            [state(backend) for backend in sorted(state_backends.keys())] +
+            [single('cp', suite.bench_cp),
+             single('move', suite.bench_move),
+             single('rename', suite.bench_rename),
+             single('echo', suite.bench_echo),
+             single('ftp', lambda: suite.bench_remote('ftp', ProcessorFTP)),
+             single('scp', lambda: suite.bench_remote('scp', ProcessorSCP))])
+
+
+def run_suite(args):
+    workdir = tempfile.mkdtemp(prefix='autoant_bench_', dir=args.workdir)
+    suite = Suite(workdir, args)
+    results = dict()
+    try:
+        for name, run in benchmarks(suite):
+            if args.only and not any(name.startswith(only) for only in args.only):
+                continue
+            runs = dict()
+            try:
+                for i in range(args.repeat):
+                    for result_name, run_result in run():
+                        runs.setdefault(result_name, list()).append(run_result)
+            except SkipBenchmark:
+                continue
+            for result_name, result_runs in runs.items():
+                results[result_name] = best(result_runs)
+                if results[result_name]['files'] != args.files:
+                    log.warning("{0}: {1} of {2} files done".format(result_name, results[result_name]['files'],
+                                                                    args.files))
+    finally:
+        suite.stop()
+        close_pools()
+        shutil.rmtree(workdir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+        Returns {name: {rate: change}} of rates slower than baseline by more than tolerance
+    """
+    regressions = dict()
+    for name, run_result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for rate in RATES:
+            if not run_result.get(rate) or not base.get(rate):
+                continue
+            change = run_result[rate] / base[rate] - 1
+            run_result.setdefault('baseline', dict())[rate] = round(change, 4)
+            if change < -tolerance:
+                regressions.setdefault(name, dict())[rate] = change
+    return regressions
+
+
+def print_results(results, regressions):
+    print("{0:>20} {1:>10} {2:>7} {3:>11} {4:>10}   {5}".format('benchmark', 'seconds', 'files',
+                                                               'files/s', 'MB/s', 'vs baseline'))
+    for name in sorted(results):
+        run_result = results[name]
+        changes = ', '.join("{0} {1:+.1%}{2}".format(rate, change, ' REGRESSION'
+                                                     if rate in regressions.get(name, ()) else '')
+                            for rate, change in sorted(run_result.get('baseline', dict()).items()))
+        print("{0:>20} {1:>10.3f} {2:>7} {3:>11} {4:>10}   {5}".format(name, run_result['seconds'],
+                                                                      run_result['files'],
+                                                                      run_result['files_per_sec'] or '-',
+                                                                      run_result['mb_per_sec'] or '-',
+                                                                      changes).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AutoAnt benchmark suite')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=3, help='Levels of sub directories')
+    parser.add_argument('--width', type=int, default=4, help='Sub directories per directory')
+    parser.add_argument('--min-size', type=sizestr, default='1K', help='Smallest file size, ex: 1K')
+    parser.add_argument('--max-size', type=sizestr, default='1M', help='Largest file size, ex: 1M')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the file sizes and contents')
+    parser.add_argument('--threads', type=int, default=1, help='Threads of each processor')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark, the fastest is kept')
+    parser.add_argument('--only', type=lambda value: value.split(','), default=None,
+                        help='Comma separated benchmarks to run, ex: scan,state,cp')
+    parser.add_argument('--workdir', default=None, help='Where trees are created, default is the temp dir')
+    parser.add_argument('--output', default=None, help='Writes the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Slowdown of files/s or MB/s reported as a regression, ex: 0.1 is 10%%')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    params = dict((name, getattr(args, name)) for name in ('files', 'depth', 'width', 'min_size', 'max_size',
+                                                           'seed', 'threads', 'repeat'))
+    results = run_suite(args)
+    regressions = dict()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            log.warning("Baseline params {0} differ from {1}".format(baseline.get('params'), params))
+        regressions = compare(results, baseline.get('results', dict()), args.tolerance)
+    print_results(results, regressions)
+    if args.output:
+        report = {'autoant': VERSION_STRING,
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'params': params,
+                  'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True, separators=(',', ': '))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+    Synthetic directory trees for benchmarks. The same arguments
+    and seed always give the same directories, names, sizes and contents.
+"""
+import binascii
+import math
+import os
+import random
+import time
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def file_sizes(files, min_size, max_size, seed=0):
+    """
+        files sizes between min_size and max_size, log-uniform
+        like real trees: many small files and a few large ones
+    """
+    rng = random.Random(seed)
+    if min_size >= max_size:
+        return [max_size] * files
+    low, high = math.log(max(min_size, 1)), math.log(max_size)
+    return [int(math.exp(rng.uniform(low, high))) for i in range(files)]
+
+
+def random_block(size, seed=0):
+    """
+        size bytes from a random.Random seeded with seed
+    """
+    bits = random.Random(seed).getrandbits(size * 8)
+    return binascii.unhexlify('{0:0{1}x}'.format(bits, size * 2))
+
+
+def make_tree(basedir, files, depth, width=4, min_size=1, max_size=1, seed=0):
+    """
+        Creates files spread over width ** depth leaf directories,
+        returns the total size in bytes
+    """
+    dirs = [basedir]
+    for level in range(depth):
+        dirs = [os.path.join(d, 'd{0}'.format(i)) for d in dirs for i in range(width)]
+        for d in dirs:
+            os.makedirs(d)
+    block = random_block(min(max_size, BLOCK_SIZE), seed)
+    total = 0
+    for i, size in enumerate(file_sizes(files, min_size, max_size, seed)):
+        with open(os.path.join(dirs[i % len(dirs)], 'f{0}.dat'.format(i)), 'wb') as f:
+            left = size
+            while left > 0:
+                f.write(block[:left])
+                left -= len(block)
+        total += size
+    # directories modified in the last seconds are never replayed from a manifest
+    past = time.time() - 60
+    for root, sub_dirs, file_names in os.walk(basedir):
+        os.utime(root, (past, past))
+    return total
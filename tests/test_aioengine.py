@@ -0,0 +1,186 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+
+def _missing(*modules):
+    for module in modules:
+        try:
+            __import__(module)
+        except ImportError:
+            return True
+    return False
+
+
+@unittest.skipIf(sys.version_info[0] < 3 or _missing('pyftpdlib', 'aioftp', 'asyncssh'),
+                 "needs Python 3, pyftpdlib, aioftp and asyncssh")
+class TestAsyncSequenceRunner(unittest.TestCase):
+    """
+        Runs the async engine against the benchmark FTP and SFTP stand-ins
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        from standins import FTPStandIn, SFTPStandIn
+        cls.remote_root = tempfile.mkdtemp()
+        cls.ftp = FTPStandIn(cls.remote_root).start()
+        cls.sftp = SFTPStandIn(cls.remote_root).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ftp.stop()
+        cls.sftp.stop()
+        shutil.rmtree(cls.remote_root)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src') + '/'
+        # states are kept on the working directory
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        # each test has its own remote directory, directory caches are shared by destination
+        self.remote_dir = '/' + self._testMethodName + '/'
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+        shutil.rmtree(os.path.join(self.remote_root, self._testMethodName), ignore_errors=True)
+
+    def write_files(self, names):
+        for name in names:
+            path = os.path.join(self.src, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(name)
+
+    def remote_files(self):
+        base = os.path.join(self.remote_root, self._testMethodName)
+        return sorted(os.path.relpath(os.path.join(root, name), base)
+                      for root, dirs, names in os.walk(base) for name in names)
+
+    def ftp_args(self, **kwargs):
+        args = dict(name='FTP', mon_name='SRC', remote_host='127.0.0.1', remote_port=str(self.ftp.port),
+                    remote_dir=self.remote_dir, username='autoant', password='autoant', threads='8')
+        args.update(kwargs)
+        return args
+
+    def scp_args(self, **kwargs):
+        args = self.ftp_args(name='SCP', remote_port=str(self.sftp.port))
+        args.update(kwargs)
+        return args
+
+    def run_producer(self, *processors):
+        from autoant.producers import DirMon
+        producer = DirMon(name='SRC', basedir=self.src, engine='async')
+        for processor in processors:
+            producer.add_process(processor)
+        producer.run()
+        return producer
+
+    def test_ftp_upload(self):
+        from autoant.processors import ProcessorFTP
+        names = ['a/b/f{0}.txt'.format(i) for i in range(20)] + ['c/f.txt']
+        self.write_files(names)
+        self.run_producer(ProcessorFTP(**self.ftp_args()))
+        self.assertEqual(self.remote_files(), sorted(names))
+
+    def test_scp_upload(self):
+        from autoant.processors import ProcessorSCP
+        names = ['a/b/f{0}.txt'.format(i) for i in range(20)] + ['c/f.txt']
+        self.write_files(names)
+        self.run_producer(ProcessorSCP(**self.scp_args()))
+        self.assertEqual(self.remote_files(), sorted(names))
+
+    def test_checksum_on_upload(self):
+        import hashlib
+        from autoant import processors
+        from autoant.processors import ProcessorFTP, ProcessorSCP
+        self.write_files(['a/f1.txt', 'f2.txt'])
+        hash_file = processors.hash_file
+
+        def no_second_read(path, algorithm):
+            raise AssertionError("{0} read again to hash it".format(path))
+        processors.hash_file = no_second_read
+        try:
+            self.run_producer(ProcessorFTP(**self.ftp_args(checksum='sha256', remote_dir=self.remote_dir + 'ftp/')),
+                              ProcessorSCP(**self.scp_args(checksum='sha256', remote_dir=self.remote_dir + 'scp/')))
+        finally:
+            processors.hash_file = hash_file
+        self.assertEqual(self.remote_files(), ['ftp/a/f1.txt', 'ftp/f2.txt', 'scp/a/f1.txt', 'scp/f2.txt'])
+        expected = dict((name, 'sha256:' + hashlib.sha256(name.encode()).hexdigest())
+                        for name in ['a/f1.txt', 'f2.txt'])
+        for name in ['SRC.FTP', 'SRC.SCP']:
+            checksums = dict((item.get_relative_path() + item.name, item.checksum)
+                             for item in processors.ProcessState(name, 'pickle').processed)
+            self.assertEqual(checksums, expected)
+
+    def test_concurrent_make_dir(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from autoant.aioengine import AsyncProcessorFTP
+        from autoant.processors import ProcessorFTP
+        loop = asyncio.new_event_loop()
+        # gather picks the current event loop
+        asyncio.set_event_loop(loop)
+        executor = ThreadPoolExecutor(2)
+        async_processor = AsyncProcessorFTP(ProcessorFTP(**self.ftp_args()), executor)
+        made = list()
+        make_dirs = async_processor.make_dirs
+
+        def counted_make_dirs(connection, directory):
+            made.append(directory)
+            return make_dirs(connection, directory)
+        async_processor.make_dirs = counted_make_dirs
+        try:
+            connections = [loop.run_until_complete(async_processor.acquire()) for i in range(8)]
+            remote_path = self.remote_dir + 'a/b/f.txt'
+            loop.run_until_complete(asyncio.gather(*[async_processor.create_path(connection, remote_path)
+                                                     for connection in connections]))
+            for connection in connections:
+                async_processor._idle.put_nowait(connection)
+            loop.run_until_complete(async_processor.disconnect())
+        finally:
+            executor.shutdown()
+            asyncio.set_event_loop(None)
+            loop.close()
+        directory = self.remote_dir.rstrip('/')
+        self.assertEqual(made, [directory, directory + '/a', directory + '/a/b'])
+        self.assertTrue(os.path.isdir(os.path.join(self.remote_root, self._testMethodName, 'a', 'b')))
+
+    def test_threaded_fallback(self):
+        from autoant.aioengine import AsyncProcessor, AsyncProcessorFTP, get_async_processor
+        from autoant.processors import ProcessorCopy, ProcessorFTP
+        dest_dir = os.path.join(self.tmp_dir, 'dst') + '/'
+        cp = ProcessorCopy(name='CP', mon_name='SRC', dest_dir=dest_dir, threads='2')
+        ftp = ProcessorFTP(**self.ftp_args())
+        resumed_ftp = ProcessorFTP(**self.ftp_args(name='FTP2', resume='True'))
+        self.assertIs(type(get_async_processor(cp, None)), AsyncProcessor)
+        self.assertIs(type(get_async_processor(ftp, None)), AsyncProcessorFTP)
+        self.assertIs(type(get_async_processor(resumed_ftp, None)), AsyncProcessor)
+        names = ['a/f1.txt', 'a/f2.txt', 'f3.txt']
+        self.write_files(names)
+        self.run_producer(cp, resumed_ftp)
+        for name in names:
+            self.assertTrue(os.path.isfile(os.path.join(dest_dir, name)))
+        self.assertEqual(self.remote_files(), sorted(names))
+
+    def test_state_saved(self):
+        from autoant.processors import ProcessorSCP
+        self.write_files(['f1.txt', 'f2.txt'])
+        self.run_producer(ProcessorSCP(**self.scp_args()))
+        self.assertEqual(self.remote_files(), ['f1.txt', 'f2.txt'])
+        for name in ['f1.txt', 'f2.txt']:
+            os.remove(os.path.join(self.remote_root, self._testMethodName, name))
+        self.write_files(['f3.txt'])
+        # a new processor and producer, like a new run, only uploads the new file
+        self.run_producer(ProcessorSCP(**self.scp_args()))
+        self.assertEqual(self.remote_files(), ['f3.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
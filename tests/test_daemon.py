@@ -0,0 +1,115 @@
+import datetime
+import time
+import unittest
+from threading import Event, Thread
+
+from autoant.daemon import CronSchedule, Daemon, IntervalSchedule, _parse_cron_field
+
+
+def timestamp(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+
+class TestCronSchedule(unittest.TestCase):
+
+    def assertNext(self, expression, after, expected):
+        self.assertEqual(CronSchedule(expression).next_time(timestamp(*after)), timestamp(*expected))
+
+    def test_parse_field(self):
+        self.assertEqual(_parse_cron_field('*', 0, 59), set(range(60)))
+        self.assertEqual(_parse_cron_field('*/20', 0, 59), set([0, 20, 40]))
+        self.assertEqual(_parse_cron_field('1-10/3', 1, 31), set([1, 4, 7, 10]))
+        self.assertEqual(_parse_cron_field('5/20', 0, 59), set([5, 25, 45]))
+        self.assertEqual(_parse_cron_field('1,3,5-6', 0, 7), set([1, 3, 5, 6]))
+
+    def test_invalid_fields(self):
+        for expression in ('60 * * * *', '* * * *', '5-1 * * * *', '*/0 * * * *', '* * 0 * *', 'a * * * *'):
+            self.assertRaises(ValueError, CronSchedule, expression)
+
+    def test_never_runs(self):
+        self.assertRaises(ValueError, CronSchedule, '0 0 30 2 *')
+        self.assertRaises(ValueError, CronSchedule, '0 0 31 4,6,9,11 *')
+
+    def test_minutes_and_hours(self):
+        self.assertNext('*/15 8-9 * * *', (2026, 1, 5, 7, 50), (2026, 1, 5, 8, 0))
+        self.assertNext('*/15 8-9 * * *', (2026, 1, 5, 8, 0), (2026, 1, 5, 8, 15))
+        self.assertNext('*/15 8-9 * * *', (2026, 1, 5, 9, 45), (2026, 1, 6, 8, 0))
+
+    def test_macros(self):
+        self.assertNext('@daily', (2026, 1, 5, 7, 50), (2026, 1, 6, 0, 0))
+        self.assertNext('@monthly', (2026, 1, 5, 7, 50), (2026, 2, 1, 0, 0))
+
+    def test_sunday_is_0_and_7(self):
+        # 2026-02-01 is a sunday
+        self.assertNext('0 0 * * 0', (2026, 1, 26), (2026, 2, 1))
+        self.assertNext('0 0 * * 7', (2026, 1, 26), (2026, 2, 1))
+
+    def test_day_or_weekday(self):
+        # both restricted, the 10th or mondays
+        self.assertNext('0 0 10 * 1', (2026, 2, 1), (2026, 2, 2))
+        self.assertNext('0 0 10 * 1', (2026, 2, 9), (2026, 2, 10))
+
+    def test_stepped_day_and_weekday(self):
+        # */2 is unrestricted like *, odd days that are mondays, first days on even weekdays
+        self.assertNext('0 0 */2 * 1', (2026, 2, 1), (2026, 2, 9))
+        self.assertNext('0 0 1 * */2', (2026, 2, 1), (2026, 3, 1))
+
+    def test_leap_day(self):
+        self.assertNext('0 0 29 2 *', (2026, 3, 1), (2028, 2, 29))
+
+
+class FakeSequence(object):
+    keep_warm = False
+
+    def close(self):
+        pass
+
+
+class WatchingProducer(object):
+    """
+        Stands for an inotify_mon with watch_time 0, runs until stopped
+    """
+    def __init__(self, name):
+        self.name = name
+        self.process_sequence = FakeSequence()
+        self.started = Event()
+        self._stop_event = Event()
+
+    def run(self):
+        self.started.set()
+        self._stop_event.wait()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class FakeAutoAnt(object):
+
+    def __init__(self):
+        self.load_config()
+
+    def load_config(self):
+        self.producers = [WatchingProducer('SRC')]
+        self.schedules = {'SRC': IntervalSchedule(60)}
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_reload_stops_watching_producers(self):
+        autoant = FakeAutoAnt()
+        daemon = Daemon(autoant)
+        daemon._schedule_producers()
+        producer = autoant.producers[0]
+        daemon._start_cycle(producer)
+        self.assertTrue(producer.started.wait(5))
+        reload = Thread(target=daemon.reload)
+        reload.daemon = True
+        reload.start()
+        reload.join(5)
+        self.assertFalse(reload.is_alive())
+        self.assertIsNot(autoant.producers[0], producer)
+        self.assertEqual(list(daemon._producers), ['SRC'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import io
+import unittest
+
+from autoant.pool import ConnectionPool, SendingReader
+
+
+class FakeConnection(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.alive = True
+        self.closed = False
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.opened = list()
+        self.pool = ConnectionPool(('ftp', 'localhost', 21, 'autoant'), self.open_connection, self.close_connection,
+                                   self.check_connection)
+
+    def open_connection(self):
+        connection = FakeConnection(len(self.opened))
+        self.opened.append(connection)
+        return connection
+
+    def close_connection(self, connection):
+        connection.closed = True
+
+    def check_connection(self, connection):
+        return connection.alive
+
+    def stale_pooled_connection(self):
+        """
+            Returns a pooled connection the server dropped while it was idle
+        """
+        with self.pool.connection() as connection:
+            pass
+        connection.alive = False
+        return connection
+
+    def test_reuses_connection(self):
+        first = self.pool.run(lambda connection: connection, lambda: False)
+        second = self.pool.run(lambda connection: connection, lambda: False)
+        self.assertIs(first, second)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_stale_connection_replaced_before_sending(self):
+        stale = self.stale_pooled_connection()
+
+        def work(connection):
+            if not connection.alive:
+                raise EOFError("connection closed")
+            return connection
+        self.assertIs(self.pool.run(work, lambda: False), self.opened[1])
+        self.assertTrue(stale.closed)
+
+    def test_stale_connection_fails_after_sending(self):
+        stale = self.stale_pooled_connection()
+        runs = list()
+
+        def work(connection):
+            runs.append(connection)
+            raise EOFError("connection closed")
+        self.assertRaises(EOFError, self.pool.run, work, lambda: True)
+        self.assertEqual(runs, [stale])
+        self.assertTrue(stale.closed)
+
+    def test_alive_connection_error_not_retried(self):
+        runs = list()
+
+        def work(connection):
+            runs.append(connection)
+            raise IOError("permission denied")
+        self.assertRaises(IOError, self.pool.run, work, lambda: False)
+        self.assertEqual(len(runs), 1)
+        # still usable, back to the pool
+        self.assertIs(self.pool.acquire(), runs[0])
+
+
+class TestSendingReader(unittest.TestCase):
+
+    def test_calls_on_send_once(self):
+        sent = list()
+        reader = SendingReader(io.BytesIO(b'data'), lambda: sent.append(True))
+        self.assertEqual(sent, [])
+        self.assertEqual(reader.read(2), b'da')
+        self.assertEqual(reader.read(), b'ta')
+        self.assertEqual(sent, [True])
+        self.assertEqual(reader.tell(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import sys
+import unittest
+
+from autoant.processors import ProcessorEcho
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), "needs inotify")
+class TestInotifyMon(unittest.TestCase):
+
+    def inotify_mon(self, **kwargs):
+        from autoant.producers import InotifyMon
+        return InotifyMon(name='SRC', basedir='/tmp/', **kwargs)
+
+    def echo(self, **kwargs):
+        return ProcessorEcho(name='ECHO', mon_name='SRC', **kwargs)
+
+    def test_rejects_dir_mon_only_properties(self):
+        for name, value in (('manifest', 'True'), ('walk_threads', '4'), ('walk_ordered', 'True'),
+                            ('max_files', '10')):
+            self.assertRaises(SystemExit, self.inotify_mon, **{name: value})
+
+    def test_watching_forever_needs_a_recording_state_backend(self):
+        producer = self.inotify_mon()
+        self.assertRaises(SystemExit, producer.add_process, self.echo())
+        producer.add_process(self.echo(state_backend='journal'))
+        producer.add_process(self.echo(state='False'))
+        self.inotify_mon(watch_time='10').add_process(self.echo())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from autoant.states import PickleStateBackend, JournalStateBackend
+
+
+class TestJournalStateBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.name = os.path.join(self.tmp_dir, 'SRC.CP')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_once(self, new_items):
+        """
+            Loads the state, records new_items and saves, like a processor run
+        """
+        state = JournalStateBackend(self.name)
+        items = list(state.load())
+        for item in new_items:
+            state.record(item)
+            items.append(item)
+        state.save(items)
+        return items
+
+    def test_migrates_pickle_state(self):
+        PickleStateBackend(self.name).save(['a', 'b'])
+        self.assertEqual(self.run_once(['c']), ['a', 'b', 'c'])
+        self.assertTrue(os.path.isfile(self.name + '.jnl'))
+        self.assertEqual(list(JournalStateBackend(self.name).load()), ['a', 'b', 'c'])
+
+    def test_migrated_state_survives_later_runs(self):
+        PickleStateBackend(self.name).save(['a', 'b'])
+        self.run_once([])
+        self.run_once(['c'])
+        self.run_once(['d'])
+        self.assertEqual(list(JournalStateBackend(self.name).load()), ['a', 'b', 'c', 'd'])
+
+    def test_appends_and_reloads(self):
+        self.run_once(['a'])
+        self.run_once(['b'])
+        self.assertEqual(list(JournalStateBackend(self.name).load()), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from autoant.utilslinux import OpenFileIndex
+
+HOLD_OPEN = "import sys; f = open(sys.argv[1]); sys.stdout.write('open\\n'); sys.stdout.flush(); sys.stdin.readline()"
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), "needs /proc")
+class TestOpenFileIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'f.dat')
+        with open(self.path, 'w') as f:
+            f.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def hold_open(self):
+        """
+            Starts a process holding the file open until a line is written to its stdin
+        """
+        holder = subprocess.Popen([sys.executable, '-c', HOLD_OPEN, self.path],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        holder.stdout.readline()
+        return holder
+
+    def release(self, holder):
+        holder.stdin.write(b'\n')
+        holder.stdin.flush()
+        holder.wait()
+
+    def test_open_by_other_process(self):
+        holder = self.hold_open()
+        try:
+            self.assertTrue(OpenFileIndex(ttl=60).is_open(self.path))
+        finally:
+            self.release(holder)
+
+    def test_closed_within_ttl(self):
+        index = OpenFileIndex(ttl=60)
+        holder = self.hold_open()
+        self.assertTrue(index.is_open(self.path))
+        self.release(holder)
+        self.assertFalse(index.is_open(self.path))
+
+    def test_own_process_ignored(self):
+        with open(self.path):
+            self.assertFalse(OpenFileIndex(ttl=60).is_open(self.path))
+
+    def test_ttl_snapshot(self):
+        index = OpenFileIndex(ttl=60)
+        self.assertFalse(index.is_open(self.path))
+        holder = self.hold_open()
+        try:
+            # not refreshed yet
+            self.assertFalse(index.is_open(self.path))
+            index._refreshed = time.time() - 60
+            self.assertTrue(index.is_open(self.path))
+        finally:
+            self.release(holder)
+
+
+if __name__ == '__main__':
+    unittest.main()